@@ -1,14 +1,20 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, status, BackgroundTasks, UploadFile, File, Form, Request, Body
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, status, BackgroundTasks, UploadFile, File, Form, Request, Response, Body
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.staticfiles import StaticFiles
+from fastapi.responses import StreamingResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError, OperationFailure
 import os
+import asyncio
 import logging
 import base64
 import hashlib
 import json
+import time
+import math
 from pathlib import Path
 from pydantic import BaseModel, Field, EmailStr
 from typing import List, Optional, Union
@@ -23,10 +29,21 @@ ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
 # Import Portainer service
-from services.portainer_service import portainer_service
+from services.portainer_service import portainer_service, precompress_static_assets, build_directory_archive, TRAEFIK_ROUTING_MODE
 from services.arvento_service import ArventoService
 from services.kabis_service import KabisService, kabis_service
+from services.kabis_outbox import kabis_outbox
 from services.hgs_service import HGSService, hgs_service
+from services.hgs_statement import iter_statement_rows, StatementError
+from services.tenant_db_registry import tenant_db_registry, get_safe_code, get_tenant_mongo_url
+from services.tenant_fanout import tenant_fanout
+from services.portainer_inventory import portainer_inventory
+from services.tenant_snapshots import tenant_snapshots
+from services.fleet_health import fleet_health
+from services.gps_positions import gps_position_cache, diff_positions
+from services.gps_history import gps_history
+from services.gps_geo import vehicle_position_index
+from services.integration_http import integration_http
 import subprocess
 import tarfile
 import io
@@ -443,11 +460,28 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None) -
     return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
 
 async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
-    token = credentials.credentials
+    return await get_user_from_token(credentials.credentials)
+
+STREAM_TOKEN_EXPIRE_SECONDS = 60
+
+async def get_stream_user(request: Request, token: Optional[str] = None):
+    """
+    Auth for streaming endpoints. EventSource cannot send headers, so ?token=
+    is accepted too - but only a short-lived stream token (POST /auth/stream-token),
+    never the session JWT, since query strings end up in access logs.
+    """
+    auth_header = request.headers.get("authorization", "")
+    if auth_header.lower().startswith("bearer "):
+        return await get_user_from_token(auth_header[7:])
+    if not token:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    return await get_user_from_token(token, scope="stream")
+
+async def get_user_from_token(token: str, scope: Optional[str] = None):
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         user_id: str = payload.get("sub")
-        if user_id is None:
+        if user_id is None or payload.get("scope") != scope:
             raise HTTPException(status_code=401, detail="Invalid token")
     except JWTError:
         raise HTTPException(status_code=401, detail="Invalid token")
@@ -533,6 +567,15 @@ async def get_me(user: dict = Depends(get_current_user)):
         created_at=datetime.fromisoformat(user["created_at"]) if isinstance(user["created_at"], str) else user["created_at"]
     )
 
+@api_router.post("/auth/stream-token")
+async def create_stream_token(user: dict = Depends(get_current_user)):
+    """Short-lived token for EventSource streams (?token=), so the session JWT never appears in URLs"""
+    token = create_access_token(
+        {"sub": user["id"], "scope": "stream"},
+        expires_delta=timedelta(seconds=STREAM_TOKEN_EXPIRE_SECONDS)
+    )
+    return {"token": token, "expires_in": STREAM_TOKEN_EXPIRE_SECONDS}
+
 # ============== SUPERADMIN COMPANY ROUTES ==============
 @api_router.post("/superadmin/companies", response_model=CompanyResponse)
 async def create_company_superadmin(company: CompanyCreate, user: dict = Depends(get_current_user)):
@@ -710,18 +753,30 @@ async def delete_company_superadmin(company_id: str, hard_delete: bool = False,
     
     deleted_resources = []
     errors = []
+    stack_removed = not company.get("portainer_stack_id")
     
     # 1. Delete Portainer stack if exists
     if company.get("portainer_stack_id"):
         try:
             stack_result = await portainer_service.delete_stack(company["portainer_stack_id"])
             if stack_result.get("success"):
+                stack_removed = True
+                portainer_inventory.mark_stale()
+                await tenant_db_registry.evict(company.get("code", ""))
                 deleted_resources.append(f"Portainer Stack (ID: {company['portainer_stack_id']})")
             else:
                 errors.append(f"Portainer stack silme hatası: {stack_result.get('error')}")
         except Exception as e:
             errors.append(f"Portainer hatası: {str(e)}")
     
+    # Shared-mode tenants keep their data on the shared instance - drop user and database
+    if company.get("mongo_mode") == "shared" and stack_removed:
+        try:
+            await tenant_db_registry.drop_shared_tenant(company["code"], drop_data=True)
+            deleted_resources.append(f"Paylaşımlı MongoDB veritabanı ({company['code']})")
+        except Exception as e:
+            errors.append(f"Paylaşımlı MongoDB hatası: {str(e)}")
+    
     # 2. Delete all company data from database
     try:
         # Delete vehicles
@@ -749,10 +804,19 @@ async def delete_company_superadmin(company_id: str, hard_delete: bool = False,
         if users_result.deleted_count > 0:
             deleted_resources.append(f"{users_result.deleted_count} kullanıcı")
         
-        # Delete company record
+        # Delete company record and free its ports
         await db.companies.delete_one({"id": company_id})
+        if stack_removed:
+            await portainer_service.release_port_offset(db, company.get("port_offset"))
         deleted_resources.append("Firma kaydı")
         
+        if company.get("backend_mode") == "shared":
+            await sync_shared_backend_tenants()
+        if company.get("frontend_mode") == "shared":
+            await sync_shared_frontend_hosts()
+        if company.get("portainer_stack_id") and company.get("domain"):
+            await refresh_traefik_routing()
+        
     except Exception as e:
         errors.append(f"Veritabanı hatası: {str(e)}")
     
@@ -828,6 +892,8 @@ async def deploy_company_frontend(company_code: str, backend_url: str, container
         
         logger.info(f"[FRONTEND-DEPLOY] Build completed successfully for {company_code}")
         
+        await asyncio.to_thread(precompress_static_assets, build_dir)
+        
         # Create tar archive
         tar_buffer = io.BytesIO()
         with tarfile.open(fileobj=tar_buffer, mode='w') as tar:
@@ -868,7 +934,7 @@ async def deploy_company_frontend(company_code: str, backend_url: str, container
         logger.error(f"[FRONTEND-DEPLOY] Error for {company_code}: {str(e)}")
         return {"success": False, "error": str(e)}
 
-async def deploy_company_backend(company_code: str, container_name: str, mongo_service_name: str, db_name: str):
+async def deploy_company_backend(company_code: str, container_name: str, mongo_url: str, db_name: str):
     """
     Background task to deploy backend code to company container
     """
@@ -876,7 +942,7 @@ async def deploy_company_backend(company_code: str, container_name: str, mongo_s
     
     logger.info(f"[BACKEND-DEPLOY] Starting backend deployment for {company_code}")
     logger.info(f"[BACKEND-DEPLOY] Container: {container_name}")
-    logger.info(f"[BACKEND-DEPLOY] MongoDB service: {mongo_service_name}")
+    logger.info(f"[BACKEND-DEPLOY] MongoDB: {mongo_url.split('@')[-1]}")
     logger.info(f"[BACKEND-DEPLOY] Database: {db_name}")
     
     try:
@@ -885,24 +951,16 @@ async def deploy_company_backend(company_code: str, container_name: str, mongo_s
         
         backend_dir = "/app/backend"
         
-        # Create tar with backend files
+        # Backend code is the same for every tenant - compressed once and reused
+        code_archive = await asyncio.to_thread(
+            build_directory_archive, backend_dir, include=('server.py', 'requirements.txt', 'services')
+        )
+        
+        # Tenant-specific files go in a small archive of their own
         tar_buffer = io.BytesIO()
         with tarfile.open(fileobj=tar_buffer, mode='w') as tar:
-            # Add server.py
-            tar.add(f"{backend_dir}/server.py", arcname="server.py")
-            tar.add(f"{backend_dir}/requirements.txt", arcname="requirements.txt")
-            
-            # Add services folder
-            services_dir = f"{backend_dir}/services"
-            if os.path.exists(services_dir):
-                for root, dirs, files in os.walk(services_dir):
-                    for file in files:
-                        file_path = os.path.join(root, file)
-                        arcname = os.path.relpath(file_path, backend_dir)
-                        tar.add(file_path, arcname=arcname)
-            
             # Add .env with correct settings
-            env_content = f"""MONGO_URL=mongodb://{mongo_service_name}:27017
+            env_content = f"""MONGO_URL={mongo_url}
 DB_NAME={db_name}
 JWT_SECRET={company_code}_jwt_secret_2024
 """
@@ -925,9 +983,15 @@ JWT_SECRET={company_code}_jwt_secret_2024
         # Upload to container
         upload_result = await portainer_service.upload_to_container(
             container_name=container_name,
-            tar_data=tar_data,
+            tar_data=code_archive,
             dest_path="/app"
         )
+        if not upload_result.get('error'):
+            upload_result = await portainer_service.upload_to_container(
+                container_name=container_name,
+                tar_data=tar_data,
+                dest_path="/app"
+            )
         
         if upload_result.get('error'):
             logger.error(f"[BACKEND-DEPLOY] Upload failed for {company_code}: {upload_result.get('error')}")
@@ -935,11 +999,10 @@ JWT_SECRET={company_code}_jwt_secret_2024
         
         logger.info(f"[BACKEND-DEPLOY] Upload successful, installing dependencies...")
         
-        # Install dependencies
-        install_result = await portainer_service.exec_in_container(
-            container_name=container_name,
-            command='pip install "bcrypt>=4.0.0,<4.1.0" "passlib[bcrypt]>=1.7.4" motor python-jose python-dotenv httpx --quiet'
-        )
+        # Install dependencies (offline from the shared wheelhouse, skipped when already current)
+        install_result = await portainer_service.install_backend_dependencies(container_name)
+        if install_result.get('error'):
+            logger.warning(f"[BACKEND-DEPLOY] Dependency install issue for {company_code}: {install_result.get('error')}")
         
         logger.info(f"[BACKEND-DEPLOY] Dependencies installed, restarting container...")
         
@@ -957,27 +1020,21 @@ JWT_SECRET={company_code}_jwt_secret_2024
         logger.error(f"[BACKEND-DEPLOY] Error for {company_code}: {str(e)}")
         return {"success": False, "error": str(e)}
 
-async def setup_company_database(company: dict, mongo_port: int, db_name: str = None):
+async def setup_company_database(company: dict, mongo_mode: Optional[str] = None):
     """
     Setup company database with admin user
+    (dedicated container or shared instance, through tenant_db_registry)
     """
-    from motor.motor_asyncio import AsyncIOMotorClient
+    mongo_mode = mongo_mode or company.get("mongo_mode") or "dedicated"
+    db_name = f"{get_safe_code(company.get('code'))}_db"
     
-    # Use provided db_name or calculate from company code
-    if not db_name:
-        company_code = company.get("code", "").replace("-", "").replace("_", "")
-        db_name = f"{company_code}_db"
-    
-    logger.info(f"[DB-SETUP] Setting up database for {company['name']} on port {mongo_port}")
+    logger.info(f"[DB-SETUP] Setting up database for {company['name']} ({mongo_mode})")
     logger.info(f"[DB-SETUP] Database name: {db_name}")
     
     try:
-        # Connect to company's MongoDB
-        mongo_url = f"mongodb://72.61.158.147:{mongo_port}"
-        logger.info(f"[DB-SETUP] Connecting to MongoDB at {mongo_url}")
-        
-        client = AsyncIOMotorClient(mongo_url, serverSelectionTimeoutMS=15000)
-        company_db = client[db_name]
+        company_db = await tenant_db_registry.get_db(company.get("code"), mongo_mode=mongo_mode)
+        if company_db is None:
+            raise ConnectionError(f"MongoDB for {company.get('code')} unreachable")
         
         # Create company record
         company_id = company.get("id")
@@ -1021,7 +1078,6 @@ async def setup_company_database(company: dict, mongo_port: int, db_name: str =
         else:
             logger.info(f"[DB-SETUP] Admin user already exists: {admin_email}")
         
-        client.close()
         logger.info(f"[DB-SETUP] Database setup completed for {company['name']}")
         return {"success": True, "admin_email": admin_email, "admin_password": admin_password}
         
@@ -1041,7 +1097,7 @@ async def full_auto_provision(company: dict, result: dict, port_offset: int):
     import asyncio
     
     company_code = company["code"]
-    safe_code = company_code.replace('-', '').replace('_', '')
+    safe_code = get_safe_code(company_code)
     domain = company.get("domain")
     
     logger.info(f"[AUTO-PROVISION] Starting full auto provision for {company['name']}")
@@ -1056,17 +1112,17 @@ async def full_auto_provision(company: dict, result: dict, port_offset: int):
         # Container names use safe_code (no dashes/underscores)
         logger.info(f"[AUTO-PROVISION] Step 1: Deploying backend code...")
         backend_container = f"{safe_code}_backend"
-        mongo_service_name = f"{safe_code}_mongodb"
+        mongo_mode = result.get("mongo_mode") or company.get("mongo_mode") or "dedicated"
         db_name = f"{safe_code}_db"
         
         logger.info(f"[AUTO-PROVISION] Backend container: {backend_container}")
-        logger.info(f"[AUTO-PROVISION] MongoDB service: {mongo_service_name}")
+        logger.info(f"[AUTO-PROVISION] MongoDB mode: {mongo_mode}")
         logger.info(f"[AUTO-PROVISION] Database: {db_name}")
         
         await deploy_company_backend(
             company_code=company_code,
             container_name=backend_container,
-            mongo_service_name=mongo_service_name,
+            mongo_url=get_tenant_mongo_url(company_code, mongo_mode),
             db_name=db_name
         )
         
@@ -1093,12 +1149,14 @@ async def full_auto_provision(company: dict, result: dict, port_offset: int):
         
         # Step 3: Setup database with admin user
         logger.info(f"[AUTO-PROVISION] Step 3: Setting up database and admin user...")
-        mongo_port = result.get('ports', {}).get('mongodb', 21000 + port_offset)
-        await setup_company_database(company, mongo_port, db_name)
+        await setup_company_database(company, mongo_mode)
         
-        # Step 4: Restart Traefik to pick up new labels
+        # Step 4: Publish the tenant's routes to Traefik
         logger.info(f"[AUTO-PROVISION] Step 4: Refreshing Traefik routing...")
-        await restart_traefik_for_new_labels()
+        if TRAEFIK_ROUTING_MODE == 'docker':
+            await restart_traefik_for_new_labels()
+        else:
+            await refresh_traefik_routing(wait_for=company_code)
         
         logger.info(f"[AUTO-PROVISION] Full auto provision completed for {company['name']}")
         
@@ -1115,9 +1173,99 @@ async def full_auto_provision(company: dict, result: dict, port_offset: int):
         logger.error(f"[AUTO-PROVISION] Error during auto provision for {company['name']}: {str(e)}")
 
 
+async def refresh_traefik_routing(wait_for: Optional[str] = None) -> dict:
+    """
+    Bring Traefik routes in line with provisioned companies.
+    
+    File mode regenerates the dynamic config from the companies collection;
+    Traefik hot-reloads it, so existing tenants keep serving. In docker (label)
+    mode this is a no-op: the provider follows container labels by itself and
+    drops removed containers, so the platform-wide proxy is never restarted here.
+    
+    Args:
+        wait_for: Company code whose routes must be live before returning
+    """
+    if TRAEFIK_ROUTING_MODE == 'docker':
+        return {"success": True, "mode": "docker"}
+    
+    try:
+        companies = await db.companies.find(
+            {"domain": {"$nin": [None, ""]}, "portainer_stack_id": {"$ne": None}},
+            {"_id": 0, "code": 1, "domain": 1, "backend_mode": 1, "frontend_mode": 1}
+        ).to_list(length=None)
+        tenants = [
+            {
+                "code": c["code"],
+                "domain": c["domain"],
+                "backend_mode": c.get("backend_mode", "dedicated"),
+                "frontend_mode": c.get("frontend_mode", "dedicated")
+            }
+            for c in companies if c.get("code")
+        ]
+        result = await portainer_service.update_traefik_routes(
+            tenants,
+            wait_for=[wait_for] if wait_for else None
+        )
+        if result.get("success") and wait_for and not result.get("routes_ready"):
+            logger.warning(f"[TRAEFIK] Routes for {wait_for} not live yet: {result.get('pending_routers')}")
+        return {**result, "mode": "file"}
+    except Exception as e:
+        logger.warning(f"[TRAEFIK] Route refresh error (non-critical): {str(e)}")
+        return {"success": False, "mode": "file", "error": str(e)}
+
+
+async def sync_shared_backend_tenants() -> dict:
+    """
+    Rewrite the multi-tenant backend's Host -> tenant map from companies
+    consolidated onto it (backend_mode 'shared')
+    """
+    companies = await db.companies.find(
+        {"backend_mode": "shared", "domain": {"$nin": [None, ""]}},
+        {"_id": 0, "code": 1, "name": 1, "domain": 1, "mongo_mode": 1}
+    ).to_list(length=None)
+    
+    tenants = []
+    for company in companies:
+        safe_code = get_safe_code(company["code"])
+        domain = company["domain"]
+        tenants.append({
+            "code": company["code"],
+            "name": company.get("name"),
+            "hosts": [f"api.{domain}"],
+            "mongo_url": get_tenant_mongo_url(company["code"], company.get("mongo_mode") or "dedicated"),
+            "db_name": f"{safe_code}_db",
+            "env": {
+                # Same secret as the dedicated container, so existing tokens stay valid
+                "JWT_SECRET": f"{safe_code}_jwt_secret_2024",
+                "COMPANY_CODE": company["code"],
+                "COMPANY_NAME": company.get("name", ""),
+                "API_URL": f"https://api.{domain}",
+                "DOMAIN": domain
+            }
+        })
+    
+    result = await portainer_service.write_shared_backend_tenant_map(tenants)
+    return {**result, "tenant_count": len(tenants)}
+
+
+async def get_shared_frontend_tenants() -> list:
+    """Companies whose web panel is served by the shared static frontend"""
+    return await db.companies.find(
+        {"frontend_mode": "shared", "domain": {"$nin": [None, ""]}, "portainer_stack_id": {"$ne": None}},
+        {"_id": 0, "code": 1, "domain": 1}
+    ).to_list(length=None)
+
+
+async def sync_shared_frontend_hosts() -> dict:
+    """Rewrite the shared frontend's Host -> API URL map (config.js per Host)"""
+    tenants = await get_shared_frontend_tenants()
+    return await portainer_service.write_shared_frontend_hosts(tenants)
+
+
 async def restart_traefik_for_new_labels():
     """
     Restart Traefik container to pick up new Docker labels from newly created containers
+    (legacy label routing; file routing uses refresh_traefik_routing)
     """
     try:
         # Find and restart Traefik container
@@ -1163,15 +1311,27 @@ async def provision_company(company_id: str, background_tasks: BackgroundTasks,
     if company.get("portainer_stack_id"):
         raise HTTPException(status_code=400, detail="Company already has a provisioned stack")
     
-    # Get next available port offset
-    port_offset = await portainer_service.get_next_port_offset(db)
+    # Reserve a port offset atomically (unique index guards against stale free-list entries)
+    if company.get("port_offset") is not None:
+        port_offset = company["port_offset"]
+    else:
+        port_offset = None
+        for _ in range(3):
+            candidate = await portainer_service.allocate_port_offset(db)
+            try:
+                await db.companies.update_one({"id": company_id}, {"$set": {"port_offset": candidate}})
+                port_offset = candidate
+                break
+            except DuplicateKeyError:
+                logger.warning(f"[PROVISION] Port offset {candidate} already in use, allocating another")
+        if port_offset is None:
+            raise HTTPException(status_code=500, detail="Port offset could not be allocated")
     
     # Update status to provisioning
     await db.companies.update_one(
         {"id": company_id},
         {"$set": {
             "status": CompanyStatus.PROVISIONING.value,
-            "port_offset": port_offset,
             "updated_at": datetime.now(timezone.utc).isoformat()
         }}
     )
@@ -1179,23 +1339,30 @@ async def provision_company(company_id: str, background_tasks: BackgroundTasks,
     # Check if domain is set - use full stack if domain exists
     domain = company.get("domain")
     
-    if domain:
-        # Create full stack with Traefik labels for domain routing
-        result = await portainer_service.create_full_stack(
-            company_code=company["code"],
-            company_name=company["name"],
-            domain=domain,
-            port_offset=port_offset
-        )
-    else:
-        # Create minimal stack (MongoDB only) for IP-based access
-        result = await portainer_service.create_stack(
-            company_code=company["code"],
-            company_name=company["name"],
-            port_offset=port_offset
-        )
+    try:
+        if domain:
+            # Create full stack with Traefik labels for domain routing
+            result = await portainer_service.create_full_stack(
+                company_code=company["code"],
+                company_name=company["name"],
+                domain=domain,
+                port_offset=port_offset,
+                plan=company.get("subscription_plan")
+            )
+        else:
+            # Create minimal stack (MongoDB only) for IP-based access
+            result = await portainer_service.create_stack(
+                company_code=company["code"],
+                company_name=company["name"],
+                port_offset=port_offset
+            )
+    except Exception as e:
+        # Handled like a failed result below, so the port offset is released
+        logger.error(f"[PROVISION] Stack creation raised for {company['code']}: {e}")
+        result = {"success": False, "error": str(e)}
     
     if result.get("success"):
+        portainer_inventory.mark_stale()
         # Update company with stack info
         await db.companies.update_one(
             {"id": company_id},
@@ -1203,6 +1370,9 @@ async def provision_company(company_id: str, background_tasks: BackgroundTasks,
                 "status": CompanyStatus.ACTIVE.value,
                 "portainer_stack_id": result.get("stack_id"),
                 "stack_name": result.get("stack_name"),
+                "mongo_mode": result.get("mongo_mode", "dedicated"),
+                "frontend_mode": result.get("frontend_mode", "dedicated"),
+                "resource_plan": result.get("resource_plan"),
                 "ports": result.get("ports"),
                 "urls": result.get("urls"),
                 "updated_at": datetime.now(timezone.utc).isoformat()
@@ -1226,11 +1396,18 @@ async def provision_company(company_id: str, background_tasks: BackgroundTasks,
                 admin_email=admin_email,
                 admin_password=admin_password,
                 mongo_port=mongo_port,
-                backend_port=backend_port
+                backend_port=backend_port,
+                mongo_mode=result.get("mongo_mode"),
+                frontend_mode=result.get("frontend_mode")
             )
             
             logger.info(f"[PROVISION] Full deployment result: {deploy_result.get('success')}")
             
+            if result.get("frontend_mode") == "shared":
+                deploy_result["shared_frontend"] = await sync_shared_frontend_hosts()
+            
+            routing_result = await refresh_traefik_routing(wait_for=company["code"])
+            
             return {
                 "message": "Company provisioned and deployed successfully",
                 "stack_id": result.get("stack_id"),
@@ -1238,6 +1415,7 @@ async def provision_company(company_id: str, background_tasks: BackgroundTasks,
                 "urls": result.get("urls"),
                 "ports": result.get("ports"),
                 "deployment": deploy_result,
+                "routing": routing_result,
                 "admin_email": admin_email,
                 "note": "Stack oluşturuldu, template'den kod kopyalandı, database kuruldu."
             }
@@ -1252,15 +1430,17 @@ async def provision_company(company_id: str, background_tasks: BackgroundTasks,
                 "note": "Domain belirtilmediği için sadece MongoDB kuruldu."
             }
     else:
-        # Revert status
+        # Revert status and give the port offset back
         await db.companies.update_one(
             {"id": company_id},
             {"$set": {
                 "status": CompanyStatus.PENDING.value,
                 "provisioning_error": result.get("error"),
                 "updated_at": datetime.now(timezone.utc).isoformat()
-            }}
+            },
+            "$unset": {"port_offset": ""}}
         )
+        await portainer_service.release_port_offset(db, port_offset)
         raise HTTPException(status_code=500, detail=f"Provisioning failed: {result.get('error')}")
 
 @api_router.delete("/superadmin/companies/{company_id}/provision")
@@ -1281,6 +1461,14 @@ async def deprovision_company(company_id: str, user: dict = Depends(get_current_
     result = await portainer_service.delete_stack(stack_id)
     
     if result.get("success"):
+        portainer_inventory.mark_stale()
+        await tenant_db_registry.evict(company.get("code", ""))
+        if company.get("mongo_mode") == "shared":
+            # Revoke the tenant's access; its database stays on the shared instance
+            try:
+                await tenant_db_registry.drop_shared_tenant(company["code"], drop_data=False)
+            except Exception as e:
+                logger.warning(f"[DEPROVISION] Shared MongoDB user cleanup failed for {company['code']}: {e}")
         await db.companies.update_one(
             {"id": company_id},
             {"$set": {
@@ -1290,8 +1478,16 @@ async def deprovision_company(company_id: str, user: dict = Depends(get_current_
                 "ports": None,
                 "urls": None,
                 "updated_at": datetime.now(timezone.utc).isoformat()
-            }}
+            },
+            "$unset": {"port_offset": "", "backend_mode": "", "frontend_mode": ""}}
         )
+        await portainer_service.release_port_offset(db, company.get("port_offset"))
+        if company.get("backend_mode") == "shared":
+            await sync_shared_backend_tenants()
+        if company.get("frontend_mode") == "shared":
+            await sync_shared_frontend_hosts()
+        if company.get("domain"):
+            await refresh_traefik_routing()
         return {"message": "Company stack removed successfully"}
     else:
         raise HTTPException(status_code=500, detail=f"Deprovisioning failed: {result.get('error')}")
@@ -1322,10 +1518,14 @@ async def update_company_from_template(company_id: str, user: dict = Depends(get
     
     logger.info(f"[UPDATE-TEMPLATE] Starting template update for {company['name']} ({company_code})")
     
+    # Snapshot current code so a bad update can be rolled back
+    snapshot = await tenant_snapshots.create(db, company_code, frontend_mode=company.get("frontend_mode"))
+    
     # Update from template
     result = await portainer_service.update_tenant_from_template(
         company_code=company_code,
-        domain=domain
+        domain=domain,
+        frontend_mode=company.get("frontend_mode")
     )
     
     if result.get("success"):
@@ -1344,19 +1544,64 @@ async def update_company_from_template(company_id: str, user: dict = Depends(get
             "company_name": company['name'],
             "domain": domain,
             "results": result.get("results"),
+            "snapshot": snapshot,
             "note": "Veritabanı verileri korundu. Sadece kod güncellendi."
         }
     else:
         raise HTTPException(
             status_code=500, 
             detail=f"Güncelleme başarısız: {result.get('error')}"
+            + (f" (geri almak için snapshot: {snapshot['snapshot_id']})" if snapshot.get("success") else "")
+        )
+
+class RollbackRequest(BaseModel):
+    snapshot_id: Optional[str] = None  # default: latest snapshot
+
+@api_router.get("/superadmin/companies/{company_id}/snapshots")
+async def list_company_snapshots(company_id: str, user: dict = Depends(get_current_user)):
+    """SuperAdmin: Code snapshots taken before template updates, newest first"""
+    if user["role"] != UserRole.SUPERADMIN.value:
+        raise HTTPException(status_code=403, detail="Only SuperAdmin can view snapshots")
+    
+    company = await db.companies.find_one({"id": company_id}, {"_id": 0, "code": 1})
+    if not company:
+        raise HTTPException(status_code=404, detail="Company not found")
+    
+    return {"snapshots": await tenant_snapshots.list_snapshots(db, company["code"])}
+
+@api_router.post("/superadmin/companies/{company_id}/rollback")
+async def rollback_company_code(company_id: str, data: RollbackRequest, user: dict = Depends(get_current_user)):
+    """
+    SuperAdmin: Restore tenant code from a snapshot taken before a template update.
+    Only files that differ from the snapshot are uploaded; the database is not touched.
+    """
+    if user["role"] != UserRole.SUPERADMIN.value:
+        raise HTTPException(status_code=403, detail="Only SuperAdmin can roll back companies")
+    
+    company = await db.companies.find_one({"id": company_id}, {"_id": 0})
+    if not company:
+        raise HTTPException(status_code=404, detail="Company not found")
+    
+    result = await tenant_snapshots.rollback(db, company["code"], data.snapshot_id)
+    if result.get("error") == "Snapshot not found":
+        raise HTTPException(status_code=404, detail="Snapshot bulunamadı")
+    
+    if result.get("success"):
+        await db.companies.update_one(
+            {"id": company_id},
+            {"$set": {
+                "last_rollback": {"snapshot_id": result["snapshot_id"], "at": datetime.now(timezone.utc).isoformat()},
+                "updated_at": datetime.now(timezone.utc).isoformat()
+            }}
         )
+    return result
 
 @api_router.post("/superadmin/companies/update-all-from-template")
-async def update_all_companies_from_template(user: dict = Depends(get_current_user)):
+async def update_all_companies_from_template(only_healthy: bool = False, user: dict = Depends(get_current_user)):
     """
     SuperAdmin: Update ALL active companies from template.
     This is a batch operation that updates all deployed companies.
+    only_healthy skips tenants the fleet health prober does not report as up.
     """
     if user["role"] != UserRole.SUPERADMIN.value:
         raise HTTPException(status_code=403, detail="Only SuperAdmin can perform batch updates")
@@ -1381,10 +1626,22 @@ async def update_all_companies_from_template(user: dict = Depends(get_current_us
         company_code = company.get("code")
         domain = company.get("domain")
         
+        if only_healthy and not fleet_health.is_healthy(company_code):
+            results.append({
+                "company": company["name"],
+                "code": company_code,
+                "success": False,
+                "skipped": True,
+                "error": "Tenant sağlık kontrolünden geçmedi"
+            })
+            continue
+        
         try:
+            snapshot = await tenant_snapshots.create(db, company_code, frontend_mode=company.get("frontend_mode"))
             result = await portainer_service.update_tenant_from_template(
                 company_code=company_code,
-                domain=domain
+                domain=domain,
+                frontend_mode=company.get("frontend_mode")
             )
             
             if result.get("success"):
@@ -1400,7 +1657,8 @@ async def update_all_companies_from_template(user: dict = Depends(get_current_us
                 results.append({
                     "company": company["name"],
                     "code": company_code,
-                    "success": True
+                    "success": True,
+                    "snapshot_id": snapshot.get("snapshot_id")
                 })
             else:
                 fail_count += 1
@@ -1408,7 +1666,8 @@ async def update_all_companies_from_template(user: dict = Depends(get_current_us
                     "company": company["name"],
                     "code": company_code,
                     "success": False,
-                    "error": result.get("error")
+                    "error": result.get("error"),
+                    "snapshot_id": snapshot.get("snapshot_id")
                 })
         except Exception as e:
             fail_count += 1
@@ -1536,8 +1795,31 @@ async def get_template_info(user: dict = Depends(get_current_user)):
     
     return info
 
+@api_router.get("/superadmin/fleet/health")
+async def get_fleet_health(company_code: Optional[str] = None, hours: int = 24, user: dict = Depends(get_current_user)):
+    """
+    SuperAdmin: Live health of all tenant backends from the background prober.
+    With company_code, also returns that tenant's hourly history.
+    """
+    if user["role"] != UserRole.SUPERADMIN.value:
+        raise HTTPException(status_code=403, detail="Only SuperAdmin can view fleet health")
+    
+    summary = fleet_health.summary()
+    if company_code:
+        summary["tenants"] = [t for t in summary["tenants"] if t["code"] == company_code]
+        summary["history"] = await fleet_health.history(db, company_code, min(max(hours, 1), 24 * 7))
+    return summary
+
+@api_router.get("/superadmin/integrations/metrics")
+async def get_integration_metrics(user: dict = Depends(get_current_user)):
+    """SuperAdmin: Request, error, latency and circuit breaker stats per external provider"""
+    if user["role"] != UserRole.SUPERADMIN.value:
+        raise HTTPException(status_code=403, detail="Only SuperAdmin can view integration metrics")
+    
+    return {"providers": integration_http.metrics()}
+
 @api_router.get("/superadmin/template/status")
-async def get_template_status(user: dict = Depends(get_current_user)):
+async def get_template_status(refresh: bool = False, user: dict = Depends(get_current_user)):
     """SuperAdmin: Get master template status"""
     if user["role"] != UserRole.SUPERADMIN.value:
         raise HTTPException(status_code=403, detail="Only SuperAdmin can view template status")
@@ -1545,72 +1827,90 @@ async def get_template_status(user: dict = Depends(get_current_user)):
     # Get template status from database
     status = await db.system_settings.find_one({"key": "master_template"}, {"_id": 0})
     
+    # Template container states from the Portainer inventory snapshot
+    inventory = await portainer_inventory.get(refresh)
+    template_containers = {
+        c["names"][0].lstrip("/"): c.get("state")
+        for c in inventory.get("containers", [])
+        if c.get("names") and c["names"][0].lstrip("/").startswith("rentacar_template_")
+    }
+    
     if status:
         return {
             "status": status.get("status", "unknown"),
             "last_updated": status.get("last_updated"),
-            "updated_by": status.get("updated_by")
+            "updated_by": status.get("updated_by"),
+            "containers": template_containers,
+            "last_refreshed": inventory.get("last_refreshed")
         }
     
     return {
         "status": "not_initialized",
         "last_updated": None,
-        "updated_by": None
+        "updated_by": None,
+        "containers": template_containers,
+        "last_refreshed": inventory.get("last_refreshed")
     }
 
+@api_router.post("/superadmin/template/wheelhouse")
+async def build_template_wheelhouse(force: bool = False, user: dict = Depends(get_current_user)):
+    """SuperAdmin: Pre-build the offline wheelhouse used for tenant backend installs"""
+    if user["role"] != UserRole.SUPERADMIN.value:
+        raise HTTPException(status_code=403, detail="Only SuperAdmin can build the wheelhouse")
+    
+    result = await portainer_service.build_wheelhouse(force=force)
+    if not result.get("success"):
+        raise HTTPException(status_code=500, detail=f"Wheelhouse build failed: {result.get('error')}")
+    return result
+
 @api_router.get("/superadmin/portainer/stacks")
-async def get_portainer_stacks(user: dict = Depends(get_current_user)):
-    """SuperAdmin: Get all stacks from Portainer"""
+async def get_portainer_stacks(refresh: bool = False, user: dict = Depends(get_current_user)):
+    """SuperAdmin: Get all stacks from Portainer (inventory snapshot, ?refresh=true for live)"""
     if user["role"] != UserRole.SUPERADMIN.value:
         raise HTTPException(status_code=403, detail="Only SuperAdmin can view Portainer stacks")
     
-    stacks = await portainer_service.get_stacks()
-    return {"stacks": stacks}
+    inventory = await portainer_inventory.get(refresh)
+    return {
+        "stacks": inventory.get("stacks", []),
+        "last_refreshed": inventory.get("last_refreshed"),
+        "last_changed": inventory.get("last_changed")
+    }
 
 @api_router.get("/superadmin/portainer/containers")
-async def get_portainer_containers(user: dict = Depends(get_current_user)):
-    """SuperAdmin: Get all containers from Portainer"""
+async def get_portainer_containers(refresh: bool = False, user: dict = Depends(get_current_user)):
+    """SuperAdmin: Get all containers from Portainer (inventory snapshot, ?refresh=true for live)"""
     if user["role"] != UserRole.SUPERADMIN.value:
         raise HTTPException(status_code=403, detail="Only SuperAdmin can view Portainer containers")
     
-    containers = await portainer_service.get_containers()
-    return {"containers": containers}
+    inventory = await portainer_inventory.get(refresh)
+    return {
+        "containers": inventory.get("containers", []),
+        "last_refreshed": inventory.get("last_refreshed"),
+        "last_changed": inventory.get("last_changed"),
+        "changes": inventory.get("changes")
+    }
 
 @api_router.get("/superadmin/portainer/status")
-async def get_portainer_status(user: dict = Depends(get_current_user)):
+async def get_portainer_status(refresh: bool = False, user: dict = Depends(get_current_user)):
     """SuperAdmin: Check Portainer connection status"""
     if user["role"] != UserRole.SUPERADMIN.value:
         raise HTTPException(status_code=403, detail="Only SuperAdmin can check Portainer status")
     
     try:
-        # Direct test to Portainer API with SSL disabled
-        import httpx
-        import traceback
-        async with httpx.AsyncClient(verify=False, timeout=10.0, http2=False) as client:
-            url = f"{portainer_service.base_url}/api/system/status"
-            logger.info(f"Testing Portainer connection to: {url}")
-            response = await client.get(url, headers=portainer_service.headers)
-            
-            if response.status_code == 200:
-                stacks = await portainer_service.get_stacks()
-                return {
-                    "connected": True,
-                    "url": portainer_service.base_url,
-                    "endpoint_id": portainer_service.endpoint_id,
-                    "stack_count": len(stacks) if isinstance(stacks, list) else 0
-                }
-            else:
-                return {
-                    "connected": False,
-                    "url": portainer_service.base_url,
-                    "error": f"HTTP {response.status_code}: {response.text[:200]}"
-                }
-    except httpx.ConnectError as e:
-        logger.error(f"Portainer connection error: {traceback.format_exc()}")
+        inventory = await portainer_inventory.get(refresh)
+        if inventory.get("connected"):
+            return {
+                "connected": True,
+                "url": portainer_service.base_url,
+                "endpoint_id": portainer_service.endpoint_id,
+                "stack_count": len(inventory.get("stacks", [])),
+                "last_refreshed": inventory.get("last_refreshed")
+            }
         return {
             "connected": False,
             "url": portainer_service.base_url,
-            "error": f"Bağlantı hatası: {str(e)}"
+            "error": f"Bağlantı hatası: {inventory.get('error')}",
+            "last_refreshed": inventory.get("last_refreshed")
         }
     except Exception as e:
         import traceback
@@ -1688,12 +1988,181 @@ async def deploy_superadmin_stack(user: dict = Depends(get_current_user)):
         raise HTTPException(status_code=500, detail=f"Deployment failed: {result.get('error')}")
 
 @api_router.get("/superadmin/traefik/status")
-async def get_traefik_status(user: dict = Depends(get_current_user)):
+async def get_traefik_status(refresh: bool = False, user: dict = Depends(get_current_user)):
     """SuperAdmin: Check Traefik installation status"""
     if user["role"] != UserRole.SUPERADMIN.value:
         raise HTTPException(status_code=403, detail="Only SuperAdmin can check Traefik status")
     
-    return await portainer_service.check_traefik_status()
+    inventory = await portainer_inventory.get(refresh)
+    traefik_status = await portainer_service.check_traefik_status(stacks=inventory.get("stacks", []))
+    traefik_status["last_refreshed"] = inventory.get("last_refreshed")
+    return traefik_status
+
+class BackendModeRequest(BaseModel):
+    mode: str  # 'shared' | 'dedicated'
+
+@api_router.post("/superadmin/shared-frontend/deploy")
+async def deploy_shared_frontend(user: dict = Depends(get_current_user)):
+    """SuperAdmin: Deploy (or refresh the build of) the shared static frontend"""
+    if user["role"] != UserRole.SUPERADMIN.value:
+        raise HTTPException(status_code=403, detail="Only SuperAdmin can deploy the shared frontend")
+    
+    result = await portainer_service.deploy_shared_frontend(await get_shared_frontend_tenants())
+    if not result.get("success"):
+        raise HTTPException(status_code=500, detail=f"Shared frontend deployment failed: {result}")
+    portainer_inventory.mark_stale()
+    return result
+
+@api_router.put("/superadmin/companies/{company_id}/frontend-mode")
+async def set_company_frontend_mode(company_id: str, data: BackendModeRequest, user: dict = Depends(get_current_user)):
+    """
+    SuperAdmin: Serve a tenant's web panel from the shared static frontend or
+    from its own Nginx container
+    """
+    if user["role"] != UserRole.SUPERADMIN.value:
+        raise HTTPException(status_code=403, detail="Only SuperAdmin can change frontend mode")
+    if data.mode not in ("shared", "dedicated"):
+        raise HTTPException(status_code=400, detail="mode must be 'shared' or 'dedicated'")
+    if TRAEFIK_ROUTING_MODE != "file":
+        raise HTTPException(status_code=400, detail="Shared frontend requires TRAEFIK_ROUTING_MODE=file")
+    
+    company = await db.companies.find_one({"id": company_id}, {"_id": 0})
+    if not company:
+        raise HTTPException(status_code=404, detail="Company not found")
+    if not company.get("portainer_stack_id") or not company.get("domain"):
+        raise HTTPException(status_code=400, detail="Company has no provisioned stack with a domain")
+    
+    safe_code = get_safe_code(company["code"])
+    frontend_container = f"{safe_code}_frontend"
+    
+    if data.mode == "dedicated" and await portainer_service.get_container_id(frontend_container) is None:
+        raise HTTPException(status_code=400, detail="Tenant stack has no frontend container - redeploy the stack first")
+    
+    await db.companies.update_one(
+        {"id": company_id},
+        {"$set": {"frontend_mode": data.mode, "updated_at": datetime.now(timezone.utc).isoformat()}}
+    )
+    
+    if data.mode == "dedicated":
+        await portainer_service.start_container(frontend_container)
+        await portainer_service.wait_for_container_state(frontend_container, "running", timeout=30)
+    
+    hosts_result = await sync_shared_frontend_hosts()
+    if data.mode == "shared" and not hosts_result.get("success"):
+        await db.companies.update_one({"id": company_id}, {"$set": {"frontend_mode": company.get("frontend_mode", "dedicated")}})
+        raise HTTPException(status_code=500, detail=f"Shared frontend host map update failed: {hosts_result.get('error')}")
+    
+    routing_result = await refresh_traefik_routing(wait_for=company["code"])
+    
+    if data.mode == "shared" and routing_result.get("success"):
+        await portainer_service.stop_container(frontend_container)
+    
+    portainer_inventory.mark_stale()
+    return {
+        "message": f"Frontend mode set to {data.mode}",
+        "frontend_mode": data.mode,
+        "host_map": hosts_result,
+        "routing": routing_result
+    }
+
+@api_router.post("/superadmin/shared-backend/deploy")
+async def deploy_shared_backend(user: dict = Depends(get_current_user)):
+    """SuperAdmin: Deploy (or refresh the code of) the multi-tenant backend"""
+    if user["role"] != UserRole.SUPERADMIN.value:
+        raise HTTPException(status_code=403, detail="Only SuperAdmin can deploy the shared backend")
+    
+    result = await portainer_service.deploy_shared_backend()
+    if not result.get("success"):
+        raise HTTPException(status_code=500, detail=f"Shared backend deployment failed: {result}")
+    portainer_inventory.mark_stale()
+    result["tenant_map"] = await sync_shared_backend_tenants()
+    return result
+
+@api_router.put("/superadmin/companies/{company_id}/backend-mode")
+async def set_company_backend_mode(company_id: str, data: BackendModeRequest, user: dict = Depends(get_current_user)):
+    """
+    SuperAdmin: Move a tenant's API onto the shared multi-tenant backend or back
+    to its own container. Routing switches via the Traefik file provider.
+    """
+    if user["role"] != UserRole.SUPERADMIN.value:
+        raise HTTPException(status_code=403, detail="Only SuperAdmin can change backend mode")
+    if data.mode not in ("shared", "dedicated"):
+        raise HTTPException(status_code=400, detail="mode must be 'shared' or 'dedicated'")
+    if TRAEFIK_ROUTING_MODE != "file":
+        raise HTTPException(status_code=400, detail="Shared backend requires TRAEFIK_ROUTING_MODE=file")
+    
+    company = await db.companies.find_one({"id": company_id}, {"_id": 0})
+    if not company:
+        raise HTTPException(status_code=404, detail="Company not found")
+    if not company.get("portainer_stack_id") or not company.get("domain"):
+        raise HTTPException(status_code=400, detail="Company has no provisioned stack with a domain")
+    
+    safe_code = get_safe_code(company["code"])
+    backend_container = f"{safe_code}_backend"
+    
+    await db.companies.update_one(
+        {"id": company_id},
+        {"$set": {"backend_mode": data.mode, "updated_at": datetime.now(timezone.utc).isoformat()}}
+    )
+    
+    if data.mode == "dedicated":
+        # Bring the tenant's own backend back before routing to it
+        await portainer_service.start_container(backend_container)
+        await portainer_service.wait_for_container_state(backend_container, "running", timeout=30)
+    
+    map_result = await sync_shared_backend_tenants()
+    if data.mode == "shared" and not map_result.get("success"):
+        await db.companies.update_one({"id": company_id}, {"$set": {"backend_mode": company.get("backend_mode", "dedicated")}})
+        raise HTTPException(status_code=500, detail=f"Shared backend tenant map update failed: {map_result.get('error')}")
+    
+    routing_result = await refresh_traefik_routing(wait_for=company["code"])
+    if not routing_result.get("success"):
+        # Put the previous mode back so the stored state matches the live routes
+        previous_mode = company.get("backend_mode", "dedicated")
+        await db.companies.update_one({"id": company_id}, {"$set": {"backend_mode": previous_mode}})
+        await sync_shared_backend_tenants()
+        if data.mode == "dedicated" and previous_mode == "shared":
+            await portainer_service.stop_container(backend_container)
+        raise HTTPException(status_code=500, detail=f"Traefik routing update failed: {routing_result.get('error')}")
+    
+    if data.mode == "shared":
+        # The dedicated container is idle now - free its memory
+        await portainer_service.stop_container(backend_container)
+    
+    portainer_inventory.mark_stale()
+    return {
+        "message": f"Backend mode set to {data.mode}",
+        "backend_mode": data.mode,
+        "tenant_map": map_result,
+        "routing": routing_result
+    }
+
+class SharedMongoDeployRequest(BaseModel):
+    root_username: str = "root"
+    root_password: str
+
+@api_router.post("/superadmin/shared-mongo/deploy")
+async def deploy_shared_mongo(data: SharedMongoDeployRequest, user: dict = Depends(get_current_user)):
+    """SuperAdmin: Deploy the shared MongoDB instance used by shared-mode tenants"""
+    if user["role"] != UserRole.SUPERADMIN.value:
+        raise HTTPException(status_code=403, detail="Only SuperAdmin can deploy shared MongoDB")
+    
+    result = await portainer_service.deploy_shared_mongo(data.root_username, data.root_password)
+    if not result.get("success"):
+        raise HTTPException(status_code=500, detail=f"Shared MongoDB deployment failed: {result.get('error')}")
+    portainer_inventory.mark_stale()
+    return result
+
+@api_router.post("/superadmin/traefik/routes/sync")
+async def sync_traefik_routes(user: dict = Depends(get_current_user)):
+    """SuperAdmin: Regenerate Traefik tenant routes from the companies collection"""
+    if user["role"] != UserRole.SUPERADMIN.value:
+        raise HTTPException(status_code=403, detail="Only SuperAdmin can sync Traefik routes")
+    
+    result = await refresh_traefik_routing()
+    if not result.get("success"):
+        raise HTTPException(status_code=500, detail=f"Traefik route sync failed: {result.get('error')}")
+    return result
 
 @api_router.post("/superadmin/traefik/deploy")
 async def deploy_traefik(user: dict = Depends(get_current_user), admin_email: str = "admin@rentafleet.com"):
@@ -1763,6 +2232,7 @@ async def deploy_code_to_template(user: dict = Depends(get_current_user)):
         
         # Upload to template frontend container
         build_dir = f"{template_frontend_dir}/build"  # Template build, NOT SuperAdmin
+        await asyncio.to_thread(precompress_static_assets, build_dir)
         tar_buffer = io.BytesIO()
         with tarfile.open(fileobj=tar_buffer, mode='w') as tar:
             for root, dirs, files in os.walk(build_dir):
@@ -2091,6 +2561,8 @@ async def deploy_frontend_to_kvm(background_tasks: BackgroundTasks, user: dict =
                 "details": result.stderr
             }
         
+        await asyncio.to_thread(precompress_static_assets, build_dir)
+        
         # Step 2: Create tar archive of build folder
         tar_buffer = io.BytesIO()
         with tarfile.open(fileobj=tar_buffer, mode='w') as tar:
@@ -2322,8 +2794,6 @@ async def deploy_local_build_to_tenant(request: DeployBuildRequest, user: dict =
     if user["role"] != UserRole.SUPERADMIN.value:
         raise HTTPException(status_code=403, detail="Only SuperAdmin can deploy builds")
     
-    import tarfile
-    import io as std_io
     import os
     
     build_path = "/app/frontend/build"
@@ -2353,20 +2823,10 @@ async def deploy_local_build_to_tenant(request: DeployBuildRequest, user: dict =
         logger.info(f"[DEPLOY-BUILD] Clean result: {clean_result}")
         
         logger.info(f"[DEPLOY-BUILD] Creating tar archive from {build_path}...")
+        await asyncio.to_thread(precompress_static_assets, build_path)
         
-        # Create tar archive of build directory
-        tar_buffer = std_io.BytesIO()
-        with tarfile.open(fileobj=tar_buffer, mode='w') as tar:
-            for root, dirs, files in os.walk(build_path):
-                for file in files:
-                    file_path = os.path.join(root, file)
-                    arcname = os.path.relpath(file_path, build_path)
-                    # Skip downloads folder
-                    if arcname.startswith('downloads/'):
-                        continue
-                    tar.add(file_path, arcname=arcname)
-        
-        tar_data = tar_buffer.getvalue()
+        # Compressed once per build and reused for every tenant (downloads folder skipped)
+        tar_data = await asyncio.to_thread(build_directory_archive, build_path, ('downloads/',))
         logger.info(f"[DEPLOY-BUILD] Tar archive size: {len(tar_data)} bytes")
         
         # Upload to container
@@ -2422,7 +2882,7 @@ async def deploy_code_to_tenant(company_id: str, user: dict = Depends(get_curren
         raise HTTPException(status_code=400, detail="Company stack not provisioned yet")
     
     company_code = company["code"]
-    safe_code = company_code.replace('-', '').replace('_', '')
+    safe_code = get_safe_code(company_code)
     domain = company.get("domain")
     ports = company.get("ports", {})
     
@@ -2432,13 +2892,13 @@ async def deploy_code_to_tenant(company_id: str, user: dict = Depends(get_curren
         # Step 1: Deploy Backend
         logger.info(f"[DEPLOY-CODE] Deploying backend for {company['name']}...")
         backend_container = f"{safe_code}_backend"
-        mongo_service = f"{safe_code}_mongodb"
+        mongo_mode = company.get("mongo_mode") or "dedicated"
         db_name = f"{safe_code}_db"
         
         backend_result = await deploy_company_backend(
             company_code=company_code,
             container_name=backend_container,
-            mongo_service_name=mongo_service,
+            mongo_url=get_tenant_mongo_url(company_code, mongo_mode),
             db_name=db_name
         )
         results["backend"] = backend_result
@@ -2461,8 +2921,7 @@ async def deploy_code_to_tenant(company_id: str, user: dict = Depends(get_curren
         
         # Step 3: Setup Database
         logger.info(f"[DEPLOY-CODE] Setting up database for {company['name']}...")
-        mongo_port = ports.get("mongodb", 12000)
-        db_result = await setup_company_database(company, mongo_port, db_name)
+        db_result = await setup_company_database(company, mongo_mode)
         results["database"] = db_result
         
         # Update company status
@@ -2953,8 +3412,12 @@ async def get_dashboard_stats(user: dict = Depends(get_current_user)):
 
 # ============== GPS / ARVENTO ROUTES ==============
 @api_router.get("/gps/vehicles")
-async def get_vehicle_locations(user: dict = Depends(get_current_user)):
-    """Get vehicle GPS locations - Arvento integration or mock data"""
+async def get_vehicle_locations(response: Response, user: dict = Depends(get_current_user)):
+    """
+    Get vehicle GPS locations - Arvento integration or mock data.
+    Arvento positions come from the background poller's snapshot; its age is
+    returned in the X-GPS-Snapshot-Age header (seconds).
+    """
     # Get company GPS settings
     company_id = user.get("company_id")
     gps_settings = await db.integration_settings.find_one(
@@ -2962,17 +3425,20 @@ async def get_vehicle_locations(user: dict = Depends(get_current_user)):
         {"_id": 0}
     )
     
-    # Create Arvento service with company settings
-    if gps_settings and gps_settings.get("is_active"):
-        arvento = ArventoService(
-            api_key=gps_settings.get("api_key"),
-            company_code=gps_settings.get("company_code"),
-            api_url=gps_settings.get("api_url")
-        )
-    else:
-        arvento = ArventoService()  # Will use mock data
+    if gps_settings and gps_settings.get("is_active") and gps_settings.get("api_key") and gps_settings.get("company_code"):
+        snapshot = await gps_position_cache.get(db, company_id)
+        if snapshot is None or not gps_position_cache.has_poller(company_id):
+            await gps_position_cache.ensure_poller(db, company_id)
+            snapshot = snapshot or await gps_position_cache.prime(db, company_id)
+        
+        if snapshot:
+            response.headers["X-GPS-Snapshot-Age"] = str(snapshot["age_seconds"]) if snapshot["age_seconds"] is not None else ""
+            response.headers["X-GPS-Snapshot-At"] = snapshot.get("fetched_at") or ""
+            response.headers["X-GPS-Snapshot-Stale"] = "true" if snapshot["stale"] else "false"
+            return snapshot["vehicles"]
+        return []
     
-    result = await arvento.get_all_vehicles()
+    result = await ArventoService().get_all_vehicles()  # Will use mock data
     
     # If mock, enhance with actual vehicle data
     if result.get("source") == "mock":
@@ -3001,24 +3467,193 @@ async def get_vehicle_locations(user: dict = Depends(get_current_user)):
     
     return result.get("vehicles", [])
 
+GPS_STREAM_MIN_INTERVAL = float(os.environ.get('GPS_STREAM_MIN_INTERVAL', '2'))
+GPS_STREAM_HEARTBEAT = float(os.environ.get('GPS_STREAM_HEARTBEAT', '15'))
+
+@api_router.get("/gps/stream")
+async def stream_vehicle_locations(request: Request, min_interval: float = GPS_STREAM_MIN_INTERVAL, user: dict = Depends(get_stream_user)):
+    """
+    Live vehicle positions as Server-Sent Events, fed from the Arvento snapshot.
+    
+    - event: snapshot - all vehicles, sent once on connect
+    - event: delta    - only vehicles whose position/state changed, plus removed ids
+    - event: heartbeat - snapshot age when nothing changed for GPS_STREAM_HEARTBEAT seconds
+    Frames are sent at most once per min_interval seconds (never below GPS_STREAM_MIN_INTERVAL).
+    EventSource clients pass a token from POST /auth/stream-token as ?token=.
+    """
+    company_id = user.get("company_id")
+    if not gps_position_cache.has_poller(company_id):
+        await gps_position_cache.ensure_poller(db, company_id)
+    if not gps_position_cache.has_poller(company_id):
+        raise HTTPException(status_code=404, detail="GPS entegrasyonu aktif değil")
+    
+    throttle = max(min_interval, GPS_STREAM_MIN_INTERVAL)
+    
+    def frame(event: str, data: dict) -> str:
+        return f"event: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+    
+    async def events():
+        snapshot = await gps_position_cache.get(db, company_id) or await gps_position_cache.prime(db, company_id)
+        sent = {}
+        version = 0
+        if snapshot:
+            diff_positions(sent, snapshot["vehicles"])
+            version = snapshot.get("version", 0)
+            yield frame("snapshot", {
+                "version": version,
+                "vehicles": snapshot["vehicles"],
+                "age_seconds": snapshot["age_seconds"],
+                "stale": snapshot["stale"]
+            })
+        last_frame = time.monotonic()
+        
+        while not await request.is_disconnected():
+            updated = await gps_position_cache.wait_for_update(company_id, version, GPS_STREAM_HEARTBEAT)
+            snapshot = await gps_position_cache.get(db, company_id)
+            if not updated or snapshot is None:
+                yield frame("heartbeat", {"version": version, "age_seconds": snapshot["age_seconds"] if snapshot else None})
+                last_frame = time.monotonic()
+                continue
+            
+            # Server-side throttle: coalesce snapshots arriving faster than the frame rate
+            wait = throttle - (time.monotonic() - last_frame)
+            if wait > 0:
+                await asyncio.sleep(wait)
+                snapshot = await gps_position_cache.get(db, company_id)
+                if snapshot is None:
+                    continue
+            
+            version = snapshot.get("version", 0)
+            delta = diff_positions(sent, snapshot["vehicles"])
+            if delta["changed"] or delta["removed"]:
+                yield frame("delta", {
+                    "version": version,
+                    "changed": delta["changed"],
+                    "removed": delta["removed"],
+                    "age_seconds": snapshot["age_seconds"]
+                })
+                last_frame = time.monotonic()
+    
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 @api_router.get("/gps/vehicle/{vehicle_id}/history")
 async def get_vehicle_history(
     vehicle_id: str,
     start_date: str = None,
     end_date: str = None,
+    zoom: Optional[int] = None,
     user: dict = Depends(get_current_user)
 ):
-    """Get vehicle route history"""
-    vehicle = await db.vehicles.find_one({"id": vehicle_id})
+    """
+    Get vehicle route history from the stored Arvento positions.
+    Dates are ISO 8601 (default: last 24 hours); zoom is the map zoom level the
+    route is simplified for (omit for the full track, capped at GPS_HISTORY_MAX_POINTS).
+    """
+    vehicle = await db.vehicles.find_one({"id": vehicle_id}, {"_id": 0})
     if not vehicle:
         raise HTTPException(status_code=404, detail="Vehicle not found")
+    if user["role"] != UserRole.SUPERADMIN.value and vehicle.get("company_id") != user.get("company_id"):
+        raise HTTPException(status_code=404, detail="Vehicle not found")
     
-    # Mock history data for now
-    return {
+    try:
+        end = datetime.fromisoformat(end_date.replace("Z", "+00:00")) if end_date else datetime.now(timezone.utc)
+        start = datetime.fromisoformat(start_date.replace("Z", "+00:00")) if start_date else end - timedelta(hours=24)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Geçersiz tarih formatı (ISO 8601 bekleniyor)")
+    if end.tzinfo is None:
+        end = end.replace(tzinfo=timezone.utc)
+    if start.tzinfo is None:
+        start = start.replace(tzinfo=timezone.utc)
+    if start >= end:
+        raise HTTPException(status_code=400, detail="start_date must be before end_date")
+    
+    route = await gps_history.get_route(db, vehicle.get("company_id"), vehicle.get("plate"), start, end, zoom)
+    
+    result = {
         "vehicle_id": vehicle_id,
         "plate": vehicle.get("plate"),
-        "history": [],
-        "message": "Rota gecmisi icin Arvento API yapilandirilmali"
+        "start_date": start.isoformat(),
+        "end_date": end.isoformat(),
+        "zoom": zoom,
+        "history": route["points"],
+        "raw_count": route["raw_count"],
+        "count": route["count"],
+        "tolerance_m": route["tolerance_m"]
+    }
+    if not route["raw_count"]:
+        result["message"] = "Bu aralıkta kayıtlı konum yok (rota geçmişi Arvento entegrasyonu aktifken kaydedilir)"
+    return result
+
+class GeofenceCheckRequest(BaseModel):
+    # GeoJSON Polygon/MultiPolygon ({"type", "coordinates"}) or {"type": "Circle", "center": [lng, lat], "radius_km": r}
+    geometry: dict
+    statuses: Optional[List[str]] = None  # e.g. ["rented"]; default: all vehicles
+    company_id: Optional[str] = None  # SuperAdmin only
+
+def _gps_company_id(user: dict, company_id: Optional[str] = None) -> str:
+    if user["role"] == UserRole.SUPERADMIN.value and company_id:
+        return company_id
+    if not user.get("company_id"):
+        raise HTTPException(status_code=400, detail="company_id is required")
+    return user["company_id"]
+
+@api_router.get("/gps/nearby")
+async def get_nearby_vehicles(
+    lat: float,
+    lng: float,
+    radius_km: float = 5.0,
+    status: Optional[str] = VehicleStatus.AVAILABLE.value,
+    limit: int = 10,
+    company_id: Optional[str] = None,
+    user: dict = Depends(get_current_user)
+):
+    """
+    Vehicles closest to a point (e.g. a pickup location), by last-known GPS position.
+    status filters on the vehicle's current status (comma separated; empty for all).
+    """
+    if not (-90 <= lat <= 90 and -180 <= lng <= 180):
+        raise HTTPException(status_code=400, detail="Invalid coordinates")
+    statuses = [s for s in (status or "").split(",") if s] or None
+    vehicles = await vehicle_position_index.nearby(
+        db, _gps_company_id(user, company_id), lat, lng,
+        radius_km=min(max(radius_km, 0.1), 500),
+        statuses=statuses,
+        limit=min(max(limit, 1), 100)
+    )
+    return {"center": {"lat": lat, "lng": lng}, "radius_km": radius_km, "count": len(vehicles), "vehicles": vehicles}
+
+@api_router.post("/gps/geofence/check")
+async def check_geofence(data: GeofenceCheckRequest, user: dict = Depends(get_current_user)):
+    """
+    Which vehicles are inside / outside a region, by last-known GPS position
+    (e.g. rented vehicles that have left the allowed area).
+    """
+    def is_number(value) -> bool:
+        return isinstance(value, (int, float)) and not isinstance(value, bool) and math.isfinite(value)
+    
+    geometry = data.geometry
+    if geometry.get("type") == "Circle":
+        center, radius_km = geometry.get("center"), geometry.get("radius_km")
+        if not isinstance(center, list) or len(center) != 2 or not all(is_number(v) for v in center) \
+                or not -180 <= center[0] <= 180 or not -90 <= center[1] <= 90:
+            raise HTTPException(status_code=400, detail="Circle needs center [lng, lat] as numbers")
+        if not is_number(radius_km) or radius_km <= 0:
+            raise HTTPException(status_code=400, detail="radius_km must be a number greater than 0")
+    elif geometry.get("type") not in ("Polygon", "MultiPolygon") or not geometry.get("coordinates"):
+        raise HTTPException(status_code=400, detail="geometry must be a GeoJSON Polygon/MultiPolygon or a Circle")
+    
+    try:
+        result = await vehicle_position_index.geofence(db, _gps_company_id(user, data.company_id), geometry, data.statuses)
+    except OperationFailure as e:
+        raise HTTPException(status_code=400, detail=f"Invalid geometry: {e}")
+    return {
+        "inside_count": len(result["inside"]),
+        "outside_count": len(result["outside"]),
+        **result
     }
 
 @api_router.get("/gps/settings")
@@ -3068,6 +3703,11 @@ async def update_gps_settings(
         upsert=True
     )
     
+    # Start, restart or stop the company's position poller right away
+    await gps_position_cache.ensure_poller(db, company_id)
+    if not settings_doc["is_active"]:
+        await vehicle_position_index.forget(db, company_id)
+    
     return {"success": True, "message": "GPS ayarlari guncellendi"}
 
 @api_router.post("/gps/test-connection")
@@ -3114,7 +3754,7 @@ async def add_hgs_tag(tag_data: dict, user: dict = Depends(get_current_user)):
         raise HTTPException(status_code=403, detail="Insufficient permissions")
     
     hgs_service.set_db(db)
-    result = await hgs_service.add_hgs_tag(tag_data.get("vehicle_id"), tag_data)
+    result = await hgs_service.add_hgs_tag(tag_data.get("vehicle_id"), tag_data, user.get("company_id"))
     
     if not result.get("success"):
         raise HTTPException(status_code=400, detail=result.get("error"))
@@ -3134,15 +3774,28 @@ async def update_hgs_balance(
     balance_data: dict,
     user: dict = Depends(get_current_user)
 ):
-    """Update HGS tag balance"""
+    """Update HGS tag balance (balance: set the read balance, amount: top up)"""
+    field = "amount" if balance_data.get("amount") is not None else "balance"
+    try:
+        value = float(balance_data.get(field, 0))
+    except (TypeError, ValueError):
+        raise HTTPException(status_code=400, detail=f"{field} must be a number")
+    if not math.isfinite(value) or (field == "amount" and value <= 0):
+        raise HTTPException(status_code=400, detail="amount must be greater than 0" if field == "amount" else "balance must be a number")
+    
     hgs_service.set_db(db)
-    result = await hgs_service.update_balance(
-        tag_id,
-        balance_data.get("balance", 0),
-        balance_data.get("note", "")
-    )
+    if field == "amount":
+        result = await hgs_service.top_up(tag_id, value, balance_data.get("note", ""))
+    else:
+        result = await hgs_service.update_balance(tag_id, value, balance_data.get("note", ""))
     return result
 
+@api_router.get("/hgs/tags/{tag_id}/ledger")
+async def get_hgs_ledger(tag_id: str, limit: int = 100, user: dict = Depends(get_current_user)):
+    """Get HGS balance movements of a tag"""
+    hgs_service.set_db(db)
+    return await hgs_service.get_ledger(tag_id, min(limit, 1000), user.get("company_id"))
+
 @api_router.post("/hgs/tags/{tag_id}/passages")
 async def add_hgs_passage(
     tag_id: str,
@@ -3154,6 +3807,35 @@ async def add_hgs_passage(
     result = await hgs_service.add_passage(tag_id, passage_data)
     return result
 
+HGS_IMPORT_MAX_BYTES = 20 * 1024 * 1024
+
+@api_router.post("/hgs/passages/import")
+async def import_hgs_passages(
+    file: UploadFile = File(...),
+    encoding: str = Form("utf-8-sig"),
+    user: dict = Depends(get_current_user)
+):
+    """
+    Import HGS passages from a CSV toll statement (PTT / bank export).
+    Re-uploading the same statement does not debit passages twice.
+    """
+    if user["role"] not in [UserRole.SUPERADMIN.value, UserRole.FIRMA_ADMIN.value, UserRole.OPERASYON.value]:
+        raise HTTPException(status_code=403, detail="Insufficient permissions")
+    
+    file.file.seek(0, 2)
+    if file.file.tell() > HGS_IMPORT_MAX_BYTES:
+        raise HTTPException(status_code=400, detail="Dosya boyutu 20MB sınırını aşıyor")
+    file.file.seek(0)
+    
+    hgs_service.set_db(db)
+    try:
+        result = await hgs_service.import_passages(user.get("company_id"), iter_statement_rows(file.file, encoding))
+    except (StatementError, LookupError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    logger.info(f"[HGS] Import {result.get('import_id')}: {result.get('inserted')} passages, {result.get('duplicates')} duplicates, {result.get('unmatched')} unmatched")
+    return result
+
 @api_router.get("/hgs/passages")
 async def get_hgs_passages(
     tag_id: str = None,
@@ -3165,7 +3847,7 @@ async def get_hgs_passages(
 ):
     """Get HGS passage records"""
     hgs_service.set_db(db)
-    passages = await hgs_service.get_passages(tag_id, vehicle_id, start_date, end_date, limit)
+    passages = await hgs_service.get_passages(tag_id, vehicle_id, start_date, end_date, limit, user.get("company_id"))
     return passages
 
 @api_router.delete("/hgs/tags/{tag_id}")
@@ -3237,39 +3919,8 @@ async def create_kabis_notification(
     rental_data: dict,
     user: dict = Depends(get_current_user)
 ):
-    """Create KABIS rental notification"""
-    company_id = user.get("company_id")
-    
-    # Get company KABIS settings
-    settings = await db.integration_settings.find_one(
-        {"company_id": company_id, "type": "kabis"}
-    )
-    
-    if settings and settings.get("is_active"):
-        kabis = KabisService(
-            api_key=settings.get("api_key"),
-            firma_kodu=settings.get("firma_kodu"),
-            api_url=settings.get("api_url")
-        )
-    else:
-        kabis = KabisService()
-    
-    result = await kabis.create_rental_notification(rental_data)
-    
-    # Save notification to DB
-    if result.get("success"):
-        notification_doc = {
-            "id": result.get("notification_id"),
-            "company_id": company_id,
-            "rental_data": rental_data,
-            "status": result.get("status"),
-            "source": result.get("source"),
-            "created_at": result.get("created_at"),
-            "created_by": user.get("id")
-        }
-        await db.kabis_notifications.insert_one(notification_doc)
-    
-    return result
+    """Queue KABIS rental notification (submitted in the background by kabis_outbox)"""
+    return await kabis_outbox.enqueue(db, user.get("company_id"), rental_data, user.get("id"))
 
 @api_router.get("/kabis/notifications")
 async def get_kabis_notifications(
@@ -3295,25 +3946,57 @@ async def cancel_kabis_notification(
     """Cancel KABIS notification"""
     company_id = user.get("company_id")
     
-    settings = await db.integration_settings.find_one(
-        {"company_id": company_id, "type": "kabis"}
+    notification = await db.kabis_notifications.find_one(
+        {"company_id": company_id, "$or": [{"id": notification_id}, {"bildirim_no": notification_id}]},
+        {"_id": 0}
     )
+    if not notification:
+        raise HTTPException(status_code=404, detail="Bildirim bulunamadi")
     
-    kabis = KabisService(
-        api_key=settings.get("api_key") if settings else None,
-        firma_kodu=settings.get("firma_kodu") if settings else None
-    )
+    if notification.get("status") == "submitting":
+        raise HTTPException(status_code=409, detail="Bildirim su anda KABIS'e gonderiliyor, birazdan tekrar deneyin")
     
-    result = await kabis.cancel_notification(notification_id, reason)
+    if notification.get("status") in ["pending", "failed", "pending_api"]:
+        # Never reached KABIS - cancel the queued record unless the dispatcher claimed it meanwhile
+        update = await db.kabis_notifications.update_one(
+            {"id": notification["id"], "status": {"$in": ["pending", "failed", "pending_api"]}},
+            {"$set": {"status": "cancelled", "cancel_reason": reason}}
+        )
+        if update.modified_count == 0:
+            raise HTTPException(status_code=409, detail="Bildirim su anda KABIS'e gonderiliyor, birazdan tekrar deneyin")
+        return {"success": True, "notification_id": notification["id"], "status": "cancelled_local"}
+    else:
+        settings = await db.integration_settings.find_one(
+            {"company_id": company_id, "type": "kabis"}
+        )
+        
+        kabis = KabisService(
+            api_key=settings.get("api_key") if settings else None,
+            firma_kodu=settings.get("firma_kodu") if settings else None,
+            api_url=settings.get("api_url") if settings else None
+        )
+        
+        result = await kabis.cancel_notification(notification.get("bildirim_no") or notification["id"], reason)
     
     if result.get("success"):
         await db.kabis_notifications.update_one(
-            {"id": notification_id},
+            {"id": notification["id"], "status": {"$ne": "submitting"}},
             {"$set": {"status": "cancelled", "cancel_reason": reason}}
         )
     
     return result
 
+@api_router.post("/kabis/notifications/{notification_id}/retry")
+async def retry_kabis_notification(
+    notification_id: str,
+    user: dict = Depends(get_current_user)
+):
+    """Re-queue a KABIS notification that failed permanently"""
+    if not await kabis_outbox.retry(db, user.get("company_id"), notification_id):
+        raise HTTPException(status_code=404, detail="Tekrar denenebilecek basarisiz bildirim bulunamadi")
+    
+    return {"success": True, "message": "Bildirim tekrar kuyruğa alındı"}
+
 # ============== WHATSAPP ROUTES ==============
 @api_router.get("/whatsapp/link")
 async def get_whatsapp_link(
@@ -3884,6 +4567,27 @@ async def get_all_subscriptions(user: dict = Depends(get_current_user)):
     
     return companies
 
+async def apply_plan_resources(company: dict, plan: str) -> Optional[dict]:
+    """
+    Re-apply container resource limits after a plan change.
+    Only full (domain) stacks carry a resource profile.
+    """
+    if not company.get("portainer_stack_id") or not company.get("domain"):
+        return None
+    if company.get("resource_plan") == plan:
+        return None
+    
+    result = await portainer_service.apply_resource_profile(
+        company_code=company["code"],
+        plan=plan,
+        previous_plan=company.get("resource_plan"),
+        mongo_mode=company.get("mongo_mode") or "dedicated",
+        frontend_mode=company.get("frontend_mode") or "dedicated"
+    )
+    if result.get("success"):
+        await db.companies.update_one({"id": company["id"]}, {"$set": {"resource_plan": plan}})
+    return result
+
 @api_router.post("/superadmin/subscriptions/{company_id}/activate")
 async def activate_subscription(
     company_id: str,
@@ -3948,11 +4652,14 @@ async def activate_subscription(
     
     logger.info(f"Subscription activated for {company['name']}: {plan} ({billing_cycle})")
     
+    resources_result = await apply_plan_resources(company, plan)
+    
     return {
         "success": True,
         "message": f"Subscription activated: {plan_details['name']} ({billing_cycle})",
         "subscription_end": end_date.isoformat(),
-        "amount": amount
+        "amount": amount,
+        "resources": resources_result
     }
 
 @api_router.post("/superadmin/subscriptions/{company_id}/extend")
@@ -4199,6 +4906,7 @@ async def get_finance_summary(user: dict = Depends(get_current_user)):
 # ============== IYZICO PAYMENT INTEGRATION ==============
 
 from services.iyzico_service import iyzico_service
+from services.iyzico_events import iyzico_events, webhook_idempotency_key
 
 class IyzicoCheckoutRequest(BaseModel):
     company_id: str
@@ -4330,183 +5038,268 @@ async def initialize_iyzico_checkout(
             detail=result.get("errorMessage", "Failed to initialize checkout")
         )
 
-@api_router.post("/payment/iyzico/callback")
-async def iyzico_payment_callback(request: Request):
-    """Handle iyzico payment callback"""
-    try:
-        # Get token from form data or JSON
-        content_type = request.headers.get("content-type", "")
-        
-        if "application/x-www-form-urlencoded" in content_type:
-            form_data = await request.form()
-            token = form_data.get("token")
-        else:
-            body = await request.json()
-            token = body.get("token")
-        
-        if not token:
-            raise HTTPException(status_code=400, detail="Token is required")
-        
-        # Retrieve checkout result
-        result = await iyzico_service.retrieve_checkout_result(token)
+IYZICO_CALLBACK_WAIT = float(os.environ.get("IYZICO_CALLBACK_WAIT", "5"))
+
+async def _record_iyzico_payment(payment_record: dict) -> dict:
+    """
+    Insert a subscription payment once per iyzico payment_id (applied=False until
+    the company update went through). Returns the stored record.
+    """
+    return await db.subscription_payments.find_one_and_update(
+        {"payment_id": payment_record["payment_id"]},
+        {"$setOnInsert": {**payment_record, "applied": False}},
+        upsert=True,
+        projection={"_id": 0},
+        return_document=ReturnDocument.AFTER
+    )
+
+async def _apply_iyzico_payment(company_id: str, payment_id: str, update: dict) -> bool:
+    """
+    Apply a payment's company update at most once (guarded by last_iyzico_payment_id),
+    then mark the payment applied. Safe to call again after a partial failure.
+    """
+    result = await db.companies.update_one(
+        {"id": company_id, "last_iyzico_payment_id": {"$ne": payment_id}},
+        {"$set": {**update, "last_iyzico_payment_id": payment_id}}
+    )
+    await db.subscription_payments.update_one({"payment_id": payment_id}, {"$set": {"applied": True}})
+    return result.modified_count > 0
+
+async def _process_iyzico_callback(db, event: dict) -> dict:
+    """Apply a checkout callback event (queued by iyzico_payment_callback)"""
+    token = event["body"]["token"]
+    
+    # Retrieve checkout result
+    result = await iyzico_service.retrieve_checkout_result(token)
+    if result.get("status") == "error":
+        # Transport error or open circuit - retried by the queue, not a payment failure
+        raise RuntimeError(result.get("message") or "iyzico checkout result unavailable")
+    
+    # Find the session
+    session = await db.iyzico_sessions.find_one({"token": token})
+    
+    if result.get("status") == "success" and result.get("paymentStatus") == "SUCCESS":
+        # Payment successful
+        now = datetime.now(timezone.utc)
         
-        # Find the session
-        session = await db.iyzico_sessions.find_one({"token": token})
+        # Update session
+        await db.iyzico_sessions.update_one(
+            {"token": token},
+            {"$set": {
+                "status": "completed",
+                "payment_id": result.get("paymentId"),
+                "completed_at": now.isoformat()
+            }}
+        )
         
-        if result.get("status") == "success" and result.get("paymentStatus") == "SUCCESS":
-            # Payment successful
-            now = datetime.now(timezone.utc)
+        if not result.get("paymentId"):
+            # Without the iyzico payment id the payment cannot be de-duplicated
+            logger.error(f"iyzico checkout result without paymentId for token {token}: {result}")
+            return {"status": "rejected", "message": "Payment result has no paymentId"}
+        payment_id = str(result["paymentId"])
+        
+        if session:
+            company_id = session["company_id"]
+            plan = session["plan"]
+            billing_cycle = session["billing_cycle"]
+            amount = session["amount"]
             
-            # Update session
-            await db.iyzico_sessions.update_one(
-                {"token": token},
-                {"$set": {
-                    "status": "completed",
-                    "payment_id": result.get("paymentId"),
-                    "completed_at": now.isoformat()
-                }}
-            )
+            # Record payment
+            payment_record = {
+                "id": str(uuid.uuid4()),
+                "company_id": company_id,
+                "plan": plan,
+                "billing_cycle": billing_cycle,
+                "amount": amount,
+                "currency": "TRY",
+                "payment_method": "iyzico",
+                "payment_id": payment_id,
+                "status": PaymentStatus.COMPLETED.value,
+                "created_at": now.isoformat()
+            }
+            payment = await _record_iyzico_payment(payment_record)
+            # Records from before the applied flag were applied inline
+            if payment.get("applied", True):
+                return {"status": "success", "message": "Payment already processed"}
             
-            if session:
-                company_id = session["company_id"]
-                plan = session["plan"]
-                billing_cycle = session["billing_cycle"]
-                amount = session["amount"]
-                
-                # Calculate subscription period
-                if billing_cycle == "yearly":
-                    months = 12
-                else:
-                    months = 1
-                
-                new_end = now + timedelta(days=30 * months)
-                
-                # Update company subscription
-                await db.companies.update_one(
-                    {"id": company_id},
-                    {"$set": {
-                        "status": CompanyStatus.ACTIVE.value,
-                        "subscription_plan": plan,
-                        "billing_cycle": billing_cycle,
-                        "subscription_start": now.isoformat(),
-                        "subscription_end": new_end.isoformat(),
-                        "last_payment_date": now.isoformat(),
-                        "updated_at": now.isoformat()
-                    }}
-                )
-                
-                # Record payment
-                payment_record = {
-                    "id": str(uuid.uuid4()),
-                    "company_id": company_id,
-                    "plan": plan,
-                    "billing_cycle": billing_cycle,
-                    "amount": amount,
-                    "currency": "TRY",
-                    "payment_method": "iyzico",
-                    "payment_id": result.get("paymentId"),
-                    "status": PaymentStatus.COMPLETED.value,
-                    "created_at": now.isoformat()
-                }
-                await db.subscription_payments.insert_one(payment_record)
-                
-                logger.info(f"iyzico payment completed for company {company_id}: ₺{amount}")
+            # Calculate subscription period
+            if billing_cycle == "yearly":
+                months = 12
+            else:
+                months = 1
             
-            return {"status": "success", "message": "Payment completed successfully"}
-        else:
-            # Payment failed
-            await db.iyzico_sessions.update_one(
-                {"token": token},
+            new_end = now + timedelta(days=30 * months)
+            
+            # Update company subscription
+            await _apply_iyzico_payment(company_id, payment_id, {
+                "status": CompanyStatus.ACTIVE.value,
+                "subscription_plan": plan,
+                "billing_cycle": billing_cycle,
+                "subscription_start": now.isoformat(),
+                "subscription_end": new_end.isoformat(),
+                "last_payment_date": now.isoformat(),
+                "updated_at": now.isoformat()
+            })
+            
+            logger.info(f"iyzico payment completed for company {company_id}: ₺{amount}")
+        
+        return {"status": "success", "message": "Payment completed successfully"}
+    
+    # Payment failed
+    await db.iyzico_sessions.update_one(
+        {"token": token, "status": {"$ne": "completed"}},
+        {"$set": {
+            "status": "failed",
+            "error": result.get("errorMessage"),
+            "failed_at": datetime.now(timezone.utc).isoformat()
+        }}
+    )
+    
+    logger.error(f"iyzico payment failed: {result}")
+    return {"status": "failed", "message": result.get("errorMessage", "Payment failed")}
+
+async def _process_iyzico_webhook(db, event: dict) -> dict:
+    """Apply a subscription webhook event (queued by iyzico_webhook)"""
+    body = event["body"]
+    event_type = body.get("iyziEventType")
+    subscription_ref = body.get("subscriptionReferenceCode")
+    
+    if event_type == "SUBSCRIPTION_PAYMENT_SUCCESS":
+        # Find company by subscription reference
+        company = await db.companies.find_one({"iyzico_subscription_ref": subscription_ref})
+        if not company:
+            return {"status": "ignored", "message": "Unknown subscription"}
+        
+        if not body.get("paymentId"):
+            logger.error(f"iyzico webhook {event['id']} without paymentId: {body}")
+            return {"status": "rejected", "message": "Webhook has no paymentId"}
+        payment_id = str(body["paymentId"])
+        now = datetime.now(timezone.utc)
+        
+        # Record payment
+        payment_record = {
+            "id": str(uuid.uuid4()),
+            "company_id": company["id"],
+            "plan": company.get("subscription_plan", "starter"),
+            "billing_cycle": "monthly",
+            "amount": body.get("paidPrice", 0),
+            "currency": "TRY",
+            "payment_method": "iyzico_recurring",
+            "payment_id": payment_id,
+            "status": PaymentStatus.COMPLETED.value,
+            "created_at": now.isoformat()
+        }
+        payment = await _record_iyzico_payment(payment_record)
+        if payment.get("applied", True):
+            return {"status": "duplicate", "message": "Payment already recorded"}
+        
+        # Extend subscription
+        current_end = datetime.fromisoformat(company.get("subscription_end", now.isoformat()).replace("Z", "+00:00"))
+        new_end = max(current_end, now) + timedelta(days=30)
+        
+        if await _apply_iyzico_payment(company["id"], payment_id, {
+            "subscription_end": new_end.isoformat(),
+            "last_payment_date": now.isoformat(),
+            "updated_at": now.isoformat()
+        }):
+            logger.info(f"Recurring payment processed for {company['name']}")
+        return {"status": "processed", "subscription_end": new_end.isoformat()}
+    
+    elif event_type == "SUBSCRIPTION_CANCELLED":
+        company = await db.companies.find_one({"iyzico_subscription_ref": subscription_ref})
+        if company:
+            await db.companies.update_one(
+                {"id": company["id"]},
                 {"$set": {
-                    "status": "failed",
-                    "error": result.get("errorMessage"),
-                    "failed_at": datetime.now(timezone.utc).isoformat()
+                    "status": CompanyStatus.SUSPENDED.value,
+                    "suspension_reason": "Subscription cancelled",
+                    "updated_at": datetime.now(timezone.utc).isoformat()
                 }}
             )
-            
-            logger.error(f"iyzico payment failed: {result}")
-            return {"status": "failed", "message": result.get("errorMessage", "Payment failed")}
+            logger.info(f"Subscription cancelled for {company['name']}")
+            return {"status": "processed"}
     
-    except Exception as e:
-        logger.error(f"iyzico callback error: {str(e)}")
-        raise HTTPException(status_code=500, detail=str(e))
+    return {"status": "ignored"}
+
+iyzico_events.register_handler("callback", _process_iyzico_callback)
+iyzico_events.register_handler("webhook", _process_iyzico_webhook)
+
+@api_router.post("/payment/iyzico/callback")
+async def iyzico_payment_callback(request: Request):
+    """
+    Handle iyzico payment callback.
+    The token is queued once (repeated callbacks are ignored) and applied by the
+    iyzico event worker; waits briefly so the caller usually gets the outcome.
+    """
+    # Get token from form data or JSON
+    content_type = request.headers.get("content-type", "")
+    
+    if "application/x-www-form-urlencoded" in content_type:
+        form_data = await request.form()
+        token = form_data.get("token")
+    else:
+        body = await request.json()
+        token = body.get("token")
+    
+    if not token:
+        raise HTTPException(status_code=400, detail="Token is required")
+    
+    # Ordered with the company's other payment events
+    session = await db.iyzico_sessions.find_one({"token": token}, {"_id": 0, "company_id": 1})
+    event, created = await iyzico_events.ingest(
+        db, "callback", f"callback:{token}", {"token": token},
+        order_key=session.get("company_id") if session else None
+    )
+    
+    processed = await iyzico_events.wait_for(db, event["id"], IYZICO_CALLBACK_WAIT)
+    if processed and processed.get("status") == "done":
+        return processed.get("result")
+    if processed and processed.get("status") == "failed":
+        return {"status": "failed", "message": processed.get("error") or "Payment failed"}
+    return {"status": "processing", "message": "Payment is being processed"}
 
 @api_router.post("/payment/iyzico/webhook")
 async def iyzico_webhook(request: Request):
-    """Handle iyzico webhooks for subscription events"""
+    """
+    Handle iyzico webhooks for subscription events.
+    Verified events are stored once under an idempotency key and acknowledged;
+    the iyzico event worker applies them in order per company.
+    """
+    payload = await request.body()
+    signature = request.headers.get("X-IYZ-SIGNATURE-V3", "")
+    
+    # Verify signature
+    if not iyzico_service.verify_webhook_signature(payload, signature):
+        logger.warning("Invalid iyzico webhook signature")
+        raise HTTPException(status_code=401, detail="Invalid signature")
+    
     try:
-        payload = await request.body()
-        signature = request.headers.get("X-IYZ-SIGNATURE-V3", "")
-        
-        # Verify signature
-        if not iyzico_service.verify_webhook_signature(payload, signature):
-            logger.warning("Invalid iyzico webhook signature")
-            raise HTTPException(status_code=401, detail="Invalid signature")
-        
         body = json.loads(payload)
-        event_type = body.get("iyziEventType")
-        
-        logger.info(f"iyzico webhook received: {event_type}")
-        
-        if event_type == "SUBSCRIPTION_PAYMENT_SUCCESS":
-            # Handle recurring payment success
-            subscription_ref = body.get("subscriptionReferenceCode")
-            payment_id = body.get("paymentId")
-            
-            # Find company by subscription reference
-            company = await db.companies.find_one({"iyzico_subscription_ref": subscription_ref})
-            if company:
-                now = datetime.now(timezone.utc)
-                
-                # Extend subscription
-                current_end = datetime.fromisoformat(company.get("subscription_end", now.isoformat()).replace("Z", "+00:00"))
-                new_end = max(current_end, now) + timedelta(days=30)
-                
-                await db.companies.update_one(
-                    {"id": company["id"]},
-                    {"$set": {
-                        "subscription_end": new_end.isoformat(),
-                        "last_payment_date": now.isoformat(),
-                        "updated_at": now.isoformat()
-                    }}
-                )
-                
-                # Record payment
-                payment_record = {
-                    "id": str(uuid.uuid4()),
-                    "company_id": company["id"],
-                    "plan": company.get("subscription_plan", "starter"),
-                    "billing_cycle": "monthly",
-                    "amount": body.get("paidPrice", 0),
-                    "currency": "TRY",
-                    "payment_method": "iyzico_recurring",
-                    "payment_id": payment_id,
-                    "status": PaymentStatus.COMPLETED.value,
-                    "created_at": now.isoformat()
-                }
-                await db.subscription_payments.insert_one(payment_record)
-                
-                logger.info(f"Recurring payment processed for {company['name']}")
-        
-        elif event_type == "SUBSCRIPTION_CANCELLED":
-            subscription_ref = body.get("subscriptionReferenceCode")
-            company = await db.companies.find_one({"iyzico_subscription_ref": subscription_ref})
-            if company:
-                await db.companies.update_one(
-                    {"id": company["id"]},
-                    {"$set": {
-                        "status": CompanyStatus.SUSPENDED.value,
-                        "suspension_reason": "Subscription cancelled",
-                        "updated_at": datetime.now(timezone.utc).isoformat()
-                    }}
-                )
-                logger.info(f"Subscription cancelled for {company['name']}")
-        
-        return {"status": "received"}
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid JSON payload")
+    
+    event_type = body.get("iyziEventType")
+    logger.info(f"iyzico webhook received: {event_type}")
+    
+    company = await db.companies.find_one(
+        {"iyzico_subscription_ref": body.get("subscriptionReferenceCode")}, {"_id": 0, "id": 1}
+    ) if body.get("subscriptionReferenceCode") else None
+    event, created = await iyzico_events.ingest(
+        db, "webhook", webhook_idempotency_key(body, payload), payload.decode("utf-8"),
+        order_key=company["id"] if company else body.get("subscriptionReferenceCode"),
+        event_type=event_type
+    )
     
-    except Exception as e:
-        logger.error(f"iyzico webhook error: {str(e)}")
-        return {"status": "error", "message": str(e)}
+    return {"status": "received", "duplicate": not created}
+
+@api_router.get("/superadmin/payments/iyzico/events")
+async def list_iyzico_events(status: Optional[str] = None, limit: int = 100, user: dict = Depends(get_current_user)):
+    """SuperAdmin: Queued iyzico webhook / callback events and their processing state"""
+    if user["role"] != UserRole.SUPERADMIN.value:
+        raise HTTPException(status_code=403, detail="Only SuperAdmin can view payment events")
+    
+    query = {"status": status} if status else {}
+    return await db.iyzico_events.find(query, {"_id": 0, "payload": 0}).sort("received_at", -1).limit(min(limit, 500)).to_list(500)
 
 # ============== SUPPORT TICKET SYSTEM ==============
 
@@ -4592,62 +5385,173 @@ async def create_ticket(ticket: TicketCreate, user: dict = Depends(get_current_u
         "message": "Destek talebiniz oluşturuldu"
     }
 
+TENANT_SECRET = os.environ.get('TENANT_SECRET', '')
+
+class TicketEvent(BaseModel):
+    event_id: str
+    event_type: str  # ticket.created, ticket.reply, ticket.status
+    ticket_id: str
+    company_code: Optional[str] = None
+    occurred_at: str
+    data: dict = {}
+
+def verify_tenant_secret(request: Request, required: bool = False):
+    """
+    Reject tenant pushes with a wrong X-Tenant-Secret. The legacy incoming
+    endpoint stays open while TENANT_SECRET is unset; required endpoints refuse.
+    """
+    if required and not TENANT_SECRET:
+        raise HTTPException(status_code=503, detail="TENANT_SECRET is not configured")
+    if TENANT_SECRET and not secrets.compare_digest(request.headers.get("X-Tenant-Secret", ""), TENANT_SECRET):
+        raise HTTPException(status_code=401, detail="Invalid tenant secret")
+
+async def apply_ticket_event(event: dict) -> dict:
+    """
+    Apply a replicated tenant ticket event to the consolidated support_tickets index.
+    Every event type is idempotent so tenant outbox retries are safe.
+    Returns {"retry": True} when the ticket has not been replicated yet.
+    """
+    ticket_id = event["ticket_id"]
+    event_type = event["event_type"]
+    data = event.get("data") or {}
+    occurred_at = event.get("occurred_at") or datetime.now(timezone.utc).isoformat()
+    
+    if event_type in ("ticket.reply", "ticket.status") and data.get("status") is not None \
+            and data["status"] not in {s.value for s in TicketStatus}:
+        raise HTTPException(status_code=400, detail=f"Invalid ticket status: {data['status']}")
+    
+    if event_type == "ticket.created":
+        ticket = {k: v for k, v in data.items() if k != "_id"}
+        ticket["id"] = ticket_id
+        company_code = event.get("company_code") or ticket.get("company_code")
+        if company_code:
+            ticket["company_code"] = company_code
+            company = await db.companies.find_one({"code": company_code}, {"_id": 0, "id": 1, "name": 1})
+            if company:
+                ticket["company_id"] = company["id"]
+                ticket["company_name"] = ticket.get("company_name") or company.get("name")
+        ticket.setdefault("source", "tenant_panel")
+        ticket.setdefault("messages", [])
+        ticket.setdefault("updated_at", ticket.get("created_at", occurred_at))
+        ticket["received_at"] = datetime.now(timezone.utc).isoformat()
+        
+        result = await db.support_tickets.update_one(
+            {"id": ticket_id},
+            {"$setOnInsert": ticket},
+            upsert=True
+        )
+        return {"created": result.upserted_id is not None}
+    
+    if event_type == "ticket.reply":
+        message = data.get("message") or {}
+        update = {"$push": {"messages": message}, "$set": {"updated_at": message.get("created_at", occurred_at)}}
+        if data.get("status"):
+            update["$set"]["status"] = data["status"]
+        result = await db.support_tickets.update_one(
+            {"id": ticket_id, "messages.id": {"$ne": message.get("id")}},
+            update
+        )
+    elif event_type == "ticket.status":
+        update = {k: v for k, v in data.items() if k in ("status", "updated_at", "resolved_at")}
+        update["status_changed_at"] = occurred_at
+        result = await db.support_tickets.update_one(
+            {"id": ticket_id, "$or": [
+                {"status_changed_at": {"$exists": False}},
+                {"status_changed_at": {"$lt": occurred_at}}
+            ]},
+            {"$set": update}
+        )
+    else:
+        raise HTTPException(status_code=400, detail=f"Unknown event type: {event_type}")
+    
+    if result.matched_count == 0:
+        # Either a duplicate/stale event (ticket exists) or the create hasn't arrived yet
+        if not await db.support_tickets.find_one({"id": ticket_id}, {"_id": 1}):
+            return {"retry": True}
+        return {"applied": False}
+    return {"applied": True}
+
+# SuperAdmin: Receive ticket events pushed by tenant outboxes
+@api_router.post("/superadmin/support/tickets/events")
+async def receive_tenant_ticket_event(event: TicketEvent, request: Request):
+    """Receive ticket creations, replies and status changes from tenant backends"""
+    verify_tenant_secret(request, required=True)
+    
+    result = await apply_ticket_event(event.model_dump())
+    if result.get("retry"):
+        raise HTTPException(status_code=409, detail="Ticket not replicated yet")
+    
+    return {"success": True, **result}
+
 # SuperAdmin: Receive incoming tickets from tenants
 @api_router.post("/superadmin/support/tickets/incoming")
-async def receive_tenant_ticket(ticket_data: dict):
-    """Receive support tickets from tenant panels"""
-    # Add to superadmin database
-    ticket_data["received_at"] = datetime.now(timezone.utc).isoformat()
-    ticket_data["source"] = "tenant_panel"
-    
-    # Check if ticket already exists
-    existing = await db.support_tickets.find_one({"id": ticket_data.get("id")})
-    if existing:
+async def receive_tenant_ticket(ticket_data: dict, request: Request):
+    """Receive support tickets from tenant panels (legacy, creation only)"""
+    verify_tenant_secret(request)
+    
+    result = await apply_ticket_event({
+        "event_type": "ticket.created",
+        "ticket_id": ticket_data.get("id") or str(uuid.uuid4()),
+        "company_code": ticket_data.get("company_code"),
+        "occurred_at": ticket_data.get("created_at"),
+        "data": ticket_data
+    })
+    if not result.get("created"):
         return {"success": True, "message": "Ticket already exists"}
     
-    await db.support_tickets.insert_one(ticket_data)
     logger.info(f"Received ticket from tenant: {ticket_data.get('company_name')} - {ticket_data.get('subject')}")
-    
     return {"success": True, "message": "Ticket received"}
 
-# SuperAdmin: Get all tickets (including from tenants)
-@api_router.get("/superadmin/support/tickets")
-async def get_all_tickets(user: dict = Depends(get_current_user)):
-    """SuperAdmin: Get all support tickets from all tenants"""
+# SuperAdmin: Import tickets from tenants that predate the outbox
+@api_router.post("/superadmin/support/tickets/backfill")
+async def backfill_tenant_tickets(user: dict = Depends(get_current_user)):
+    """SuperAdmin: One-off pull of existing tenant tickets into the consolidated index"""
     if user["role"] != UserRole.SUPERADMIN.value:
-        raise HTTPException(status_code=403, detail="Only SuperAdmin can view all tickets")
+        raise HTTPException(status_code=403, detail="Only SuperAdmin can backfill tickets")
     
-    all_tickets = []
+    companies = await db.companies.find(
+        {"is_active": True},
+        {"_id": 0, "id": 1, "code": 1, "name": 1, "mongo_mode": 1}
+    ).to_list(1000)
+    companies = [c for c in companies if c.get("code")]
     
-    # Get local tickets
-    local_tickets = await db.support_tickets.find({}, {"_id": 0}).sort("created_at", -1).to_list(500)
-    all_tickets.extend(local_tickets)
+    async def fetch(company: dict):
+        return await portainer_service.get_tenant_support_tickets(
+            company["code"], strict=True, mongo_mode=company.get("mongo_mode") or "dedicated"
+        )
     
-    # Get tickets from all tenant databases
-    try:
-        companies = await db.companies.find({"is_active": True}, {"_id": 0}).to_list(100)
-        for company in companies:
-            try:
-                company_code = company.get("code", "").lower().replace(" ", "").replace("-", "")
-                if not company_code:
-                    continue
-                    
-                # Connect to tenant's MongoDB via Portainer
-                tenant_tickets = await portainer_service.get_tenant_support_tickets(company_code)
-                for ticket in tenant_tickets:
-                    ticket["company_name"] = company.get("name", company_code)
-                    ticket["company_code"] = company_code
-                    ticket["source"] = "tenant_db"
-                    all_tickets.append(ticket)
-            except Exception as e:
-                logger.warning(f"Could not fetch tickets from {company.get('name')}: {e}")
-    except Exception as e:
-        logger.error(f"Error fetching tenant tickets: {e}")
+    fanout = await tenant_fanout.run(companies, fetch)
+    imported = 0
+    for item in fanout["results"]:
+        company = item["company"]
+        for ticket in item["data"]:
+            if not ticket.get("id"):
+                continue
+            result = await apply_ticket_event({
+                "event_type": "ticket.created",
+                "ticket_id": ticket["id"],
+                "company_code": company["code"],
+                "occurred_at": ticket.get("created_at"),
+                "data": {**ticket, "source": "tenant_db"}
+            })
+            if result.get("created"):
+                imported += 1
     
-    # Sort by created_at
-    all_tickets.sort(key=lambda x: x.get("created_at", ""), reverse=True)
+    return {
+        "success": True,
+        "imported": imported,
+        "tenant_status": fanout["tenants"],
+        "partial": fanout["partial"]
+    }
+
+# SuperAdmin: Get all tickets (including from tenants)
+@api_router.get("/superadmin/support/tickets")
+async def get_all_tickets(user: dict = Depends(get_current_user)):
+    """SuperAdmin: Get all support tickets from all tenants (replicated index)"""
+    if user["role"] != UserRole.SUPERADMIN.value:
+        raise HTTPException(status_code=403, detail="Only SuperAdmin can view all tickets")
     
-    return all_tickets
+    return await db.support_tickets.find({}, {"_id": 0}).sort("created_at", -1).to_list(500)
 
 # Tenant: Get my tickets
 @api_router.get("/support/tickets")
@@ -4740,61 +5644,37 @@ async def get_all_tickets(
     priority: Optional[str] = None,
     limit: int = 100
 ):
-    """SuperAdmin: Get all support tickets including from tenants"""
+    """SuperAdmin: Get all support tickets including from tenants (replicated index)"""
     if user["role"] != UserRole.SUPERADMIN.value:
         raise HTTPException(status_code=403, detail="Only SuperAdmin can view all tickets")
     
-    all_tickets = []
-    
-    # Get local tickets
     query = {}
     if status:
         query["status"] = status
     if priority:
         query["priority"] = priority
     
-    local_tickets = await db.support_tickets.find(query, {"_id": 0}).sort("updated_at", -1).limit(limit).to_list(limit)
-    all_tickets.extend(local_tickets)
-    
-    # Get tickets from all tenant databases
-    try:
-        companies = await db.companies.find({"is_active": True}, {"_id": 0}).to_list(100)
-        for company in companies:
-            try:
-                company_code = company.get("code", "").lower().replace(" ", "").replace("-", "")
-                if not company_code:
-                    continue
-                    
-                tenant_tickets = await portainer_service.get_tenant_support_tickets(company_code)
-                for ticket in tenant_tickets:
-                    ticket["company_name"] = company.get("name", company_code)
-                    ticket["company_code"] = company_code
-                    ticket["source"] = "tenant"
-                    # Apply filters
-                    if status and ticket.get("status") != status:
-                        continue
-                    if priority and ticket.get("priority") != priority:
-                        continue
-                    all_tickets.append(ticket)
-            except Exception as e:
-                logger.warning(f"Could not fetch tickets from {company.get('name')}: {e}")
-    except Exception as e:
-        logger.error(f"Error fetching tenant tickets: {e}")
-    
-    # Sort by created_at
-    all_tickets.sort(key=lambda x: x.get("created_at", ""), reverse=True)
+    tickets = await db.support_tickets.find(query, {"_id": 0}).sort("created_at", -1).limit(limit).to_list(limit)
     
     # Get ticket stats
     stats = {
-        "total": len(all_tickets),
-        "open": len([t for t in all_tickets if t.get("status") == "open"]),
-        "in_progress": len([t for t in all_tickets if t.get("status") == "in_progress"]),
-        "waiting_customer": len([t for t in all_tickets if t.get("status") == "waiting_customer"]),
-        "resolved": len([t for t in all_tickets if t.get("status") == "resolved"]),
-        "closed": len([t for t in all_tickets if t.get("status") == "closed"])
+        "total": 0,
+        "open": 0,
+        "in_progress": 0,
+        "waiting_customer": 0,
+        "resolved": 0,
+        "closed": 0
     }
+    pipeline = [
+        {"$match": query},
+        {"$group": {"_id": "$status", "count": {"$sum": 1}}}
+    ]
+    async for row in db.support_tickets.aggregate(pipeline):
+        stats["total"] += row["count"]
+        if row["_id"] in stats:
+            stats[row["_id"]] = row["count"]
     
-    return {"tickets": all_tickets[:limit], "stats": stats}
+    return {"tickets": tickets, "stats": stats}
 
 # SuperAdmin: Update ticket status
 @api_router.patch("/superadmin/tickets/{ticket_id}/status")
@@ -5514,6 +6394,28 @@ async def startup():
     await db.vehicles.create_index("plate")
     await db.customers.create_index("tc_no")
     await db.reservations.create_index("status")
+    try:
+        await db.support_tickets.create_index("id", unique=True)
+    except OperationFailure as e:
+        # Legacy duplicate ids - ticket events still upsert on id
+        logger.warning(f"[SUPPORT] Unique ticket id index not created: {e}")
+        await db.support_tickets.create_index("id")
+    await db.support_tickets.create_index([("created_at", -1)])
+    await db.support_tickets.create_index([("status", 1), ("created_at", -1)])
+    await db.support_tickets.create_index([("priority", 1), ("created_at", -1)])
+    await db.support_tickets.create_index([("company_id", 1), ("updated_at", -1)])
+    await tenant_snapshots.ensure_indexes(db)
+    await fleet_health.ensure_indexes(db)
+    await gps_position_cache.ensure_indexes(db)
+    await gps_history.ensure_indexes(db)
+    await vehicle_position_index.ensure_indexes(db)
+    await kabis_outbox.ensure_indexes(db)
+    await hgs_service.ensure_indexes(db)
+    await hgs_service.backfill_company_ids(db)
+    hgs_service.set_db(db)
+    await hgs_service.settle_pending_debits()
+    await iyzico_events.ensure_indexes(db)
+    await portainer_service.init_port_offset_allocator(db)
     
     # Create default superadmin if not exists
     existing_admin = await db.users.find_one({"role": "superadmin"})
@@ -5530,8 +6432,24 @@ async def startup():
         await db.users.insert_one(admin_user)
         logger.info("✅ Default superadmin created: admin@admin.com / admin123")
     
+    # Keep Portainer inventory snapshot warm for status pages
+    asyncio.create_task(portainer_inventory.run())
+    
+    # Continuous tenant backend health probing
+    asyncio.create_task(fleet_health.run(db))
+    
+    # Arvento position pollers (one per company with active GPS settings)
+    gps_position_cache.add_listener(gps_history.record)
+    gps_position_cache.add_listener(vehicle_position_index.record)
+    asyncio.create_task(gps_position_cache.run(db))
+    asyncio.create_task(kabis_outbox.run(db))
+    asyncio.create_task(iyzico_events.run(db))
+    
     logger.info("FleetEase API started")
 
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    await fleet_health.close()
+    await integration_http.close_all()
+    tenant_db_registry.close_all()
     client.close()
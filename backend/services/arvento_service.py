@@ -2,12 +2,13 @@
 Arvento GPS Integration Service
 Arvento API documentation: https://www.arvento.com/api
 """
-import httpx
 import logging
 from typing import Dict, List, Any, Optional
 from datetime import datetime, timezone
 import os
 
+from .integration_http import integration_http
+
 logger = logging.getLogger(__name__)
 
 class ArventoService:
@@ -34,29 +35,29 @@ class ArventoService:
             return self._mock_vehicles()
         
         try:
-            async with httpx.AsyncClient(timeout=30) as client:
-                headers = {
-                    'Authorization': f'Bearer {self.api_key}',
-                    'X-Company-Code': self.company_code,
-                    'Content-Type': 'application/json'
+            client = integration_http.client('arvento')
+            headers = {
+                'Authorization': f'Bearer {self.api_key}',
+                'X-Company-Code': self.company_code,
+                'Content-Type': 'application/json'
+            }
+            
+            response = await client.get(
+                f'{self.api_url}/vehicles/positions',
+                headers=headers
+            )
+            
+            if response.status_code == 200:
+                data = response.json()
+                return {
+                    'success': True,
+                    'vehicles': self._transform_arvento_data(data),
+                    'source': 'arvento_api'
                 }
+            else:
+                logger.error(f'Arvento API error: {response.status_code}')
+                return self._mock_vehicles()
                 
-                response = await client.get(
-                    f'{self.api_url}/vehicles/positions',
-                    headers=headers
-                )
-                
-                if response.status_code == 200:
-                    data = response.json()
-                    return {
-                        'success': True,
-                        'vehicles': self._transform_arvento_data(data),
-                        'source': 'arvento_api'
-                    }
-                else:
-                    logger.error(f'Arvento API error: {response.status_code}')
-                    return self._mock_vehicles()
-                    
         except Exception as e:
             logger.error(f'Arvento connection error: {str(e)}')
             return self._mock_vehicles()
@@ -69,25 +70,25 @@ class ArventoService:
             return {'success': True, 'history': [], 'source': 'mock', 'message': 'API yapılandırılmamış'}
         
         try:
-            async with httpx.AsyncClient(timeout=30) as client:
-                headers = {
-                    'Authorization': f'Bearer {self.api_key}',
-                    'X-Company-Code': self.company_code
+            client = integration_http.client('arvento')
+            headers = {
+                'Authorization': f'Bearer {self.api_key}',
+                'X-Company-Code': self.company_code
+            }
+            
+            response = await client.get(
+                f'{self.api_url}/vehicles/{plate}/history',
+                headers=headers,
+                params={'start': start_date, 'end': end_date}
+            )
+            
+            if response.status_code == 200:
+                return {
+                    'success': True,
+                    'history': response.json(),
+                    'source': 'arvento_api'
                 }
                 
-                response = await client.get(
-                    f'{self.api_url}/vehicles/{plate}/history',
-                    headers=headers,
-                    params={'start': start_date, 'end': end_date}
-                )
-                
-                if response.status_code == 200:
-                    return {
-                        'success': True,
-                        'history': response.json(),
-                        'source': 'arvento_api'
-                    }
-                    
         except Exception as e:
             logger.error(f'Arvento history error: {str(e)}')
         
@@ -173,24 +174,24 @@ class ArventoService:
             }
         
         try:
-            async with httpx.AsyncClient(timeout=10) as client:
-                headers = {
-                    'Authorization': f'Bearer {self.api_key}',
-                    'X-Company-Code': self.company_code
-                }
-                
-                response = await client.get(
-                    f'{self.api_url}/ping',
-                    headers=headers
-                )
-                
-                return {
-                    'success': response.status_code == 200,
-                    'configured': True,
-                    'status_code': response.status_code,
-                    'message': 'Bağlantı başarılı' if response.status_code == 200 else 'Bağlantı hatası'
-                }
-                
+            client = integration_http.client('arvento')
+            headers = {
+                'Authorization': f'Bearer {self.api_key}',
+                'X-Company-Code': self.company_code
+            }
+            
+            response = await client.get(
+                f'{self.api_url}/ping',
+                headers=headers
+            )
+            
+            return {
+                'success': response.status_code == 200,
+                'configured': True,
+                'status_code': response.status_code,
+                'message': 'Bağlantı başarılı' if response.status_code == 200 else 'Bağlantı hatası'
+            }
+            
         except Exception as e:
             return {
                 'success': False,
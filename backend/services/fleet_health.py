@@ -0,0 +1,230 @@
+"""
+Fleet Health Prober
+Continuously probes every tenant backend's /api/health so SuperAdmin has a
+live view of which tenants are up, without waiting for an update flow to
+call _check_backend_health.
+
+Probes run through tenant_fanout (bounded concurrency, per-tenant deadline).
+Results are kept in memory for the summary and written to hourly buckets in
+fleet_health_buckets (expired by a TTL index).
+"""
+import asyncio
+import logging
+import math
+import os
+import time
+from collections import deque
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional
+
+import httpx
+
+from .tenant_fanout import tenant_fanout
+
+logger = logging.getLogger(__name__)
+
+FLEET_HEALTH_INTERVAL = int(os.environ.get('FLEET_HEALTH_INTERVAL', '30'))
+FLEET_HEALTH_TIMEOUT = float(os.environ.get('FLEET_HEALTH_TIMEOUT', '5'))
+FLEET_HEALTH_CONCURRENCY = int(os.environ.get('FLEET_HEALTH_CONCURRENCY', '20'))
+FLEET_HEALTH_URL_TEMPLATE = os.environ.get('FLEET_HEALTH_URL_TEMPLATE', 'https://api.{domain}/api/health')
+FLEET_HEALTH_FAILURE_THRESHOLD = int(os.environ.get('FLEET_HEALTH_FAILURE_THRESHOLD', '3'))
+FLEET_HEALTH_SLOW_MS = float(os.environ.get('FLEET_HEALTH_SLOW_MS', '1500'))
+FLEET_HEALTH_RETENTION_DAYS = int(os.environ.get('FLEET_HEALTH_RETENTION_DAYS', '7'))
+# Latency samples kept in memory per tenant for percentiles
+FLEET_HEALTH_WINDOW = 120
+# Samples kept per hourly bucket document (one hour at a 15s interval)
+FLEET_HEALTH_BUCKET_SAMPLES = 240
+
+
+def percentile(values: List[float], pct: float) -> Optional[float]:
+    """Nearest-rank percentile"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, math.ceil(pct / 100 * len(ordered)) - 1))
+    return round(ordered[index], 1)
+
+
+class FleetHealthProber:
+    """
+    Background prober for tenant backends
+
+    - run(db): probe all provisioned tenants every interval
+    - summary(): per-tenant status (up / degraded / down), latency percentiles
+      and consecutive failures, plus a fleet-wide rollup
+    - is_healthy(code): gate for rollout jobs
+    """
+
+    def __init__(self, interval: int = FLEET_HEALTH_INTERVAL):
+        self.interval = interval
+        self._state: Dict[str, Dict[str, Any]] = {}
+        self._last_round: Optional[str] = None
+        self._client: Optional[httpx.AsyncClient] = None
+
+    async def ensure_indexes(self, db):
+        await db.fleet_health_buckets.create_index([("company_code", 1), ("bucket", -1)], unique=True)
+        await db.fleet_health_buckets.create_index("expires_at", expireAfterSeconds=0)
+
+    def _get_client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                verify=False,
+                timeout=FLEET_HEALTH_TIMEOUT,
+                limits=httpx.Limits(max_connections=FLEET_HEALTH_CONCURRENCY, max_keepalive_connections=FLEET_HEALTH_CONCURRENCY)
+            )
+        return self._client
+
+    async def _probe(self, company: Dict[str, Any]) -> Dict[str, Any]:
+        url = FLEET_HEALTH_URL_TEMPLATE.format(domain=company['domain'], code=company['code'])
+        response = await self._get_client().get(url)
+        if response.status_code != 200:
+            raise RuntimeError(f"HTTP {response.status_code}")
+        return {'status_code': response.status_code}
+
+    def _record(self, code: str, name: str, outcome: Dict[str, Any], now: str) -> Dict[str, Any]:
+        state = self._state.setdefault(code, {
+            'code': code,
+            'latencies': deque(maxlen=FLEET_HEALTH_WINDOW),
+            'consecutive_failures': 0,
+            'last_ok': None,
+            'last_error': None
+        })
+        state['name'] = name
+        state['last_checked'] = now
+        state['last_latency_ms'] = outcome['duration_ms']
+        if outcome['status'] == 'ok':
+            state['latencies'].append(outcome['duration_ms'])
+            state['consecutive_failures'] = 0
+            state['last_ok'] = now
+        else:
+            state['consecutive_failures'] += 1
+            state['last_error'] = outcome['error']
+        return state
+
+    @staticmethod
+    def _status(state: Dict[str, Any]) -> str:
+        if state['consecutive_failures'] >= FLEET_HEALTH_FAILURE_THRESHOLD:
+            return 'down'
+        if state['consecutive_failures'] > 0:
+            return 'degraded'
+        p95 = percentile(list(state['latencies']), 95)
+        if p95 is not None and p95 > FLEET_HEALTH_SLOW_MS:
+            return 'degraded'
+        return 'up'
+
+    async def probe_all(self, db) -> Dict[str, Any]:
+        """Probe every provisioned tenant once and persist the results"""
+        companies = await db.companies.find(
+            {"portainer_stack_id": {"$ne": None}, "domain": {"$ne": None}},
+            {"_id": 0, "code": 1, "name": 1, "domain": 1}
+        ).to_list(1000)
+
+        fanout = await tenant_fanout.run(
+            companies, self._probe,
+            timeout=FLEET_HEALTH_TIMEOUT,
+            concurrency=FLEET_HEALTH_CONCURRENCY
+        )
+
+        now_dt = datetime.now(timezone.utc)
+        now = now_dt.isoformat()
+        bucket = now_dt.strftime('%Y-%m-%dT%H:00')
+        expires_at = now_dt.replace(minute=0, second=0, microsecond=0) + timedelta(days=FLEET_HEALTH_RETENTION_DAYS)
+
+        writes = []
+        for outcome in fanout['tenants']:
+            state = self._record(outcome['code'], outcome['name'], outcome, now)
+            ok = outcome['status'] == 'ok'
+            update = {
+                '$inc': {'probes': 1, 'failures': 0 if ok else 1},
+                '$set': {
+                    'consecutive_failures': state['consecutive_failures'],
+                    'last_status': outcome['status'],
+                    'last_error': None if ok else outcome['error'],
+                    'updated_at': now
+                },
+                '$setOnInsert': {'expires_at': expires_at}
+            }
+            if ok:
+                update['$push'] = {'latencies_ms': {'$each': [outcome['duration_ms']], '$slice': -FLEET_HEALTH_BUCKET_SAMPLES}}
+                update['$min'] = {'min_latency_ms': outcome['duration_ms']}
+                update['$max'] = {'max_latency_ms': outcome['duration_ms']}
+            writes.append(db.fleet_health_buckets.update_one(
+                {'company_code': outcome['code'], 'bucket': bucket}, update, upsert=True
+            ))
+        await asyncio.gather(*writes)
+
+        # Tenants that were deprovisioned since the last round
+        active = {c['code'] for c in companies}
+        for code in list(self._state):
+            if code not in active:
+                self._state.pop(code)
+
+        self._last_round = now
+        return {'probed': len(companies), 'ok': fanout['ok_count'], 'failed': fanout['failed_count']}
+
+    def is_healthy(self, company_code: str) -> bool:
+        """True when the tenant's last probes succeeded (unknown tenants are not healthy)"""
+        state = self._state.get(company_code)
+        return bool(state) and self._status(state) == 'up'
+
+    def summary(self) -> Dict[str, Any]:
+        tenants = []
+        counts = {'up': 0, 'degraded': 0, 'down': 0}
+        for state in sorted(self._state.values(), key=lambda s: s['code']):
+            latencies = list(state['latencies'])
+            status = self._status(state)
+            counts[status] += 1
+            tenants.append({
+                'code': state['code'],
+                'name': state.get('name'),
+                'status': status,
+                'consecutive_failures': state['consecutive_failures'],
+                'last_latency_ms': state.get('last_latency_ms'),
+                'p50_ms': percentile(latencies, 50),
+                'p95_ms': percentile(latencies, 95),
+                'p99_ms': percentile(latencies, 99),
+                'last_ok': state['last_ok'],
+                'last_checked': state.get('last_checked'),
+                'last_error': state['last_error']
+            })
+        return {
+            'last_round': self._last_round,
+            'interval_seconds': self.interval,
+            'total': len(tenants),
+            **counts,
+            'tenants': tenants
+        }
+
+    async def history(self, db, company_code: str, hours: int = 24) -> List[Dict[str, Any]]:
+        """Hourly buckets for one tenant with per-bucket percentiles, oldest first"""
+        since = (datetime.now(timezone.utc) - timedelta(hours=hours)).strftime('%Y-%m-%dT%H:00')
+        buckets = await db.fleet_health_buckets.find(
+            {'company_code': company_code, 'bucket': {'$gte': since}},
+            {'_id': 0, 'expires_at': 0}
+        ).sort('bucket', 1).to_list(hours + 1)
+        for b in buckets:
+            latencies = b.pop('latencies_ms', [])
+            b['p50_ms'] = percentile(latencies, 50)
+            b['p95_ms'] = percentile(latencies, 95)
+            b['p99_ms'] = percentile(latencies, 99)
+            b['availability'] = round(1 - b.get('failures', 0) / b['probes'], 4) if b.get('probes') else None
+        return buckets
+
+    async def run(self, db):
+        """Background prober"""
+        while True:
+            started = time.monotonic()
+            try:
+                await self.probe_all(db)
+            except Exception as e:
+                logger.warning(f"[FLEET-HEALTH] Probe round failed: {e}")
+            await asyncio.sleep(max(1.0, self.interval - (time.monotonic() - started)))
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+# Singleton instance
+fleet_health = FleetHealthProber()
@@ -0,0 +1,166 @@
+"""
+Vehicle Position Geo Index
+Last-known vehicle positions as GeoJSON points with a 2dsphere index, for
+nearest-vehicle lookups in the booking flow and geofence checks.
+
+- record(db, company_id, snapshot): snapshot listener, upserts one document
+  per vehicle into vehicle_positions
+- nearby(): $geoNear, joined with vehicles for the current status
+- geofence(): $geoWithin a polygon or circle; vehicles inside and outside
+"""
+import logging
+from typing import Any, Dict, List, Optional
+
+from pymongo import UpdateOne
+
+from .gps_history import normalize_plate
+from .gps_positions import vehicle_key
+
+logger = logging.getLogger(__name__)
+
+EARTH_RADIUS_KM = 6378.1
+
+
+class VehiclePositionIndex:
+    """Last-known positions per company vehicle"""
+
+    async def ensure_indexes(self, db):
+        await db.vehicle_positions.create_index([("location", "2dsphere"), ("company_id", 1)])
+        await db.vehicle_positions.create_index([("company_id", 1), ("vehicle_key", 1)], unique=True)
+        # $lookup from positions to vehicles
+        await db.vehicles.create_index("id")
+
+    async def record(self, db, company_id: str, snapshot: Dict[str, Any]):
+        """Upsert each vehicle's latest position, linked to our vehicle record by plate"""
+        vehicles = await db.vehicles.find(
+            {"company_id": company_id}, {"_id": 0, "id": 1, "plate": 1}
+        ).to_list(None)
+        ids_by_plate = {normalize_plate(v.get("plate")): v["id"] for v in vehicles}
+
+        operations = []
+        for vehicle in snapshot.get("vehicles", []):
+            lat, lng = vehicle.get("lat"), vehicle.get("lng")
+            if lat is None or lng is None or not (-90 <= lat <= 90 and -180 <= lng <= 180):
+                continue
+            plate_key = normalize_plate(vehicle.get("plate"))
+            operations.append(UpdateOne(
+                {"company_id": company_id, "vehicle_key": vehicle_key(vehicle)},
+                {"$set": {
+                    "vehicle_id": ids_by_plate.get(plate_key),
+                    "plate": vehicle.get("plate"),
+                    "plate_key": plate_key,
+                    "location": {"type": "Point", "coordinates": [float(lng), float(lat)]},
+                    "speed": vehicle.get("speed", 0),
+                    "heading": vehicle.get("heading", 0),
+                    "ignition": vehicle.get("ignition", False),
+                    "last_update": vehicle.get("last_update"),
+                    "updated_at": snapshot.get("fetched_at")
+                }},
+                upsert=True
+            ))
+
+        if operations:
+            await db.vehicle_positions.bulk_write(operations, ordered=False)
+
+    @staticmethod
+    def _with_vehicle(statuses: Optional[List[str]]) -> List[Dict[str, Any]]:
+        """Pipeline stages joining the current vehicle record and filtering on its status"""
+        stages = [
+            {"$lookup": {
+                "from": "vehicles",
+                "localField": "vehicle_id",
+                "foreignField": "id",
+                "as": "vehicle",
+                "pipeline": [{"$project": {"_id": 0, "id": 1, "brand": 1, "model": 1, "status": 1, "daily_rate": 1}}]
+            }},
+            {"$unwind": {"path": "$vehicle", "preserveNullAndEmptyArrays": not statuses}}
+        ]
+        if statuses:
+            stages.append({"$match": {"vehicle.status": {"$in": statuses}}})
+        return stages
+
+    @staticmethod
+    def _format(doc: Dict[str, Any]) -> Dict[str, Any]:
+        lng, lat = doc["location"]["coordinates"]
+        result = {
+            "vehicle_id": doc.get("vehicle_id"),
+            "plate": doc.get("plate"),
+            "lat": lat,
+            "lng": lng,
+            "speed": doc.get("speed"),
+            "ignition": doc.get("ignition"),
+            "last_update": doc.get("last_update"),
+            "vehicle": doc.get("vehicle")
+        }
+        if "distance_m" in doc:
+            result["distance_m"] = round(doc["distance_m"], 1)
+        return result
+
+    async def nearby(
+        self,
+        db,
+        company_id: str,
+        lat: float,
+        lng: float,
+        radius_km: float = 5.0,
+        statuses: Optional[List[str]] = None,
+        limit: int = 10
+    ) -> List[Dict[str, Any]]:
+        """Vehicles within radius_km of a point, closest first"""
+        pipeline = [
+            {"$geoNear": {
+                "near": {"type": "Point", "coordinates": [lng, lat]},
+                "distanceField": "distance_m",
+                "maxDistance": radius_km * 1000,
+                "query": {"company_id": company_id},
+                "spherical": True
+            }},
+            *self._with_vehicle(statuses),
+            {"$limit": limit},
+            {"$project": {"_id": 0}}
+        ]
+        docs = await db.vehicle_positions.aggregate(pipeline).to_list(limit)
+        return [self._format(d) for d in docs]
+
+    async def geofence(
+        self,
+        db,
+        company_id: str,
+        geometry: Dict[str, Any],
+        statuses: Optional[List[str]] = None
+    ) -> Dict[str, List[Dict[str, Any]]]:
+        """
+        Split the company's vehicles into inside/outside a region.
+
+        geometry: a GeoJSON Polygon / MultiPolygon, or
+                  {"type": "Circle", "center": [lng, lat], "radius_km": r}
+        """
+        if geometry.get("type") == "Circle":
+            lng, lat = geometry["center"]
+            within = {"$centerSphere": [[lng, lat], geometry["radius_km"] / EARTH_RADIUS_KM]}
+        else:
+            within = {"$geometry": {"type": geometry["type"], "coordinates": geometry["coordinates"]}}
+
+        inside_pipeline = [
+            {"$match": {"company_id": company_id, "location": {"$geoWithin": within}}},
+            {"$project": {"_id": 0, "vehicle_key": 1}}
+        ]
+        inside_keys = {d["vehicle_key"] for d in await db.vehicle_positions.aggregate(inside_pipeline).to_list(None)}
+
+        all_pipeline = [
+            {"$match": {"company_id": company_id}},
+            *self._with_vehicle(statuses),
+            {"$project": {"_id": 0}}
+        ]
+        inside, outside = [], []
+        for doc in await db.vehicle_positions.aggregate(all_pipeline).to_list(None):
+            (inside if doc["vehicle_key"] in inside_keys else outside).append(self._format(doc))
+        return {"inside": inside, "outside": outside}
+
+    async def forget(self, db, company_id: str):
+        """Drop a company's positions (GPS integration disabled)"""
+        await db.vehicle_positions.delete_many({"company_id": company_id})
+
+
+# Singleton instance
+vehicle_position_index = VehiclePositionIndex()
@@ -0,0 +1,205 @@
+"""
+GPS Position History
+Time-series store for polled Arvento positions, bucketed by vehicle and hour,
+with route history downsampled to the map zoom level.
+
+- Every new position snapshot appends changed points to gps_position_buckets
+  (one document per company + vehicle + hour, expired by a TTL index)
+- get_route() simplifies the stored track with Douglas-Peucker (NumPy) using a
+  tolerance of about one screen pixel at the requested zoom
+"""
+import logging
+import math
+import os
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+from pymongo import UpdateOne
+
+from .gps_positions import vehicle_key
+
+logger = logging.getLogger(__name__)
+
+GPS_HISTORY_RETENTION_DAYS = int(os.environ.get('GPS_HISTORY_RETENTION_DAYS', '30'))
+GPS_HISTORY_MAX_POINTS = int(os.environ.get('GPS_HISTORY_MAX_POINTS', '500'))
+# Web Mercator ground resolution at zoom 0 on the equator (meters per pixel)
+METERS_PER_PIXEL_Z0 = 156543.03392
+METERS_PER_DEGREE = 111320.0
+
+
+def normalize_plate(plate: Optional[str]) -> str:
+    return (plate or '').replace(' ', '').upper()
+
+
+def _parse_timestamp(value: Any, default: datetime) -> datetime:
+    if isinstance(value, datetime):
+        return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+    if isinstance(value, str) and value:
+        try:
+            parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+            return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+        except ValueError:
+            pass
+    return default
+
+
+def douglas_peucker(points: np.ndarray, epsilon: float) -> np.ndarray:
+    """
+    Indices of the points kept by Douglas-Peucker simplification.
+    points: (n, 2) array in a planar projection; epsilon in the same units.
+    Iterative, with the per-segment distance computation vectorised.
+    """
+    n = len(points)
+    if n < 3:
+        return np.arange(n)
+
+    keep = np.zeros(n, dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, n - 1)]
+    while stack:
+        start, end = stack.pop()
+        if end - start < 2:
+            continue
+        segment = points[end] - points[start]
+        inner = points[start + 1:end] - points[start]
+        length = np.hypot(segment[0], segment[1])
+        if length == 0:
+            distances = np.hypot(inner[:, 0], inner[:, 1])
+        else:
+            distances = np.abs(segment[0] * inner[:, 1] - segment[1] * inner[:, 0]) / length
+        index = int(np.argmax(distances))
+        if distances[index] > epsilon:
+            split = start + 1 + index
+            keep[split] = True
+            stack.append((start, split))
+            stack.append((split, end))
+    return np.flatnonzero(keep)
+
+
+def zoom_tolerance_meters(zoom: int, latitude: float) -> float:
+    """Ground distance covered by one pixel at this zoom and latitude"""
+    return METERS_PER_PIXEL_Z0 * math.cos(math.radians(latitude)) / (2 ** zoom)
+
+
+class GPSHistoryStore:
+    """
+    Hourly position buckets per vehicle
+
+    - record(db, company_id, snapshot): snapshot listener, appends new points
+    - get_route(...): stored track for a time range, downsampled by zoom
+    """
+
+    def __init__(self, retention_days: int = GPS_HISTORY_RETENTION_DAYS):
+        self.retention_days = retention_days
+        # (company_id, vehicle key) -> last recorded position timestamp
+        self._last_recorded: Dict[tuple, datetime] = {}
+
+    async def ensure_indexes(self, db):
+        await db.gps_position_buckets.create_index(
+            [("company_id", 1), ("vehicle_key", 1), ("bucket", 1)], unique=True
+        )
+        await db.gps_position_buckets.create_index([("company_id", 1), ("plate_key", 1), ("bucket", 1)])
+        await db.gps_position_buckets.create_index("expires_at", expireAfterSeconds=0)
+
+    async def record(self, db, company_id: str, snapshot: Dict[str, Any]):
+        """Append each vehicle's position if it is newer than the last one recorded"""
+        fetched_at = _parse_timestamp(snapshot.get('fetched_at'), datetime.now(timezone.utc))
+        operations = []
+        for vehicle in snapshot.get('vehicles', []):
+            if vehicle.get('lat') is None or vehicle.get('lng') is None:
+                continue
+            key = vehicle_key(vehicle)
+            ts = _parse_timestamp(vehicle.get('last_update'), fetched_at)
+            last = self._last_recorded.get((company_id, key))
+            if last is not None and ts <= last:
+                continue
+            self._last_recorded[(company_id, key)] = ts
+
+            bucket = ts.replace(minute=0, second=0, microsecond=0)
+            point = [ts.timestamp(), float(vehicle['lat']), float(vehicle['lng']), vehicle.get('speed') or 0]
+            operations.append(UpdateOne(
+                {'company_id': company_id, 'vehicle_key': key, 'bucket': bucket},
+                {
+                    '$push': {'points': point},
+                    '$inc': {'count': 1},
+                    '$min': {'first_ts': ts},
+                    '$max': {'last_ts': ts},
+                    '$set': {'plate': vehicle.get('plate'), 'plate_key': normalize_plate(vehicle.get('plate'))},
+                    '$setOnInsert': {'expires_at': bucket + timedelta(days=self.retention_days)}
+                },
+                upsert=True
+            ))
+
+        if operations:
+            await db.gps_position_buckets.bulk_write(operations, ordered=False)
+
+    async def get_route(
+        self,
+        db,
+        company_id: str,
+        plate: str,
+        start: datetime,
+        end: datetime,
+        zoom: Optional[int] = None,
+        max_points: int = GPS_HISTORY_MAX_POINTS
+    ) -> Dict[str, Any]:
+        """
+        Track of a vehicle between start and end.
+        zoom (map zoom level, 0-20) sets the simplification tolerance;
+        the result is capped at max_points either way.
+        """
+        buckets = db.gps_position_buckets.find(
+            {
+                'company_id': company_id,
+                'plate_key': normalize_plate(plate),
+                'bucket': {'$gte': start.replace(minute=0, second=0, microsecond=0), '$lte': end}
+            },
+            {'_id': 0, 'points': 1}
+        ).sort('bucket', 1)
+
+        rows: List[list] = []
+        async for bucket in buckets:
+            rows.extend(bucket.get('points', []))
+        if not rows:
+            return {'points': [], 'raw_count': 0, 'count': 0, 'tolerance_m': None}
+
+        data = np.asarray(rows, dtype=float)
+        data = data[(data[:, 0] >= start.timestamp()) & (data[:, 0] <= end.timestamp())]
+        data = data[np.argsort(data[:, 0], kind='stable')]
+        raw_count = len(data)
+
+        tolerance_m = None
+        if raw_count > 2:
+            mean_lat = float(data[:, 1].mean())
+            # Equirectangular projection to meters - accurate enough at city/country scale
+            planar = np.column_stack((
+                data[:, 2] * METERS_PER_DEGREE * math.cos(math.radians(mean_lat)),
+                data[:, 1] * METERS_PER_DEGREE
+            ))
+            if zoom is not None:
+                tolerance_m = zoom_tolerance_meters(max(0, min(zoom, 22)), mean_lat)
+                data = data[douglas_peucker(planar, tolerance_m)]
+            if len(data) > max_points:
+                stride = np.linspace(0, len(data) - 1, max_points).round().astype(int)
+                data = data[np.unique(stride)]
+
+        points = [
+            {
+                'lat': round(lat, 6),
+                'lng': round(lng, 6),
+                'speed': speed,
+                'timestamp': datetime.fromtimestamp(ts, timezone.utc).isoformat()
+            }
+            for ts, lat, lng, speed in data.tolist()
+        ]
+        return {
+            'points': points,
+            'raw_count': raw_count,
+            'count': len(points),
+            'tolerance_m': round(tolerance_m, 1) if tolerance_m is not None else None
+        }
+
+
+# Singleton instance
+gps_history = GPSHistoryStore()
@@ -0,0 +1,248 @@
+"""
+GPS Position Cache
+Background pollers keep the latest Arvento vehicle positions per company, so
+/gps/vehicles is served from a snapshot instead of calling Arvento for every
+dispatcher on every map refresh.
+
+- One poller task per company with active Arvento settings
+- Interval + random jitter so companies do not hit Arvento in lockstep
+- Snapshot kept in memory and in gps_snapshots (survives restarts)
+- On upstream errors the last good snapshot is kept and marked with the error
+- Live streams wait on wait_for_update() and send per-subscriber deltas
+- Listeners (history, geo index) are called with every new snapshot
+"""
+import asyncio
+import hashlib
+import logging
+import os
+import random
+from datetime import datetime, timezone
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from .arvento_service import ArventoService
+
+logger = logging.getLogger(__name__)
+
+GPS_POLL_INTERVAL = float(os.environ.get('GPS_POLL_INTERVAL', '30'))
+GPS_POLL_JITTER = float(os.environ.get('GPS_POLL_JITTER', '5'))
+# How often the supervisor re-reads integration_settings to start/stop pollers
+GPS_SUPERVISOR_INTERVAL = float(os.environ.get('GPS_SUPERVISOR_INTERVAL', '60'))
+# Fields whose change makes a vehicle part of a stream delta
+GPS_DELTA_FIELDS = ('lat', 'lng', 'speed', 'heading', 'ignition', 'last_update')
+
+
+def vehicle_key(vehicle: Dict[str, Any]) -> str:
+    return str(vehicle.get('vehicle_id') or vehicle.get('plate'))
+
+
+def vehicle_fingerprint(vehicle: Dict[str, Any]) -> tuple:
+    return tuple(vehicle.get(field) for field in GPS_DELTA_FIELDS)
+
+
+def diff_positions(sent: Dict[str, tuple], vehicles: list) -> Dict[str, Any]:
+    """
+    Vehicles that changed since `sent` (vehicle key -> fingerprint of what a
+    client last received) and keys that disappeared. Updates `sent` in place.
+    """
+    changed = []
+    current = set()
+    for vehicle in vehicles:
+        key = vehicle_key(vehicle)
+        current.add(key)
+        fingerprint = vehicle_fingerprint(vehicle)
+        if sent.get(key) != fingerprint:
+            sent[key] = fingerprint
+            changed.append(vehicle)
+    removed = [key for key in sent if key not in current]
+    for key in removed:
+        sent.pop(key)
+    return {'changed': changed, 'removed': removed}
+
+
+def _settings_fingerprint(settings: Dict[str, Any]) -> str:
+    raw = f"{settings.get('api_key')}|{settings.get('company_code')}|{settings.get('api_url')}"
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+class GPSPositionCache:
+    """
+    Per-company Arvento position snapshots
+
+    - run(db): supervisor that starts, restarts (settings changed) and stops pollers
+    - get(db, company_id): latest snapshot with its age, from memory or Mongo
+    - ensure_poller(db, company_id): start a poller immediately (e.g. right
+      after GPS settings are saved) instead of waiting for the supervisor
+    """
+
+    def __init__(self, interval: float = GPS_POLL_INTERVAL, jitter: float = GPS_POLL_JITTER):
+        self.interval = interval
+        self.jitter = jitter
+        self._snapshots: Dict[str, Dict[str, Any]] = {}
+        self._pollers: Dict[str, Dict[str, Any]] = {}
+        self._prime_locks: Dict[str, asyncio.Lock] = {}
+        self._update_events: Dict[str, asyncio.Event] = {}
+        self._listeners: List[Callable[[Any, str, Dict[str, Any]], Awaitable[None]]] = []
+
+    async def ensure_indexes(self, db):
+        await db.gps_snapshots.create_index("company_id", unique=True)
+
+    def add_listener(self, listener: Callable[[Any, str, Dict[str, Any]], Awaitable[None]]):
+        """Call listener(db, company_id, snapshot) for every new Arvento snapshot"""
+        self._listeners.append(listener)
+
+    async def _poll_once(self, db, company_id: str, arvento: ArventoService) -> Dict[str, Any]:
+        result = await arvento.get_all_vehicles()
+        now = datetime.now(timezone.utc).isoformat()
+        previous = self._snapshots.get(company_id)
+
+        if result.get('source') != 'arvento_api':
+            # ArventoService answers upstream errors with mock data - keep the last real positions
+            error = result.get('message') or 'Arvento API yanıt vermedi'
+            if previous:
+                snapshot = {**previous, 'error': error, 'last_attempt': now}
+            else:
+                snapshot = {'company_id': company_id, 'vehicles': [], 'source': 'unavailable', 'fetched_at': None, 'error': error, 'last_attempt': now, 'version': 0}
+        else:
+            snapshot = {
+                'company_id': company_id,
+                'vehicles': result.get('vehicles', []),
+                'source': 'arvento_api',
+                'fetched_at': now,
+                'error': None,
+                'last_attempt': now,
+                'version': (previous or {}).get('version', 0) + 1
+            }
+
+        self._snapshots[company_id] = snapshot
+        if snapshot['version'] != (previous or {}).get('version'):
+            # Wake live streams waiting for this company
+            event = self._update_events.pop(company_id, None)
+            if event:
+                event.set()
+        await db.gps_snapshots.update_one({'company_id': company_id}, {'$set': dict(snapshot)}, upsert=True)
+        if snapshot['source'] == 'arvento_api' and snapshot['version'] != (previous or {}).get('version'):
+            for listener in self._listeners:
+                try:
+                    await listener(db, company_id, snapshot)
+                except Exception as e:
+                    logger.warning(f"[GPS-CACHE] Snapshot listener failed for {company_id}: {e}")
+        return snapshot
+
+    async def _poller(self, db, company_id: str, settings: Dict[str, Any]):
+        arvento = ArventoService(
+            api_key=settings.get('api_key'),
+            company_code=settings.get('company_code'),
+            api_url=settings.get('api_url')
+        )
+        # Spread the first polls of all companies over one interval
+        await asyncio.sleep(random.uniform(0, self.jitter))
+        while True:
+            try:
+                await self._poll_once(db, company_id, arvento)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"[GPS-CACHE] Poll failed for {company_id}: {e}")
+            await asyncio.sleep(self.interval + random.uniform(0, self.jitter))
+
+    def _start(self, db, company_id: str, settings: Dict[str, Any]):
+        self._stop(company_id)
+        self._pollers[company_id] = {
+            'task': asyncio.create_task(self._poller(db, company_id, settings)),
+            'fingerprint': _settings_fingerprint(settings),
+            'settings': settings
+        }
+        logger.info(f"[GPS-CACHE] Poller started for {company_id}")
+
+    def _stop(self, company_id: str):
+        poller = self._pollers.pop(company_id, None)
+        if poller:
+            poller['task'].cancel()
+            logger.info(f"[GPS-CACHE] Poller stopped for {company_id}")
+
+    async def sync_pollers(self, db):
+        """Match running pollers to the active Arvento integration settings"""
+        active = {
+            s['company_id']: s async for s in db.integration_settings.find(
+                {'type': 'arvento', 'is_active': True, 'api_key': {'$nin': [None, '']}, 'company_code': {'$nin': [None, '']}},
+                {'_id': 0}
+            )
+        }
+        for company_id in list(self._pollers):
+            if company_id not in active:
+                self._stop(company_id)
+                self._snapshots.pop(company_id, None)
+        for company_id, settings in active.items():
+            poller = self._pollers.get(company_id)
+            if not poller or poller['task'].done() or poller['fingerprint'] != _settings_fingerprint(settings):
+                self._start(db, company_id, settings)
+
+    async def ensure_poller(self, db, company_id: str):
+        settings = await db.integration_settings.find_one({'company_id': company_id, 'type': 'arvento'}, {'_id': 0})
+        if settings and settings.get('is_active') and settings.get('api_key') and settings.get('company_code'):
+            poller = self._pollers.get(company_id)
+            if not poller or poller['fingerprint'] != _settings_fingerprint(settings):
+                self._start(db, company_id, settings)
+        else:
+            self._stop(company_id)
+            self._snapshots.pop(company_id, None)
+
+    def has_poller(self, company_id: str) -> bool:
+        return company_id in self._pollers
+
+    async def prime(self, db, company_id: str) -> Optional[Dict[str, Any]]:
+        """First poll done inline for a company nobody has polled yet (one upstream call for concurrent callers)"""
+        poller = self._pollers.get(company_id)
+        if not poller:
+            return None
+        lock = self._prime_locks.setdefault(company_id, asyncio.Lock())
+        async with lock:
+            if company_id not in self._snapshots:
+                settings = poller['settings']
+                arvento = ArventoService(
+                    api_key=settings.get('api_key'),
+                    company_code=settings.get('company_code'),
+                    api_url=settings.get('api_url')
+                )
+                await self._poll_once(db, company_id, arvento)
+        return await self.get(db, company_id)
+
+    async def get(self, db, company_id: str) -> Optional[Dict[str, Any]]:
+        """Latest snapshot plus age_seconds (None when the company has never been polled)"""
+        snapshot = self._snapshots.get(company_id)
+        if snapshot is None:
+            snapshot = await db.gps_snapshots.find_one({'company_id': company_id}, {'_id': 0})
+            if snapshot is None:
+                return None
+            self._snapshots[company_id] = snapshot
+
+        age = None
+        if snapshot.get('fetched_at'):
+            fetched = datetime.fromisoformat(snapshot['fetched_at'])
+            age = round((datetime.now(timezone.utc) - fetched).total_seconds(), 1)
+        return {**snapshot, 'age_seconds': age, 'stale': age is None or age > 3 * (self.interval + self.jitter)}
+
+    async def wait_for_update(self, company_id: str, version: int, timeout: float) -> bool:
+        """Wait until the company's snapshot is newer than version; False on timeout"""
+        snapshot = self._snapshots.get(company_id)
+        if snapshot and snapshot.get('version', 0) > version:
+            return True
+        event = self._update_events.setdefault(company_id, asyncio.Event())
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    async def run(self, db):
+        """Supervisor loop"""
+        while True:
+            try:
+                await self.sync_pollers(db)
+            except Exception as e:
+                logger.warning(f"[GPS-CACHE] Supervisor refresh failed: {e}")
+            await asyncio.sleep(GPS_SUPERVISOR_INTERVAL)
+
+
+# Singleton instance
+gps_position_cache = GPSPositionCache()
@@ -4,14 +4,34 @@ Araç bazlı HGS etiket takibi, bakiye ve geçiş kayıtları
 
 NOT: Bu servis manuel takip içindir. 
 PTT HGS API entegrasyonu için ayrı modül gereklidir.
+
+Bakiye defteri (hgs_ledger):
+- Her bakiye hareketi (açılış, manuel güncelleme, geçiş) silinmeyen bir kayıt
+  olarak eklenir, etiket bakiyesi bu hareketlerin toplamıdır
+- Etiket bakiyesi atomik $inc ile güncellenir (find_one_and_update yeni
+  değeri döner), eşzamanlı geçiş kayıtlarında güncelleme kaybolmaz
 """
+import asyncio
 import logging
-from typing import Dict, List, Any, Optional
+import os
+from typing import Dict, Iterator, List, Any, Optional, Tuple
 from datetime import datetime, timezone
 from uuid import uuid4
 
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import DuplicateKeyError
+
+from .hgs_statement import normalize_tag_number
+
 logger = logging.getLogger(__name__)
 
+HGS_IMPORT_CHUNK = 1000
+# Import debit references kept on the tag to make re-applying a debit a no-op
+HGS_APPLIED_DEBITS_KEEP = 50
+TAG_PROJECTION = {'_id': 0, 'applied_debits': 0}
+# Keep per-company monthly passage totals in hgs_monthly_rollups for the summary
+HGS_SUMMARY_ROLLUP = os.environ.get('HGS_SUMMARY_ROLLUP', 'false').lower() == 'true'
+
 
 class HGSService:
     """
@@ -31,7 +51,57 @@ class HGSService:
         """Database bağlantısını ayarla"""
         self.db = db
     
-    async def add_hgs_tag(self, vehicle_id: str, tag_data: Dict[str, Any]) -> Dict[str, Any]:
+    async def ensure_indexes(self, db):
+        await db.hgs_tags.create_index('id')
+        await db.hgs_tags.create_index([('vehicle_id', 1), ('is_active', 1)])
+        await db.hgs_tags.create_index([('company_id', 1), ('tag_number', 1)])
+        await db.hgs_passages.create_index('id', unique=True)
+        await db.hgs_passages.create_index([('tag_id', 1), ('passage_time', -1)])
+        await db.hgs_passages.create_index([('company_id', 1), ('passage_time', -1)])
+        await db.hgs_passages.create_index([('company_id', 1), ('vehicle_id', 1), ('passage_time', -1)])
+        # Only imported passages carry 'debited' (False / claim ref / True)
+        await db.hgs_passages.create_index('debited', sparse=True)
+        await db.hgs_tags.create_index([('company_id', 1), ('is_active', 1)])
+        await db.hgs_monthly_rollups.create_index([('company_id', 1), ('month', 1)], unique=True)
+        await db.hgs_ledger.create_index([('tag_id', 1), ('created_at', -1)])
+        # One balance movement per passage, even if the same passage is applied twice
+        await db.hgs_ledger.create_index(
+            [('tag_id', 1), ('type', 1), ('ref_id', 1)],
+            unique=True,
+            partialFilterExpression={'ref_id': {'$type': 'string'}}
+        )
+    
+    @staticmethod
+    def _ledger_entry(tag: Dict[str, Any], entry_type: str, amount: float, balance_after: float,
+                      ref_id: Optional[str] = None, note: str = '', now: str = None) -> Dict[str, Any]:
+        """Bakiye hareketi (amount: işaretli değişim, geçişlerde negatif)"""
+        return {
+            'id': str(uuid4()),
+            'tag_id': tag.get('id'),
+            'vehicle_id': tag.get('vehicle_id'),
+            'company_id': tag.get('company_id'),
+            'type': entry_type,
+            'amount': round(amount, 2),
+            'balance_after': round(balance_after, 2),
+            'ref_id': ref_id,
+            'note': note,
+            'created_at': now or datetime.now(timezone.utc).isoformat()
+        }
+    
+    @staticmethod
+    def _balance_alert(tag: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """Düşük bakiye uyarısı (güncelleme sonrası etiket dokümanından)"""
+        balance = tag.get('balance', 0)
+        min_alert = tag.get('min_balance_alert', 50)
+        if balance < min_alert:
+            return {
+                'type': 'low_balance',
+                'message': f"HGS bakiyesi düşük: {balance:.2f} TL (Minimum: {min_alert:.2f} TL)",
+                'vehicle_plate': tag.get('vehicle_plate')
+            }
+        return None
+    
+    async def add_hgs_tag(self, vehicle_id: str, tag_data: Dict[str, Any], company_id: str = None) -> Dict[str, Any]:
         """
         Araca HGS etiketi ekle
         
@@ -47,9 +117,10 @@ class HGSService:
         
         tag_doc = {
             'id': tag_id,
+            'company_id': company_id,
             'vehicle_id': vehicle_id,
             'vehicle_plate': tag_data.get('vehicle_plate', ''),
-            'tag_number': tag_data.get('tag_number', ''),
+            'tag_number': normalize_tag_number(tag_data.get('tag_number', '')),
             'provider': tag_data.get('provider', 'PTT'),  # PTT, Banka, vb.
             'balance': tag_data.get('balance', 0.0),
             'min_balance_alert': tag_data.get('min_balance_alert', 50.0),
@@ -69,6 +140,10 @@ class HGSService:
             }
         
         await self.db.hgs_tags.insert_one(tag_doc)
+        if tag_doc['balance']:
+            await self.db.hgs_ledger.insert_one(
+                self._ledger_entry(tag_doc, 'opening', tag_doc['balance'], tag_doc['balance'], now=now)
+            )
         
         return {
             'success': True,
@@ -78,58 +153,65 @@ class HGSService:
     
     async def update_balance(self, tag_id: str, new_balance: float, note: str = '') -> Dict[str, Any]:
         """
-        HGS bakiyesini güncelle
+        HGS bakiyesini güncelle (manuel olarak okunan bakiyeyi ayarla)
         """
         if not self.db:
             return {'success': False, 'error': 'Database bağlantısı yok'}
         
         now = datetime.now(timezone.utc).isoformat()
         
-        tag = await self.db.hgs_tags.find_one({'id': tag_id})
-        if not tag:
-            return {'success': False, 'error': 'HGS etiketi bulunamadı'}
-        
-        old_balance = tag.get('balance', 0)
-        
-        # Update tag balance
-        await self.db.hgs_tags.update_one(
+        # Previous balance comes from the same atomic write, not a separate read
+        tag = await self.db.hgs_tags.find_one_and_update(
             {'id': tag_id},
             {'$set': {
                 'balance': new_balance,
                 'last_balance_update': now,
                 'updated_at': now
-            }}
+            }},
+            projection={'_id': 0},
+            return_document=ReturnDocument.BEFORE
         )
+        if not tag:
+            return {'success': False, 'error': 'HGS etiketi bulunamadı'}
         
-        # Create balance history record
-        history_doc = {
-            'id': str(uuid4()),
-            'tag_id': tag_id,
-            'vehicle_id': tag.get('vehicle_id'),
+        old_balance = tag.get('balance', 0)
+        await self.db.hgs_ledger.insert_one(
+            self._ledger_entry(tag, 'manual_update', new_balance - old_balance, new_balance, note=note, now=now)
+        )
+        
+        return {
+            'success': True,
             'old_balance': old_balance,
             'new_balance': new_balance,
-            'change': new_balance - old_balance,
-            'type': 'manual_update',
-            'note': note,
-            'created_at': now
+            'alert': self._balance_alert({**tag, 'balance': new_balance})
         }
-        await self.db.hgs_balance_history.insert_one(history_doc)
+    
+    async def top_up(self, tag_id: str, amount: float, note: str = '') -> Dict[str, Any]:
+        """
+        HGS bakiyesine yükleme yap (mevcut bakiyeye eklenir)
+        """
+        if not self.db:
+            return {'success': False, 'error': 'Database bağlantısı yok'}
         
-        # Check for low balance alert
-        alert = None
-        min_alert = tag.get('min_balance_alert', 50)
-        if new_balance < min_alert:
-            alert = {
-                'type': 'low_balance',
-                'message': f"HGS bakiyesi düşük: {new_balance:.2f} TL (Minimum: {min_alert:.2f} TL)",
-                'vehicle_plate': tag.get('vehicle_plate')
-            }
+        now = datetime.now(timezone.utc).isoformat()
+        tag = await self.db.hgs_tags.find_one_and_update(
+            {'id': tag_id},
+            {'$inc': {'balance': amount}, '$set': {'last_balance_update': now, 'updated_at': now}},
+            projection={'_id': 0},
+            return_document=ReturnDocument.AFTER
+        )
+        if not tag:
+            return {'success': False, 'error': 'HGS etiketi bulunamadı'}
+        
+        await self.db.hgs_ledger.insert_one(
+            self._ledger_entry(tag, 'top_up', amount, tag['balance'], note=note, now=now)
+        )
         
         return {
             'success': True,
-            'old_balance': old_balance,
-            'new_balance': new_balance,
-            'alert': alert
+            'old_balance': round(tag['balance'] - amount, 2),
+            'new_balance': tag['balance'],
+            'alert': self._balance_alert(tag)
         }
     
     async def add_passage(self, tag_id: str, passage_data: Dict[str, Any]) -> Dict[str, Any]:
@@ -140,48 +222,326 @@ class HGSService:
         - location: Geçiş noktası
         - amount: Geçiş ücreti
         - passage_time: Geçiş zamanı
+        
+        Optional:
+        - passage_id: Dış sistemdeki geçiş numarası (aynı geçiş iki kez düşülmez)
         """
         if not self.db:
             return {'success': False, 'error': 'Database bağlantısı yok'}
         
-        tag = await self.db.hgs_tags.find_one({'id': tag_id})
+        amount = passage_data.get('amount', 0.0)
+        external_id = passage_data.get('passage_id')
+        now = datetime.now(timezone.utc).isoformat()
+        
+        # Debit first: the returned document is both the tag lookup and the new balance
+        tag = await self.db.hgs_tags.find_one_and_update(
+            {'id': tag_id},
+            {'$inc': {'balance': -amount}, '$set': {'updated_at': now}},
+            projection={'_id': 0},
+            return_document=ReturnDocument.AFTER
+        )
         if not tag:
             return {'success': False, 'error': 'HGS etiketi bulunamadı'}
         
-        passage_id = str(uuid4())
-        now = datetime.now(timezone.utc).isoformat()
-        
+        # External passage numbers are only unique per provider account - scope them to the company
+        passage_id = f"{tag.get('company_id')}:{external_id}" if external_id else str(uuid4())
         passage_doc = {
             'id': passage_id,
+            'external_id': external_id,
             'tag_id': tag_id,
             'vehicle_id': tag.get('vehicle_id'),
             'vehicle_plate': tag.get('vehicle_plate'),
+            'company_id': tag.get('company_id'),
             'location': passage_data.get('location', ''),
-            'amount': passage_data.get('amount', 0.0),
+            'amount': amount,
             'passage_time': passage_data.get('passage_time', now),
             'direction': passage_data.get('direction', ''),  # Giriş/Çıkış
             'note': passage_data.get('note', ''),
             'created_at': now
         }
         
-        await self.db.hgs_passages.insert_one(passage_doc)
+        try:
+            await self.db.hgs_passages.insert_one(passage_doc)
+        except DuplicateKeyError:
+            # Already recorded - undo this debit
+            tag = await self.db.hgs_tags.find_one_and_update(
+                {'id': tag_id},
+                {'$inc': {'balance': amount}},
+                projection={'_id': 0},
+                return_document=ReturnDocument.AFTER
+            )
+            return {
+                'success': True,
+                'duplicate': True,
+                'passage_id': passage_id,
+                'new_balance': tag.get('balance') if tag else None
+            }
         
-        # Update balance
-        new_balance = tag.get('balance', 0) - passage_data.get('amount', 0)
-        await self.db.hgs_tags.update_one(
-            {'id': tag_id},
-            {'$set': {
-                'balance': new_balance,
-                'updated_at': now
-            }}
+        await self.db.hgs_ledger.insert_one(
+            self._ledger_entry(tag, 'passage', -amount, tag['balance'], ref_id=passage_id, now=now)
         )
+        await self._bump_rollups(tag.get('company_id'), {passage_doc['passage_time'][:7]: (1, amount)}, now)
         
         return {
             'success': True,
             'passage_id': passage_id,
-            'new_balance': new_balance
+            'new_balance': tag['balance'],
+            'alert': self._balance_alert(tag)
+        }
+    
+    async def backfill_company_ids(self, db) -> int:
+        """
+        Eski etiketlere araçtan company_id ata (etiketler önceden firmasız kaydediliyordu)
+        """
+        updated = 0
+        # Etiket numaraları ekstre eşleşmesi için boşluksuz saklanır
+        async for tag in db.hgs_tags.find({'tag_number': {'$regex': r'\s'}}, {'_id': 0, 'id': 1, 'tag_number': 1}):
+            await db.hgs_tags.update_one(
+                {'id': tag['id']}, {'$set': {'tag_number': normalize_tag_number(tag['tag_number'])}}
+            )
+            updated += 1
+        async for tag in db.hgs_tags.find({'company_id': {'$in': [None, '']}}, {'_id': 0, 'id': 1, 'vehicle_id': 1}):
+            vehicle = await db.vehicles.find_one({'id': tag.get('vehicle_id')}, {'_id': 0, 'company_id': 1})
+            if vehicle and vehicle.get('company_id'):
+                await db.hgs_tags.update_one({'id': tag['id']}, {'$set': {'company_id': vehicle['company_id']}})
+                await db.hgs_passages.update_many({'tag_id': tag['id']}, {'$set': {'company_id': vehicle['company_id']}})
+                await db.hgs_ledger.update_many({'tag_id': tag['id']}, {'$set': {'company_id': vehicle['company_id']}})
+                updated += 1
+        if updated:
+            logger.info(f"[HGS] company_id / tag_number fixed on {updated} legacy tag(s)")
+        return updated
+    
+    async def _resolve_tags(self, company_id: str, rows: List[Dict[str, Any]], cache: Dict[str, Optional[Dict[str, Any]]]):
+        """Etiket no / plaka -> etiket, bilinmeyenler için tek $in sorgusu"""
+        tag_numbers = {r['tag_number'] for r in rows if r['tag_number'] and ('tag:' + r['tag_number']) not in cache}
+        plates = {r['vehicle_plate'] for r in rows if r['vehicle_plate'] and ('plate:' + _plate_key(r['vehicle_plate'])) not in cache}
+        if not tag_numbers and not plates:
+            return
+        
+        plate_variants = set()
+        for plate in plates:
+            plate_variants.update({plate, plate.upper(), _plate_key(plate)})
+        tags = self.db.hgs_tags.find(
+            {
+                'company_id': company_id,
+                'is_active': True,
+                '$or': [{'tag_number': {'$in': list(tag_numbers)}}, {'vehicle_plate': {'$in': list(plate_variants)}}]
+            },
+            {'_id': 0}
+        )
+        async for tag in tags:
+            cache['tag:' + normalize_tag_number(tag.get('tag_number'))] = tag
+            cache['plate:' + _plate_key(tag.get('vehicle_plate'))] = tag
+        for number in tag_numbers:
+            cache.setdefault('tag:' + number, None)
+        for plate in plates:
+            cache.setdefault('plate:' + _plate_key(plate), None)
+    
+    async def _import_chunk(self, company_id: str, import_id: str, chunk: List[Dict[str, Any]],
+                            tags: Dict[str, Optional[Dict[str, Any]]], balances: Dict[str, Dict[str, Any]],
+                            stats: Dict[str, Any]):
+        """
+        Parçanın geçişlerini `debited: False` olarak yaz ve hemen düş; aktarım
+        yarıda kesilirse kalanlar settle_pending_debits ile düşülür
+        """
+        await self._resolve_tags(company_id, chunk, tags)
+        now = datetime.now(timezone.utc).isoformat()
+        
+        operations, passages = [], []
+        for row in chunk:
+            tag = (tags.get('tag:' + row['tag_number']) if row['tag_number'] else None) \
+                or (tags.get('plate:' + _plate_key(row['vehicle_plate'])) if row['vehicle_plate'] else None)
+            if not tag:
+                stats['unmatched'] += 1
+                if len(stats['unmatched_samples']) < 20:
+                    stats['unmatched_samples'].append(row['tag_number'] or row['vehicle_plate'])
+                continue
+            passage_id = f"{company_id}:{row['passage_id']}"
+            passage_doc = {
+                'id': passage_id,
+                'external_id': row['passage_id'],
+                'tag_id': tag['id'],
+                'vehicle_id': tag.get('vehicle_id'),
+                'vehicle_plate': tag.get('vehicle_plate'),
+                'company_id': company_id,
+                'location': row['location'],
+                'amount': row['amount'],
+                'passage_time': row['passage_time'] or now,
+                'direction': row['direction'],
+                'note': '',
+                'import_id': import_id,
+                'debited': False,
+                'created_at': now
+            }
+            # Upsert on id: existing passages are left untouched and not debited again
+            operations.append(UpdateOne({'id': passage_id}, {'$setOnInsert': passage_doc}, upsert=True))
+            passages.append(passage_doc)
+        
+        if not operations:
+            return
+        result = await self.db.hgs_passages.bulk_write(operations, ordered=False)
+        stats['inserted'] += len(result.upserted_ids)
+        stats['duplicates'] += len(operations) - len(result.upserted_ids)
+        by_tag: Dict[str, List[str]] = {}
+        months: Dict[str, tuple] = {}
+        for index in result.upserted_ids:
+            passage = passages[index]
+            by_tag.setdefault(passage['tag_id'], []).append(passage['id'])
+            count, total = months.get(passage['passage_time'][:7], (0, 0.0))
+            months[passage['passage_time'][:7]] = (count + 1, total + passage['amount'])
+        
+        applied = await asyncio.gather(*(self._debit_passages(tag_id, ids) for tag_id, ids in by_tag.items()))
+        await self._bump_rollups(company_id, months, now)
+        for tag_result in applied:
+            if not tag_result:
+                continue
+            summary = balances.setdefault(tag_result['tag_id'], {**tag_result, 'passages': 0, 'amount': 0.0})
+            summary.update({k: v for k, v in tag_result.items() if k not in ('passages', 'amount')})
+            summary['passages'] += tag_result.get('passages', 0)
+            summary['amount'] = round(summary['amount'] + tag_result.get('amount', 0.0), 2)
+    
+    async def _debit_passages(self, tag_id: str, passage_ids: List[str]) -> Optional[Dict[str, Any]]:
+        """Henüz düşülmemiş geçişleri yeni bir düşüm referansıyla sahiplen ve düş"""
+        debit_ref = str(uuid4())
+        await self.db.hgs_passages.update_many(
+            {'id': {'$in': passage_ids}, 'debited': False},
+            {'$set': {'debited': debit_ref}}
+        )
+        return await self._apply_debit(tag_id, debit_ref)
+    
+    async def _apply_debit(self, tag_id: str, debit_ref: str) -> Optional[Dict[str, Any]]:
+        """
+        `debited: debit_ref` olan geçişlerin toplamını etiketten düş.
+        Referans etiket üzerinde aynı güncellemeyle saklanır (applied_debits),
+        yarıda kalan bir düşüm tekrar çalıştırıldığında bakiye iki kez düşülmez.
+        """
+        totals = await self.db.hgs_passages.aggregate([
+            {'$match': {'debited': debit_ref}},
+            {'$group': {'_id': None, 'passages': {'$sum': 1}, 'amount': {'$sum': '$amount'}}}
+        ]).to_list(1)
+        if not totals:
+            return None
+        amount = round(totals[0]['amount'], 2)
+        now = datetime.now(timezone.utc).isoformat()
+        
+        tag = await self.db.hgs_tags.find_one_and_update(
+            {'id': tag_id, 'applied_debits': {'$ne': debit_ref}},
+            {
+                '$inc': {'balance': -amount},
+                '$set': {'updated_at': now},
+                '$push': {'applied_debits': {'$each': [debit_ref], '$slice': -HGS_APPLIED_DEBITS_KEEP}}
+            },
+            projection=TAG_PROJECTION,
+            return_document=ReturnDocument.AFTER
+        ) or await self.db.hgs_tags.find_one({'id': tag_id}, TAG_PROJECTION)
+        if not tag:
+            logger.error(f"[HGS] Debit {debit_ref}: tag {tag_id} not found")
+            return {'tag_id': tag_id, 'error': 'HGS etiketi bulunamadı'}
+        try:
+            await self.db.hgs_ledger.insert_one(self._ledger_entry(
+                tag, 'import', -amount, tag['balance'], ref_id=debit_ref,
+                note=f"{totals[0]['passages']} geçiş içe aktarıldı", now=now
+            ))
+        except DuplicateKeyError:
+            pass
+        await self.db.hgs_passages.update_many({'debited': debit_ref}, {'$set': {'debited': True}})
+        return {
+            'tag_id': tag['id'],
+            'vehicle_plate': tag.get('vehicle_plate'),
+            'passages': totals[0]['passages'],
+            'amount': amount,
+            'new_balance': tag['balance'],
+            'alert': self._balance_alert(tag)
+        }
+    
+    async def settle_pending_debits(self, company_id: Optional[str] = None) -> int:
+        """
+        Yarıda kalan aktarımların geçişlerini düş: hiç sahiplenilmemiş
+        (`debited: False`) ve sahiplenilip tamamlanmamış (`debited: <ref>`) geçişler
+        """
+        if not self.db:
+            return 0
+        scope = {'company_id': company_id} if company_id else {}
+        settled = 0
+        claimed = await self.db.hgs_passages.aggregate([
+            {'$match': {**scope, 'debited': {'$type': 'string'}}},
+            {'$group': {'_id': {'tag_id': '$tag_id', 'ref': '$debited'}}}
+        ]).to_list(None)
+        for group in claimed:
+            if await self._apply_debit(group['_id']['tag_id'], group['_id']['ref']):
+                settled += 1
+        unclaimed = await self.db.hgs_passages.aggregate([
+            {'$match': {**scope, 'debited': False}},
+            {'$group': {'_id': '$tag_id', 'ids': {'$push': '$id'}}}
+        ]).to_list(None)
+        for group in unclaimed:
+            if await self._debit_passages(group['_id'], group['ids']):
+                settled += 1
+        if settled:
+            logger.warning(f"[HGS] Settled {settled} pending import debit(s)")
+        return settled
+    
+    async def import_passages(self, company_id: str, rows: Iterator[Tuple[int, Optional[Dict[str, Any]], Optional[str]]],
+                              chunk_size: int = HGS_IMPORT_CHUNK) -> Dict[str, Any]:
+        """
+        Ekstreden toplu geçiş aktarımı
+        
+        rows: iter_statement_rows çıktısı (satır no, satır, hata)
+        - Etiketler parça başına tek $in sorgusuyla bulunur
+        - Geçişler id üzerinden upsert edilir (aynı ekstre tekrar yüklenirse düşülmez)
+        - Her parçadan sonra bakiye etiket başına toplam tutar kadar tek $inc ile
+          güncellenir (iade satırları negatif tutarla bakiyeye geri eklenir)
+        - Önceki yarıda kalmış aktarımların düşülmemiş geçişleri önce düşülür
+        """
+        if not self.db:
+            return {'success': False, 'error': 'Database bağlantısı yok'}
+        
+        await self.settle_pending_debits(company_id)
+        import_id = str(uuid4())
+        stats = {'rows': 0, 'inserted': 0, 'duplicates': 0, 'unmatched': 0, 'unmatched_samples': [], 'errors': []}
+        tags: Dict[str, Optional[Dict[str, Any]]] = {}
+        balances: Dict[str, Dict[str, Any]] = {}
+        seen = set()
+        chunk: List[Dict[str, Any]] = []
+        
+        for line_number, row, error in rows:
+            stats['rows'] += 1
+            if error:
+                if len(stats['errors']) < 50:
+                    stats['errors'].append({'line': line_number, 'error': error})
+                continue
+            if row['passage_id'] in seen:
+                stats['duplicates'] += 1
+                continue
+            seen.add(row['passage_id'])
+            chunk.append(row)
+            if len(chunk) >= chunk_size:
+                await self._import_chunk(company_id, import_id, chunk, tags, balances, stats)
+                chunk = []
+        if chunk:
+            await self._import_chunk(company_id, import_id, chunk, tags, balances, stats)
+        
+        return {
+            'success': True,
+            'import_id': import_id,
+            **stats,
+            'tags': list(balances.values())
         }
     
+    async def get_ledger(self, tag_id: str, limit: int = 100, company_id: str = None) -> List[Dict[str, Any]]:
+        """
+        Etiketin bakiye hareketleri (en yeni önce)
+        """
+        if not self.db:
+            return []
+        
+        query = {'tag_id': tag_id}
+        if company_id:
+            query['company_id'] = company_id
+        return await self.db.hgs_ledger.find(
+            query, {'_id': 0}
+        ).sort('created_at', -1).limit(limit).to_list(limit)
+    
     async def get_vehicle_hgs(self, vehicle_id: str) -> Dict[str, Any]:
         """
         Araç HGS bilgisini getir
@@ -191,7 +551,7 @@ class HGSService:
         
         tag = await self.db.hgs_tags.find_one(
             {'vehicle_id': vehicle_id, 'is_active': True},
-            {'_id': 0}
+            TAG_PROJECTION
         )
         
         if not tag:
@@ -225,7 +585,7 @@ class HGSService:
         if company_id:
             query['company_id'] = company_id
         
-        tags = await self.db.hgs_tags.find(query, {'_id': 0}).to_list(1000)
+        tags = await self.db.hgs_tags.find(query, TAG_PROJECTION).to_list(1000)
         
         # Add alert status
         for tag in tags:
@@ -236,7 +596,7 @@ class HGSService:
     
     async def get_passages(self, tag_id: str = None, vehicle_id: str = None, 
                           start_date: str = None, end_date: str = None,
-                          limit: int = 100) -> List[Dict[str, Any]]:
+                          limit: int = 100, company_id: str = None) -> List[Dict[str, Any]]:
         """
         Geçiş kayıtlarını listele
         """
@@ -244,6 +604,8 @@ class HGSService:
             return []
         
         query = {}
+        if company_id:
+            query['company_id'] = company_id
         if tag_id:
             query['tag_id'] = tag_id
         if vehicle_id:
@@ -262,37 +624,133 @@ class HGSService:
         
         return passages
     
+    async def _bump_rollups(self, company_id: Optional[str], months: Dict[str, tuple], created_at: str):
+        """
+        Aylık geçiş toplamlarını artır (yalnızca daha önce hesaplanmış aylar).
+        created_at: geçişlerin created_at değeri; rollup'ın kesim anından önce
+        oluşturulan geçişler zaten hesaplamaya dahildir, tekrar eklenmez.
+        """
+        if not HGS_SUMMARY_ROLLUP or not company_id or not months:
+            return
+        # Months without a rollup yet are computed from hgs_passages on first read
+        await self.db.hgs_monthly_rollups.bulk_write([
+            UpdateOne(
+                {'company_id': company_id, 'month': month, '$or': [
+                    {'cutoff': {'$exists': False}},
+                    {'cutoff': {'$lte': created_at}}
+                ]},
+                {'$inc': {'passages': count, 'amount': round(amount, 2)}}
+            )
+            for month, (count, amount) in months.items()
+        ], ordered=False)
+    
+    async def _month_totals(self, company_id: str, month: str, created_before: Optional[str] = None) -> Dict[str, Any]:
+        match = {'company_id': company_id, 'passage_time': {'$gte': f'{month}-01', '$lt': _next_month(month) + '-01'}}
+        if created_before:
+            match['created_at'] = {'$lt': created_before}
+        totals = await self.db.hgs_passages.aggregate([
+            {'$match': match},
+            {'$group': {'_id': None, 'passages': {'$sum': 1}, 'amount': {'$sum': '$amount'}}}
+        ]).to_list(1)
+        return {
+            'passages': totals[0]['passages'] if totals else 0,
+            'amount': round(totals[0]['amount'], 2) if totals else 0.0
+        }
+    
+    async def _month_rollup(self, company_id: str, month: str) -> Dict[str, Any]:
+        """
+        Aylık toplam; ilk okumada hesaplanır. Boş rollup önce eklenir, böylece
+        hesaplama sürerken gelen geçişler $inc ile ona yazılır; hesaplama yalnızca
+        bu kesim anından önce oluşturulan geçişleri sayar.
+        """
+        rollup = await self.db.hgs_monthly_rollups.find_one({'company_id': company_id, 'month': month}, {'_id': 0})
+        if rollup and rollup.get('built_at'):
+            return rollup
+        if rollup:
+            # Another request is still building it
+            return {'company_id': company_id, 'month': month, **await self._month_totals(company_id, month)}
+        
+        cutoff = datetime.now(timezone.utc).isoformat()
+        try:
+            result = await self.db.hgs_monthly_rollups.update_one(
+                {'company_id': company_id, 'month': month},
+                {'$setOnInsert': {'company_id': company_id, 'month': month, 'passages': 0, 'amount': 0.0, 'cutoff': cutoff}},
+                upsert=True
+            )
+            inserted = result.upserted_id is not None
+        except DuplicateKeyError:
+            inserted = False
+        if not inserted:
+            return await self._month_rollup(company_id, month)
+        
+        totals = await self._month_totals(company_id, month, created_before=cutoff)
+        return await self.db.hgs_monthly_rollups.find_one_and_update(
+            {'company_id': company_id, 'month': month},
+            {'$inc': totals, '$set': {'built_at': datetime.now(timezone.utc).isoformat()}},
+            projection={'_id': 0},
+            return_document=ReturnDocument.AFTER
+        )
+    
     async def get_summary(self, company_id: str = None) -> Dict[str, Any]:
         """
-        HGS özet bilgisi
+        HGS özet bilgisi (firma bazlı, tek aggregation)
         """
+        empty = {
+            'total_tags': 0,
+            'total_balance': 0,
+            'low_balance_count': 0,
+            'total_passages_this_month': 0,
+            'total_amount_this_month': 0
+        }
         if not self.db:
-            return {
-                'total_tags': 0,
-                'total_balance': 0,
-                'low_balance_count': 0,
-                'total_passages_this_month': 0
-            }
-        
-        tags = await self.get_all_tags(company_id)
-        
-        total_balance = sum(t.get('balance', 0) for t in tags)
-        low_balance = sum(1 for t in tags if t.get('low_balance'))
-        
-        # This month passages
-        from datetime import datetime
-        now = datetime.now()
-        month_start = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0).isoformat()
-        
-        passages_count = await self.db.hgs_passages.count_documents({
-            'passage_time': {'$gte': month_start}
-        })
+            return empty
+        
+        month = datetime.now(timezone.utc).strftime('%Y-%m')
+        month_start = f'{month}-01'
+        
+        pipeline = [
+            {'$match': {'company_id': company_id, 'is_active': True}},
+            {'$group': {
+                '_id': None,
+                'total_tags': {'$sum': 1},
+                'total_balance': {'$sum': {'$ifNull': ['$balance', 0]}},
+                'low_balance_count': {'$sum': {'$cond': [
+                    {'$lt': [{'$ifNull': ['$balance', 0]}, {'$ifNull': ['$min_balance_alert', 50]}]}, 1, 0
+                ]}}
+            }}
+        ]
+        if not HGS_SUMMARY_ROLLUP:
+            # Month totals from the (company_id, passage_time) index in the same round trip
+            pipeline.append({'$lookup': {
+                'from': 'hgs_passages',
+                'pipeline': [
+                    {'$match': {'company_id': company_id, 'passage_time': {'$gte': month_start}}},
+                    {'$group': {'_id': None, 'count': {'$sum': 1}, 'amount': {'$sum': '$amount'}}}
+                ],
+                'as': 'month'
+            }})
+        
+        result = await self.db.hgs_tags.aggregate(pipeline).to_list(1)
+        
+        if HGS_SUMMARY_ROLLUP:
+            rollup = await self._month_rollup(company_id, month)
+            passages, amount = rollup.get('passages', 0), rollup.get('amount', 0)
+        elif result:
+            month_totals = result[0]['month'][0] if result[0]['month'] else {}
+            passages, amount = month_totals.get('count', 0), month_totals.get('amount', 0)
+        else:
+            # No active tags, but passages of deleted tags still count for the month
+            month_totals = await self._month_totals(company_id, month)
+            passages, amount = month_totals['passages'], month_totals['amount']
+        
+        totals = result[0] if result else empty
         
         return {
-            'total_tags': len(tags),
-            'total_balance': round(total_balance, 2),
-            'low_balance_count': low_balance,
-            'total_passages_this_month': passages_count
+            'total_tags': totals['total_tags'],
+            'total_balance': round(totals['total_balance'], 2),
+            'low_balance_count': totals['low_balance_count'],
+            'total_passages_this_month': passages,
+            'total_amount_this_month': round(amount, 2)
         }
     
     async def delete_tag(self, tag_id: str) -> Dict[str, Any]:
@@ -316,5 +774,14 @@ class HGSService:
         }
 
 
+def _plate_key(plate: Optional[str]) -> str:
+    return (plate or '').replace(' ', '').upper()
+
+
+def _next_month(month: str) -> str:
+    year, number = int(month[:4]), int(month[5:7])
+    return f'{year + 1}-01' if number == 12 else f'{year}-{number + 1:02d}'
+
+
 # Singleton instance
 hgs_service = HGSService()
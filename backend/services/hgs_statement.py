@@ -0,0 +1,144 @@
+"""
+HGS Statement Parser
+Streams passage rows out of CSV toll statements (PTT / bank HGS exports or
+our own template) without loading the whole file.
+
+- Delimiter (; , or tab) is detected from the header line
+- Header names are matched against Turkish and English aliases
+- Turkish number (1.234,50) and date (31.01.2026 14:05) formats are accepted;
+  times without an offset are taken as Turkey time
+"""
+import csv
+import hashlib
+import io
+import re
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, IO, Iterator, List, Optional, Tuple
+
+# Turkey has been on UTC+3 all year since 2016
+TURKEY_TZ = timezone(timedelta(hours=3))
+
+COLUMN_ALIASES = {
+    'passage_id': ('passage_id', 'gecis_no', 'geçiş_no', 'islem_no', 'işlem_no', 'transaction_id', 'referans_no'),
+    'tag_number': ('tag_number', 'etiket_no', 'hgs_no', 'etiket', 'urun_no', 'ürün_no'),
+    'vehicle_plate': ('vehicle_plate', 'plaka', 'plate'),
+    'amount': ('amount', 'tutar', 'ucret', 'ücret', 'gecis_ucreti', 'geçiş_ücreti'),
+    'passage_time': ('passage_time', 'gecis_tarihi', 'geçiş_tarihi', 'tarih', 'date', 'islem_tarihi', 'işlem_tarihi'),
+    'location': ('location', 'gecis_noktasi', 'geçiş_noktası', 'istasyon', 'lokasyon', 'giris', 'giriş'),
+    'direction': ('direction', 'yon', 'yön', 'cikis', 'çıkış')
+}
+
+DATE_FORMATS = ('%d.%m.%Y %H:%M:%S', '%d.%m.%Y %H:%M', '%d/%m/%Y %H:%M:%S', '%d/%m/%Y %H:%M', '%d.%m.%Y')
+
+
+class StatementError(ValueError):
+    """The file cannot be read as a passage statement"""
+
+
+def _header_key(name: str) -> str:
+    return re.sub(r'[\s\-]+', '_', name.strip().lower())
+
+
+def map_columns(header: List[str]) -> Dict[str, int]:
+    """Field name -> column index"""
+    keys = [_header_key(h) for h in header]
+    columns = {}
+    for field, aliases in COLUMN_ALIASES.items():
+        for alias in aliases:
+            if alias in keys:
+                columns[field] = keys.index(alias)
+                break
+    if 'amount' not in columns or not ({'tag_number', 'vehicle_plate'} & columns.keys()):
+        raise StatementError('Dosyada tutar ve etiket no / plaka sütunları bulunamadı')
+    return columns
+
+
+def parse_amount(value: str) -> float:
+    value = value.strip().replace('TL', '').replace('₺', '').replace(' ', '')
+    if ',' in value and value.rfind(',') > value.rfind('.'):
+        # Turkish format: thousands '.', decimals ','
+        value = value.replace('.', '').replace(',', '.')
+    else:
+        # English format (1,234.50): ',' only separates thousands
+        value = value.replace(',', '')
+    # Sign is kept: refund / cancellation rows are negative and credit the tag
+    return float(value)
+
+
+def parse_passage_time(value: str) -> str:
+    value = value.strip()
+    try:
+        parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except ValueError:
+        for fmt in DATE_FORMATS:
+            try:
+                parsed = datetime.strptime(value, fmt)
+                break
+            except ValueError:
+                continue
+        else:
+            raise ValueError(f'Tarih okunamadı: {value}')
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=TURKEY_TZ)
+    return parsed.astimezone(timezone.utc).isoformat()
+
+
+def normalize_tag_number(value: Optional[str]) -> str:
+    return re.sub(r'\s+', '', value or '')
+
+
+def passage_fingerprint(row: Dict[str, Any], occurrence: int = 1) -> str:
+    """
+    Stable id for statements without a passage number, so re-imports are idempotent.
+    occurrence numbers identical rows within one statement (same plate, amount and
+    no date/location column), so they stay separate passages.
+    """
+    raw = '|'.join(str(row.get(k) or '') for k in ('tag_number', 'vehicle_plate', 'passage_time', 'amount', 'location'))
+    if occurrence > 1:
+        raw += f'|{occurrence}'
+    return 'stmt-' + hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+
+def iter_statement_rows(stream: IO[bytes], encoding: str = 'utf-8-sig') -> Iterator[Tuple[int, Optional[Dict[str, Any]], Optional[str]]]:
+    """
+    Yield (line_number, row, error) for every data line of a binary CSV stream.
+    Exactly one of row / error is set.
+    """
+    text = io.TextIOWrapper(stream, encoding=encoding, errors='replace', newline='')
+    header_line = text.readline()
+    if not header_line.strip():
+        raise StatementError('Dosya boş')
+    delimiter = max((';', ',', '\t'), key=header_line.count)
+    columns = map_columns(next(csv.reader([header_line], delimiter=delimiter)))
+    occurrences: Dict[str, int] = {}
+
+    for line_number, values in enumerate(csv.reader(text, delimiter=delimiter), start=2):
+        if not any(v.strip() for v in values):
+            continue
+
+        def cell(field: str) -> str:
+            index = columns.get(field)
+            return values[index].strip() if index is not None and index < len(values) else ''
+
+        try:
+            row = {
+                'tag_number': normalize_tag_number(cell('tag_number')),
+                'vehicle_plate': cell('vehicle_plate'),
+                'amount': parse_amount(cell('amount')),
+                'passage_time': parse_passage_time(cell('passage_time')) if cell('passage_time') else None,
+                'location': cell('location'),
+                'direction': cell('direction')
+            }
+        except ValueError as e:
+            yield line_number, None, str(e)
+            continue
+        if not row['tag_number'] and not row['vehicle_plate']:
+            yield line_number, None, 'Etiket no veya plaka yok'
+            continue
+        if cell('passage_id'):
+            row['passage_id'] = cell('passage_id')
+        else:
+            fingerprint = passage_fingerprint(row)
+            occurrences[fingerprint] = occurrences.get(fingerprint, 0) + 1
+            row['passage_id'] = passage_fingerprint(row, occurrences[fingerprint])
+        yield line_number, row, None
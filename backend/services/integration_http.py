@@ -0,0 +1,229 @@
+"""
+Integration HTTP Layer
+Shared HTTP clients for external providers (Arvento, KABİS, iyzico).
+
+- One pooled keep-alive httpx client per provider instead of one per call
+- Circuit breaker per provider host: after repeated failures calls fail
+  immediately with CircuitOpenError (callers serve their fallback) until a
+  trial call succeeds again
+- Retries with jittered exponential backoff for idempotent calls
+- Per-provider request, error and latency metrics
+"""
+import asyncio
+import logging
+import math
+import os
+import random
+import time
+from collections import deque
+from typing import Any, Dict, Optional
+from urllib.parse import urlsplit
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+INTEGRATION_FAILURE_THRESHOLD = int(os.environ.get('INTEGRATION_FAILURE_THRESHOLD', '5'))
+INTEGRATION_RESET_TIMEOUT = float(os.environ.get('INTEGRATION_RESET_TIMEOUT', '30'))
+INTEGRATION_RETRIES = int(os.environ.get('INTEGRATION_RETRIES', '2'))
+INTEGRATION_BACKOFF_BASE = float(os.environ.get('INTEGRATION_BACKOFF_BASE', '0.3'))
+INTEGRATION_MAX_CONNECTIONS = int(os.environ.get('INTEGRATION_MAX_CONNECTIONS', '20'))
+INTEGRATION_LATENCY_WINDOW = 200
+
+# Per-provider request timeout in seconds (INTEGRATION_<NAME>_TIMEOUT overrides)
+PROVIDER_TIMEOUTS = {
+    'arvento': 10.0,
+    'kabis': 15.0,
+    'iyzico': 20.0
+}
+
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS', 'DELETE')
+
+
+class CircuitOpenError(Exception):
+    """Raised without calling the provider while its circuit is open"""
+
+
+class CircuitBreaker:
+    """closed -> open after threshold consecutive failures -> half-open after reset_timeout"""
+
+    def __init__(self, threshold: int = INTEGRATION_FAILURE_THRESHOLD, reset_timeout: float = INTEGRATION_RESET_TIMEOUT):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.trial_in_flight = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return 'half_open'
+        return 'open'
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == 'closed':
+            return True
+        if state == 'half_open' and not self.trial_in_flight:
+            self.trial_in_flight = True
+            return True
+        return False
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+
+    def record_failure(self) -> bool:
+        """Returns True when this failure opened the circuit"""
+        self.failures += 1
+        was_open = self.opened_at is not None
+        if self.trial_in_flight or self.failures >= self.threshold:
+            self.opened_at = time.monotonic()
+            self.trial_in_flight = False
+            return not was_open
+        return False
+
+
+class ProviderClient:
+    """Pooled client, circuit breakers (per host) and metrics for one provider"""
+
+    def __init__(self, name: str, timeout: float, retries: int = INTEGRATION_RETRIES):
+        self.name = name
+        self.timeout = timeout
+        self.retries = retries
+        self._client: Optional[httpx.AsyncClient] = None
+        self._breakers: Dict[str, CircuitBreaker] = {}
+        self._latencies = deque(maxlen=INTEGRATION_LATENCY_WINDOW)
+        self.stats = {'requests': 0, 'errors': 0, 'retries': 0, 'short_circuited': 0, 'circuit_opened': 0}
+        self.last_error: Optional[str] = None
+
+    def _get_client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                timeout=httpx.Timeout(self.timeout, connect=min(5.0, self.timeout)),
+                limits=httpx.Limits(max_connections=INTEGRATION_MAX_CONNECTIONS, max_keepalive_connections=INTEGRATION_MAX_CONNECTIONS)
+            )
+        return self._client
+
+    def _breaker(self, url: str) -> CircuitBreaker:
+        host = urlsplit(url).netloc
+        return self._breakers.setdefault(host, CircuitBreaker())
+
+    @staticmethod
+    def _is_failure(response: httpx.Response) -> bool:
+        # 4xx are caller/credential problems - the upstream itself is fine
+        return response.status_code >= 500 or response.status_code == 429
+
+    async def request(self, method: str, url: str, retry: Optional[bool] = None, **kwargs) -> httpx.Response:
+        """
+        Send a request through the breaker.
+
+        Args:
+            retry: Retry transport errors / 5xx (default: only for idempotent methods)
+
+        Raises:
+            CircuitOpenError: the provider host is failing, nothing was sent
+            httpx.HTTPError: the last attempt failed at transport level
+        """
+        breaker = self._breaker(url)
+        attempts = 1 + (self.retries if (retry if retry is not None else method.upper() in IDEMPOTENT_METHODS) else 0)
+
+        for attempt in range(attempts):
+            if not breaker.allow():
+                self.stats['short_circuited'] += 1
+                raise CircuitOpenError(f"{self.name} circuit open for {urlsplit(url).netloc}")
+
+            self.stats['requests'] += 1
+            started = time.monotonic()
+            error: Optional[Exception] = None
+            response: Optional[httpx.Response] = None
+            try:
+                response = await self._get_client().request(method, url, **kwargs)
+            except httpx.HTTPError as e:
+                error = e
+            except BaseException:
+                # Cancelled or non-transport error - do not leave a half-open trial hanging
+                breaker.trial_in_flight = False
+                raise
+            self._latencies.append((time.monotonic() - started) * 1000)
+
+            if error is None and not self._is_failure(response):
+                breaker.record_success()
+                return response
+
+            self.stats['errors'] += 1
+            self.last_error = str(error) if error else f"HTTP {response.status_code}"
+            if breaker.record_failure():
+                self.stats['circuit_opened'] += 1
+                logger.warning(f"[INTEGRATION] {self.name}: circuit opened for {urlsplit(url).netloc} ({self.last_error})")
+
+            if attempt == attempts - 1:
+                if error:
+                    raise error
+                return response
+
+            self.stats['retries'] += 1
+            # Full jitter: spread retries of concurrent callers
+            await asyncio.sleep(random.uniform(0, INTEGRATION_BACKOFF_BASE * (2 ** attempt)))
+
+    async def get(self, url: str, **kwargs) -> httpx.Response:
+        return await self.request('GET', url, **kwargs)
+
+    async def post(self, url: str, **kwargs) -> httpx.Response:
+        return await self.request('POST', url, **kwargs)
+
+    async def delete(self, url: str, **kwargs) -> httpx.Response:
+        return await self.request('DELETE', url, **kwargs)
+
+    def metrics(self) -> Dict[str, Any]:
+        latencies = sorted(self._latencies)
+
+        def pct(p: float) -> Optional[float]:
+            if not latencies:
+                return None
+            return round(latencies[max(0, math.ceil(p / 100 * len(latencies)) - 1)], 1)
+
+        return {
+            **self.stats,
+            'error_rate': round(self.stats['errors'] / self.stats['requests'], 4) if self.stats['requests'] else 0.0,
+            'latency_ms': {'p50': pct(50), 'p95': pct(95), 'p99': pct(99)},
+            'timeout_seconds': self.timeout,
+            'last_error': self.last_error,
+            'circuits': {
+                host: {'state': b.state, 'consecutive_failures': b.failures}
+                for host, b in self._breakers.items()
+            }
+        }
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+class IntegrationHTTP:
+    """Registry of provider clients"""
+
+    def __init__(self):
+        self._providers: Dict[str, ProviderClient] = {}
+
+    def client(self, name: str) -> ProviderClient:
+        provider = self._providers.get(name)
+        if provider is None:
+            timeout = float(os.environ.get(f'INTEGRATION_{name.upper()}_TIMEOUT', PROVIDER_TIMEOUTS.get(name, 15.0)))
+            provider = self._providers[name] = ProviderClient(name, timeout)
+        return provider
+
+    def metrics(self) -> Dict[str, Any]:
+        return {name: provider.metrics() for name, provider in self._providers.items()}
+
+    async def close_all(self):
+        for provider in self._providers.values():
+            await provider.close()
+
+
+# Singleton instance
+integration_http = IntegrationHTTP()
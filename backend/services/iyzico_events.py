@@ -0,0 +1,235 @@
+"""
+iyzico Event Queue
+Webhooks and checkout callbacks are stored as raw events and acknowledged
+immediately; a background worker applies them afterwards.
+
+- Each event is stored once under an idempotency key (unique index), so a
+  retried webhook / double-posted callback is acknowledged without being
+  processed again
+- Events are processed in arrival order per company (order_key); different
+  companies are processed concurrently
+- Handlers are registered by server.py per event kind; an exception retries
+  the event with backoff and holds back that company's later events
+- subscription_payments gets a unique payment_id index so the same iyzico
+  payment can never be recorded twice
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import random
+from datetime import datetime, timedelta, timezone
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError, OperationFailure
+
+logger = logging.getLogger(__name__)
+
+IYZICO_EVENTS_INTERVAL = float(os.environ.get('IYZICO_EVENTS_INTERVAL', '5'))
+IYZICO_EVENTS_CONCURRENCY = int(os.environ.get('IYZICO_EVENTS_CONCURRENCY', '10'))
+IYZICO_EVENTS_MAX_ATTEMPTS = int(os.environ.get('IYZICO_EVENTS_MAX_ATTEMPTS', '6'))
+IYZICO_EVENTS_BACKOFF_BASE = float(os.environ.get('IYZICO_EVENTS_BACKOFF_BASE', '10'))
+# An event left `processing` by a crashed worker is retried after this lease
+IYZICO_EVENTS_LEASE = float(os.environ.get('IYZICO_EVENTS_LEASE', '120'))
+IYZICO_EVENTS_RETENTION_DAYS = int(os.environ.get('IYZICO_EVENTS_RETENTION_DAYS', '90'))
+
+
+def _now() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+def webhook_idempotency_key(body: Dict[str, Any], raw: bytes) -> str:
+    """iyzico's own event reference when present, else the payment, else the payload hash"""
+    if body.get('iyziReferenceCode'):
+        return f"webhook:{body['iyziReferenceCode']}"
+    if body.get('paymentId'):
+        return f"webhook:{body.get('iyziEventType')}:{body['paymentId']}"
+    return 'webhook:' + hashlib.sha256(raw).hexdigest()
+
+
+class IyzicoEventQueue:
+    """
+    Durable inbox for iyzico events
+
+    - ingest(db, ...): store the raw event once, returns (event, created)
+    - register_handler(kind, handler): handler(db, event) -> result dict
+    - run(db): worker loop
+    - wait_for(db, event_id, timeout): result of an event processed in this process
+    """
+
+    def __init__(self, interval: float = IYZICO_EVENTS_INTERVAL, concurrency: int = IYZICO_EVENTS_CONCURRENCY):
+        self.interval = interval
+        self.concurrency = concurrency
+        self._handlers: Dict[str, Callable[[Any, Dict[str, Any]], Awaitable[Dict[str, Any]]]] = {}
+        self._wakeup = asyncio.Event()
+        self._active_keys: set = set()
+        self._done_events: Dict[str, asyncio.Event] = {}
+
+    async def ensure_indexes(self, db):
+        await db.iyzico_events.create_index("id", unique=True)
+        await db.iyzico_events.create_index([("status", 1), ("order_key", 1), ("received_at", 1)])
+        await db.iyzico_events.create_index("expires_at", expireAfterSeconds=0)
+        await db.iyzico_sessions.create_index("token")
+        await db.companies.create_index("iyzico_subscription_ref")
+        try:
+            await db.subscription_payments.create_index(
+                "payment_id", unique=True,
+                partialFilterExpression={"payment_id": {"$type": "string"}}
+            )
+        except OperationFailure as e:
+            # Existing duplicates from before the queue - processing still upserts on payment_id
+            logger.warning(f"[IYZICO-EVENTS] Unique payment_id index not created: {e}")
+
+    def register_handler(self, kind: str, handler: Callable[[Any, Dict[str, Any]], Awaitable[Dict[str, Any]]]):
+        self._handlers[kind] = handler
+
+    async def ingest(
+        self,
+        db,
+        kind: str,
+        idempotency_key: str,
+        payload: Any,
+        order_key: Optional[str],
+        event_type: Optional[str] = None
+    ) -> tuple:
+        """Store an event unless its idempotency key was seen before"""
+        now = _now()
+        event = {
+            "id": idempotency_key,
+            "kind": kind,
+            "event_type": event_type,
+            "order_key": order_key or idempotency_key,
+            "payload": payload if isinstance(payload, str) else json.dumps(payload, ensure_ascii=False),
+            "status": "pending",
+            "attempts": 0,
+            "next_attempt_at": now.isoformat(),
+            "received_at": now.isoformat(),
+            "expires_at": now + timedelta(days=IYZICO_EVENTS_RETENTION_DAYS)
+        }
+        try:
+            await db.iyzico_events.insert_one(dict(event))
+        except DuplicateKeyError:
+            existing = await db.iyzico_events.find_one({"id": idempotency_key}, {"_id": 0, "payload": 0})
+            logger.info(f"[IYZICO-EVENTS] Duplicate {kind} event {idempotency_key} ({(existing or {}).get('status')})")
+            return existing, False
+        self._wakeup.set()
+        return event, True
+
+    async def wait_for(self, db, event_id: str, timeout: float) -> Optional[Dict[str, Any]]:
+        """Wait up to timeout for the event to be processed; the finished event or None"""
+        done = self._done_events.setdefault(event_id, asyncio.Event())
+        try:
+            event = await db.iyzico_events.find_one({"id": event_id}, {"_id": 0, "payload": 0})
+            if event and event.get("status") in ("done", "failed"):
+                return event
+            await asyncio.wait_for(done.wait(), timeout)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            self._done_events.pop(event_id, None)
+        return await db.iyzico_events.find_one({"id": event_id}, {"_id": 0, "payload": 0})
+
+    async def _claim_next(self, db, order_key: str) -> Optional[Dict[str, Any]]:
+        """Oldest unfinished event of a company, if it is due"""
+        now = _now()
+        head = await db.iyzico_events.find_one(
+            {"order_key": order_key, "status": {"$in": ["pending", "processing"]}},
+            {"_id": 0, "id": 1, "status": 1, "next_attempt_at": 1, "locked_until": 1},
+            sort=[("received_at", 1)]
+        )
+        if not head:
+            return None
+        if head["status"] == "pending" and head["next_attempt_at"] > now.isoformat():
+            return None
+        if head["status"] == "processing" and (head.get("locked_until") or "") > now.isoformat():
+            return None
+        return await db.iyzico_events.find_one_and_update(
+            {"id": head["id"], "status": head["status"]},
+            {
+                "$set": {"status": "processing", "locked_until": (now + timedelta(seconds=IYZICO_EVENTS_LEASE)).isoformat()},
+                "$inc": {"attempts": 1}
+            },
+            projection={"_id": 0},
+            return_document=ReturnDocument.AFTER
+        )
+
+    async def _process(self, db, event: Dict[str, Any]) -> bool:
+        """Run the handler; True when the company's queue may move on"""
+        now = _now().isoformat()
+        handler = self._handlers.get(event["kind"])
+        try:
+            if handler is None:
+                raise RuntimeError(f"No handler for {event['kind']} events")
+            event["body"] = json.loads(event["payload"])
+            result = await handler(db, event)
+            update = {"status": "done", "result": result, "processed_at": now, "error": None}
+        except Exception as e:
+            if event["attempts"] < IYZICO_EVENTS_MAX_ATTEMPTS:
+                delay = random.uniform(0, IYZICO_EVENTS_BACKOFF_BASE * (2 ** (event["attempts"] - 1)))
+                await db.iyzico_events.update_one(
+                    {"id": event["id"]},
+                    {"$set": {
+                        "status": "pending",
+                        "error": str(e),
+                        "next_attempt_at": (_now() + timedelta(seconds=delay)).isoformat()
+                    }, "$unset": {"locked_until": ""}}
+                )
+                logger.warning(f"[IYZICO-EVENTS] {event['id']} attempt {event['attempts']} failed: {e}")
+                return False
+            logger.error(f"[IYZICO-EVENTS] {event['id']} failed permanently: {e}")
+            update = {"status": "failed", "error": str(e), "processed_at": now}
+
+        await db.iyzico_events.update_one({"id": event["id"]}, {"$set": update, "$unset": {"locked_until": ""}})
+        done = self._done_events.get(event["id"])
+        if done:
+            done.set()
+        return True
+
+    async def _drain_key(self, db, order_key: str):
+        """Process one company's events strictly in order"""
+        self._active_keys.add(order_key)
+        try:
+            while True:
+                event = await self._claim_next(db, order_key)
+                if not event or not await self._process(db, event):
+                    return
+        finally:
+            self._active_keys.discard(order_key)
+
+    async def process_once(self, db) -> int:
+        keys: List[str] = await db.iyzico_events.distinct(
+            "order_key", {"status": {"$in": ["pending", "processing"]}}
+        )
+        keys = [k for k in keys if k not in self._active_keys]
+        if not keys:
+            return 0
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def bounded(key):
+            async with semaphore:
+                try:
+                    await self._drain_key(db, key)
+                except Exception as e:
+                    logger.warning(f"[IYZICO-EVENTS] Queue {key} failed: {e}")
+
+        await asyncio.gather(*(bounded(k) for k in keys))
+        return len(keys)
+
+    async def run(self, db):
+        """Worker loop"""
+        while True:
+            self._wakeup.clear()
+            try:
+                await self.process_once(db)
+            except Exception as e:
+                logger.warning(f"[IYZICO-EVENTS] Worker round failed: {e}")
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+
+
+# Singleton instance
+iyzico_events = IyzicoEventQueue()
@@ -7,13 +7,14 @@ import os
 import hmac
 import hashlib
 import base64
-import httpx
 import json
 from datetime import datetime, timezone
 from typing import Dict, Any, Optional
 from uuid import uuid4
 import logging
 
+from .integration_http import integration_http
+
 logger = logging.getLogger(__name__)
 
 class IyzicoService:
@@ -86,15 +87,15 @@ class IyzicoService:
         }
         
         try:
-            async with httpx.AsyncClient(timeout=30.0) as client:
-                response = await client.post(
-                    f"{self.base_url}/payment/iyzipos/checkoutform/initialize/auth/ecom",
-                    content=request_body,
-                    headers=headers
-                )
-                result = response.json()
-                result["conversationId"] = conversation_id
-                return result
+            client = integration_http.client('iyzico')
+            response = await client.post(
+                f"{self.base_url}/payment/iyzipos/checkoutform/initialize/auth/ecom",
+                content=request_body,
+                headers=headers
+            )
+            result = response.json()
+            result["conversationId"] = conversation_id
+            return result
         except Exception as e:
             logger.error(f"iyzico checkout form error: {str(e)}")
             return {"status": "error", "message": str(e)}
@@ -126,13 +127,14 @@ class IyzicoService:
         }
         
         try:
-            async with httpx.AsyncClient(timeout=30.0) as client:
-                response = await client.post(
-                    f"{self.base_url}/payment/iyzipos/checkoutform/auth/ecom/detail",
-                    content=request_body,
-                    headers=headers
-                )
-                return response.json()
+            client = integration_http.client('iyzico')
+            response = await client.post(
+                f"{self.base_url}/payment/iyzipos/checkoutform/auth/ecom/detail",
+                content=request_body,
+                headers=headers,
+                retry=True
+            )
+            return response.json()
         except Exception as e:
             logger.error(f"iyzico checkout result error: {str(e)}")
             return {"status": "error", "message": str(e)}
@@ -168,13 +170,13 @@ class IyzicoService:
         }
         
         try:
-            async with httpx.AsyncClient(timeout=30.0) as client:
-                response = await client.post(
-                    f"{self.base_url}/v2/subscription/products",
-                    content=request_body,
-                    headers=headers
-                )
-                return response.json()
+            client = integration_http.client('iyzico')
+            response = await client.post(
+                f"{self.base_url}/v2/subscription/products",
+                content=request_body,
+                headers=headers
+            )
+            return response.json()
         except Exception as e:
             logger.error(f"iyzico subscription product error: {str(e)}")
             return {"status": "error", "message": str(e)}
@@ -221,13 +223,13 @@ class IyzicoService:
         }
         
         try:
-            async with httpx.AsyncClient(timeout=30.0) as client:
-                response = await client.post(
-                    f"{self.base_url}/v2/subscription/pricing-plans",
-                    content=request_body,
-                    headers=headers
-                )
-                return response.json()
+            client = integration_http.client('iyzico')
+            response = await client.post(
+                f"{self.base_url}/v2/subscription/pricing-plans",
+                content=request_body,
+                headers=headers
+            )
+            return response.json()
         except Exception as e:
             logger.error(f"iyzico pricing plan error: {str(e)}")
             return {"status": "error", "message": str(e)}
@@ -264,15 +266,15 @@ class IyzicoService:
         }
         
         try:
-            async with httpx.AsyncClient(timeout=30.0) as client:
-                response = await client.post(
-                    f"{self.base_url}/v2/subscription/checkoutform/initialize",
-                    content=request_body,
-                    headers=headers
-                )
-                result = response.json()
-                result["conversationId"] = conversation_id
-                return result
+            client = integration_http.client('iyzico')
+            response = await client.post(
+                f"{self.base_url}/v2/subscription/checkoutform/initialize",
+                content=request_body,
+                headers=headers
+            )
+            result = response.json()
+            result["conversationId"] = conversation_id
+            return result
         except Exception as e:
             logger.error(f"iyzico subscription checkout error: {str(e)}")
             return {"status": "error", "message": str(e)}
@@ -304,13 +306,13 @@ class IyzicoService:
         }
         
         try:
-            async with httpx.AsyncClient(timeout=30.0) as client:
-                response = await client.post(
-                    f"{self.base_url}/v2/subscription/subscriptions/{subscription_reference_code}/cancel",
-                    content=request_body,
-                    headers=headers
-                )
-                return response.json()
+            client = integration_http.client('iyzico')
+            response = await client.post(
+                f"{self.base_url}/v2/subscription/subscriptions/{subscription_reference_code}/cancel",
+                content=request_body,
+                headers=headers
+            )
+            return response.json()
         except Exception as e:
             logger.error(f"iyzico subscription cancel error: {str(e)}")
             return {"status": "error", "message": str(e)}
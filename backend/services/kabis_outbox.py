@@ -0,0 +1,298 @@
+"""
+KABİS Notification Outbox
+Rental notifications are written to kabis_notifications as `pending` and
+submitted to KABİS in the background, so the request path never waits on the
+government API and a KABİS outage does not lose notifications.
+
+- enqueue(): validate, store the pending record, wake the dispatcher
+- Dispatcher: claims due records, submits with bounded concurrency, retries
+  connect / open-circuit / 5xx / 429 failures with jittered exponential backoff and stores
+  the upstream bildirim_no
+- Reconciler: re-checks submitted notifications in batches via
+  get_notification_status until KABİS reports a final status
+
+Status flow: pending -> submitting -> submitted | failed
+             (failed without retry when KABİS may have received the request,
+             e.g. a read timeout - retried manually after checking the portal)
+             (pending_api when the company has no active KABİS settings)
+"""
+import asyncio
+import logging
+import os
+import random
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional
+from uuid import uuid4
+
+from .kabis_service import KabisService
+
+logger = logging.getLogger(__name__)
+
+KABIS_OUTBOX_INTERVAL = float(os.environ.get('KABIS_OUTBOX_INTERVAL', '10'))
+KABIS_OUTBOX_BATCH = int(os.environ.get('KABIS_OUTBOX_BATCH', '50'))
+KABIS_OUTBOX_CONCURRENCY = int(os.environ.get('KABIS_OUTBOX_CONCURRENCY', '5'))
+KABIS_OUTBOX_MAX_ATTEMPTS = int(os.environ.get('KABIS_OUTBOX_MAX_ATTEMPTS', '8'))
+KABIS_OUTBOX_BACKOFF_BASE = float(os.environ.get('KABIS_OUTBOX_BACKOFF_BASE', '30'))
+KABIS_OUTBOX_BACKOFF_MAX = float(os.environ.get('KABIS_OUTBOX_BACKOFF_MAX', '3600'))
+# A claimed record whose worker died is picked up again after this lease
+KABIS_OUTBOX_LEASE = float(os.environ.get('KABIS_OUTBOX_LEASE', '120'))
+KABIS_RECONCILE_INTERVAL = float(os.environ.get('KABIS_RECONCILE_INTERVAL', '600'))
+KABIS_RECONCILE_BATCH = int(os.environ.get('KABIS_RECONCILE_BATCH', '100'))
+# Stop polling KABİS for a status this long after submission
+KABIS_RECONCILE_MAX_AGE_DAYS = int(os.environ.get('KABIS_RECONCILE_MAX_AGE_DAYS', '7'))
+
+# Upstream statuses after which a notification is no longer reconciled
+KABIS_FINAL_STATUSES = ('onaylandi', 'reddedildi', 'iptal', 'approved', 'rejected', 'cancelled')
+KABIS_REJECTED_STATUSES = ('reddedildi', 'rejected')
+
+
+def _now() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+def backoff_delay(attempt: int) -> float:
+    """Full-jitter exponential backoff for the given (1-based) attempt"""
+    return random.uniform(0, min(KABIS_OUTBOX_BACKOFF_MAX, KABIS_OUTBOX_BACKOFF_BASE * (2 ** (attempt - 1))))
+
+
+def _is_retryable(result: Dict[str, Any]) -> bool:
+    status_code = result.get('status_code')
+    if status_code is None:
+        # Only when nothing was sent (connect error / open circuit); after a read
+        # timeout KABİS may already have filed it and a resend would duplicate it
+        return bool(result.get('not_sent'))
+    return status_code >= 500 or status_code == 429
+
+
+class KabisOutbox:
+    """
+    Background submission of KABİS rental notifications
+
+    - enqueue(db, company_id, rental_data, user_id): pending record, returns at once
+    - run(db): dispatcher loop (submission + periodic reconciliation)
+    - retry(db, company_id, notification_id): put a failed record back in the queue
+    """
+
+    def __init__(self, interval: float = KABIS_OUTBOX_INTERVAL, concurrency: int = KABIS_OUTBOX_CONCURRENCY):
+        self.interval = interval
+        self.concurrency = concurrency
+        self._wakeup = asyncio.Event()
+        self._last_reconcile: Optional[datetime] = None
+
+    async def ensure_indexes(self, db):
+        await db.kabis_notifications.create_index("id")
+        await db.kabis_notifications.create_index([("company_id", 1), ("created_at", -1)])
+        await db.kabis_notifications.create_index([("status", 1), ("next_attempt_at", 1)])
+        await db.kabis_notifications.create_index([("status", 1), ("reconcile_after", 1)])
+
+    async def _settings(self, db, company_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+        settings = db.integration_settings.find(
+            {"company_id": {"$in": company_ids}, "type": "kabis", "is_active": True},
+            {"_id": 0}
+        )
+        return {s["company_id"]: s async for s in settings}
+
+    @staticmethod
+    def _service(settings: Optional[Dict[str, Any]]) -> KabisService:
+        if not settings:
+            return KabisService()
+        return KabisService(
+            api_key=settings.get("api_key"),
+            firma_kodu=settings.get("firma_kodu"),
+            api_url=settings.get("api_url")
+        )
+
+    async def enqueue(self, db, company_id: str, rental_data: Dict[str, Any], user_id: Optional[str]) -> Dict[str, Any]:
+        """Store the notification for background submission"""
+        error = KabisService.validate_rental_data(rental_data)
+        if error:
+            return {"success": False, "error": error}
+
+        configured = self._service((await self._settings(db, [company_id])).get(company_id)).is_configured
+        now = _now().isoformat()
+        notification_doc = {
+            "id": str(uuid4()),
+            "company_id": company_id,
+            "rental_data": rental_data,
+            # Without credentials the notification has to be made manually in the KABİS portal
+            "status": "pending" if configured else "pending_api",
+            "source": "kabis_api" if configured else "local",
+            "bildirim_no": None,
+            "attempts": 0,
+            "next_attempt_at": now,
+            "last_error": None,
+            "created_at": now,
+            "created_by": user_id
+        }
+        await db.kabis_notifications.insert_one(notification_doc)
+        if configured:
+            self._wakeup.set()
+
+        return {
+            "success": True,
+            "notification_id": notification_doc["id"],
+            "status": notification_doc["status"],
+            "message": "Bildirim kuyruğa alındı, KABİS'e arka planda gönderilecek" if configured
+                       else "Bildirim kaydedildi (KABİS API yapılandırılmamış - manuel bildirim gerekli)",
+            "source": notification_doc["source"],
+            "created_at": now
+        }
+
+    async def retry(self, db, company_id: str, notification_id: str) -> bool:
+        result = await db.kabis_notifications.update_one(
+            {"id": notification_id, "company_id": company_id, "status": "failed"},
+            {"$set": {"status": "pending", "attempts": 0, "next_attempt_at": _now().isoformat(), "last_error": None}}
+        )
+        if result.modified_count:
+            self._wakeup.set()
+        return bool(result.modified_count)
+
+    async def _claim(self, db) -> List[Dict[str, Any]]:
+        """Atomically move due records to `submitting` (also re-claims expired leases)"""
+        now = _now()
+        due = await db.kabis_notifications.find(
+            {"$or": [
+                {"status": "pending", "next_attempt_at": {"$lte": now.isoformat()}},
+                {"status": "submitting", "locked_until": {"$lt": now.isoformat()}}
+            ]},
+            {"_id": 0, "id": 1, "status": 1}
+        ).sort("next_attempt_at", 1).limit(KABIS_OUTBOX_BATCH).to_list(KABIS_OUTBOX_BATCH)
+
+        claimed = []
+        locked_until = (now + timedelta(seconds=KABIS_OUTBOX_LEASE)).isoformat()
+        for doc in due:
+            record = await db.kabis_notifications.find_one_and_update(
+                {"id": doc["id"], "status": doc["status"]},
+                {"$set": {"status": "submitting", "locked_until": locked_until}},
+                projection={"_id": 0}
+            )
+            if record:
+                claimed.append(record)
+        return claimed
+
+    async def _submit(self, db, record: Dict[str, Any], settings: Optional[Dict[str, Any]]):
+        kabis = self._service(settings)
+        attempts = record.get("attempts", 0) + 1
+        now = _now()
+
+        if not kabis.is_configured:
+            # Settings were deactivated after the record was queued
+            await db.kabis_notifications.update_one(
+                {"id": record["id"]},
+                {"$set": {"status": "pending_api", "source": "local"}, "$unset": {"locked_until": ""}}
+            )
+            return
+
+        result = await kabis.create_rental_notification(record["rental_data"])
+        if result.get("success"):
+            await db.kabis_notifications.update_one(
+                {"id": record["id"]},
+                {
+                    "$set": {
+                        "status": "submitted",
+                        "bildirim_no": result.get("bildirim_no"),
+                        "kabis_response": result.get("kabis_response"),
+                        "attempts": attempts,
+                        "submitted_at": now.isoformat(),
+                        "reconcile_after": now.isoformat(),
+                        "last_error": None
+                    },
+                    "$unset": {"locked_until": ""}
+                }
+            )
+            return
+
+        error = result.get("error") or "KABİS bildirimi gönderilemedi"
+        if result.get("status_code") is None and not result.get("not_sent"):
+            error = f"{error} - KABİS yanıtı alınamadı, bildirim oluşmuş olabilir; portalda kontrol edip elle tekrar deneyin"
+        if _is_retryable(result) and attempts < KABIS_OUTBOX_MAX_ATTEMPTS:
+            update = {
+                "status": "pending",
+                "attempts": attempts,
+                "next_attempt_at": (now + timedelta(seconds=backoff_delay(attempts))).isoformat(),
+                "last_error": error
+            }
+        else:
+            update = {"status": "failed", "attempts": attempts, "last_error": error, "failed_at": now.isoformat()}
+            logger.warning(f"[KABIS-OUTBOX] Notification {record['id']} failed after {attempts} attempt(s): {error}")
+        await db.kabis_notifications.update_one(
+            {"id": record["id"]},
+            {"$set": update, "$unset": {"locked_until": ""}}
+        )
+
+    async def _gather(self, records: List[Dict[str, Any]], worker):
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def bounded(record):
+            async with semaphore:
+                try:
+                    await worker(record)
+                except Exception as e:
+                    logger.warning(f"[KABIS-OUTBOX] {record.get('id')}: {e}")
+
+        await asyncio.gather(*(bounded(r) for r in records))
+
+    async def dispatch_once(self, db) -> int:
+        records = await self._claim(db)
+        if not records:
+            return 0
+        settings = await self._settings(db, list({r["company_id"] for r in records}))
+        await self._gather(records, lambda r: self._submit(db, r, settings.get(r["company_id"])))
+        return len(records)
+
+    async def _reconcile_one(self, db, record: Dict[str, Any], settings: Optional[Dict[str, Any]]):
+        kabis = self._service(settings)
+        if not kabis.is_configured:
+            return
+        result = await kabis.get_notification_status(record["bildirim_no"])
+        now = _now()
+        update = {"reconcile_after": (now + timedelta(seconds=KABIS_RECONCILE_INTERVAL)).isoformat()}
+        if result.get("success"):
+            kabis_status = str(result.get("durum") or result.get("status") or "").lower() or None
+            update.update({"kabis_status": kabis_status, "reconciled_at": now.isoformat()})
+            if kabis_status in KABIS_REJECTED_STATUSES:
+                update["status"] = "rejected"
+            if kabis_status in KABIS_FINAL_STATUSES:
+                update["reconcile_after"] = None
+        await db.kabis_notifications.update_one({"id": record["id"]}, {"$set": update})
+
+    async def reconcile_once(self, db) -> int:
+        now = _now()
+        records = await db.kabis_notifications.find(
+            {
+                "status": "submitted",
+                "bildirim_no": {"$nin": [None, ""]},
+                "reconcile_after": {"$ne": None, "$lte": now.isoformat()},
+                "submitted_at": {"$gte": (now - timedelta(days=KABIS_RECONCILE_MAX_AGE_DAYS)).isoformat()}
+            },
+            {"_id": 0, "id": 1, "company_id": 1, "bildirim_no": 1}
+        ).sort("reconcile_after", 1).limit(KABIS_RECONCILE_BATCH).to_list(KABIS_RECONCILE_BATCH)
+        if not records:
+            return 0
+        settings = await self._settings(db, list({r["company_id"] for r in records}))
+        await self._gather(records, lambda r: self._reconcile_one(db, r, settings.get(r["company_id"])))
+        return len(records)
+
+    async def run(self, db):
+        """Dispatcher loop"""
+        while True:
+            self._wakeup.clear()
+            try:
+                # Drain the queue before sleeping again
+                while await self.dispatch_once(db) >= KABIS_OUTBOX_BATCH:
+                    pass
+                now = _now()
+                if self._last_reconcile is None or (now - self._last_reconcile).total_seconds() >= KABIS_RECONCILE_INTERVAL:
+                    self._last_reconcile = now
+                    await self.reconcile_once(db)
+            except Exception as e:
+                logger.warning(f"[KABIS-OUTBOX] Dispatch round failed: {e}")
+
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+
+
+# Singleton instance
+kabis_outbox = KabisOutbox()
@@ -13,13 +13,16 @@ API Erişimi İçin:
 3. API erişim bilgilerinizi alın
 4. Ayarlar > Entegrasyonlar > KABİS bölümünden bilgileri girin
 """
-import httpx
 import logging
 from typing import Dict, List, Any, Optional
 from datetime import datetime, timezone
 from uuid import uuid4
 import os
 
+import httpx
+
+from .integration_http import integration_http, CircuitOpenError
+
 logger = logging.getLogger(__name__)
 
 class KabisService:
@@ -38,6 +41,26 @@ class KabisService:
         self.api_url = api_url or os.environ.get('KABIS_API_URL', 'https://api.kabis.uab.gov.tr/v1')
         self.is_configured = bool(self.api_key and self.firma_kodu)
     
+    @staticmethod
+    def validate_rental_data(rental_data: Dict[str, Any]) -> Optional[str]:
+        """
+        Bildirim verisini doğrula, hata mesajı döner (geçerliyse None)
+        """
+        # Validate required fields
+        required_fields = ['vehicle_plate', 'customer_tc', 'customer_name', 
+                          'rental_start', 'rental_end']
+        missing = [f for f in required_fields if not rental_data.get(f)]
+        if missing:
+            missing_str = ', '.join(missing)
+            return f'Eksik alanlar: {missing_str}'
+        
+        # Validate TC Kimlik No (11 digits)
+        tc = str(rental_data.get('customer_tc', ''))
+        if len(tc) != 11 or not tc.isdigit():
+            return 'Geçersiz T.C. Kimlik No (11 haneli olmalı)'
+        
+        return None
+    
     async def create_rental_notification(self, rental_data: Dict[str, Any]) -> Dict[str, Any]:
         """
         Kiralama bildirimi oluştur
@@ -53,23 +76,11 @@ class KabisService:
         - dropoff_location: İade lokasyonu
         """
         
-        # Validate required fields
-        required_fields = ['vehicle_plate', 'customer_tc', 'customer_name', 
-                          'rental_start', 'rental_end']
-        missing = [f for f in required_fields if not rental_data.get(f)]
-        if missing:
-            missing_str = ', '.join(missing)
-            return {
-                'success': False,
-                'error': f'Eksik alanlar: {missing_str}'
-            }
-        
-        # Validate TC Kimlik No (11 digits)
-        tc = str(rental_data.get('customer_tc', ''))
-        if len(tc) != 11 or not tc.isdigit():
+        error = self.validate_rental_data(rental_data)
+        if error:
             return {
                 'success': False,
-                'error': 'Geçersiz T.C. Kimlik No (11 haneli olmalı)'
+                'error': error
             }
         
         notification_id = str(uuid4())
@@ -89,51 +100,62 @@ class KabisService:
         
         try:
             # KABİS API call
-            async with httpx.AsyncClient(timeout=30) as client:
-                headers = {
-                    'Authorization': f'Bearer {self.api_key}',
-                    'X-Firma-Kodu': self.firma_kodu,
-                    'Content-Type': 'application/json'
+            client = integration_http.client('kabis')
+            headers = {
+                'Authorization': f'Bearer {self.api_key}',
+                'X-Firma-Kodu': self.firma_kodu,
+                'Content-Type': 'application/json'
+            }
+            
+            payload = {
+                'plaka': rental_data['vehicle_plate'],
+                'kiraci_tc': rental_data['customer_tc'],
+                'kiraci_ad_soyad': rental_data['customer_name'],
+                'kiraci_telefon': rental_data.get('customer_phone', ''),
+                'kiralama_baslangic': rental_data['rental_start'],
+                'kiralama_bitis': rental_data['rental_end'],
+                'alis_lokasyon': rental_data.get('pickup_location', ''),
+                'iade_lokasyon': rental_data.get('dropoff_location', ''),
+                'firma_kodu': self.firma_kodu
+            }
+            
+            response = await client.post(
+                f'{self.api_url}/bildirim',
+                headers=headers,
+                json=payload
+            )
+            
+            if response.status_code in [200, 201]:
+                result = response.json()
+                return {
+                    'success': True,
+                    'notification_id': result.get('bildirim_no', notification_id),
+                    'bildirim_no': result.get('bildirim_no'),
+                    'status': 'submitted',
+                    'message': 'Bildirim KABIS sistemine basariyla gonderildi',
+                    'source': 'kabis_api',
+                    'kabis_response': result,
+                    'created_at': now
                 }
-                
-                payload = {
-                    'plaka': rental_data['vehicle_plate'],
-                    'kiraci_tc': rental_data['customer_tc'],
-                    'kiraci_ad_soyad': rental_data['customer_name'],
-                    'kiraci_telefon': rental_data.get('customer_phone', ''),
-                    'kiralama_baslangic': rental_data['rental_start'],
-                    'kiralama_bitis': rental_data['rental_end'],
-                    'alis_lokasyon': rental_data.get('pickup_location', ''),
-                    'iade_lokasyon': rental_data.get('dropoff_location', ''),
-                    'firma_kodu': self.firma_kodu
+            else:
+                logger.error(f'KABİS API error: {response.status_code} - {response.text}')
+                return {
+                    'success': False,
+                    'error': f'KABİS API hatası: {response.status_code}',
+                    'status_code': response.status_code,
+                    'details': response.text
                 }
                 
-                response = await client.post(
-                    f'{self.api_url}/bildirim',
-                    headers=headers,
-                    json=payload
-                )
-                
-                if response.status_code in [200, 201]:
-                    result = response.json()
-                    return {
-                        'success': True,
-                        'notification_id': result.get('bildirim_no', notification_id),
-                        'status': 'submitted',
-                        'message': 'Bildirim KABIS sistemine basariyla gonderildi',
-                        'source': 'kabis_api',
-                        'kabis_response': result,
-                        'created_at': now
-                    }
-                else:
-                    logger.error(f'KABİS API error: {response.status_code} - {response.text}')
-                    return {
-                        'success': False,
-                        'error': f'KABİS API hatası: {response.status_code}',
-                        'details': response.text
-                    }
-                    
+        except (CircuitOpenError, httpx.ConnectError, httpx.ConnectTimeout) as e:
+            # The request never reached KABİS - safe to send again
+            logger.error(f'KABİS connection error: {str(e)}')
+            return {
+                'success': False,
+                'error': f'Bağlantı hatası: {str(e)}',
+                'not_sent': True
+            }
         except Exception as e:
+            # e.g. read timeout: KABİS may have filed the notification already
             logger.error(f'KABİS connection error: {str(e)}')
             return {
                 'success': False,
@@ -153,24 +175,24 @@ class KabisService:
             }
         
         try:
-            async with httpx.AsyncClient(timeout=30) as client:
-                headers = {
-                    'Authorization': f'Bearer {self.api_key}',
-                    'X-Firma-Kodu': self.firma_kodu
-                }
-                
-                response = await client.delete(
-                    f'{self.api_url}/bildirim/{notification_id}',
-                    headers=headers,
-                    params={'iptal_nedeni': reason}
-                )
-                
-                return {
-                    'success': response.status_code in [200, 204],
-                    'notification_id': notification_id,
-                    'status': 'cancelled' if response.status_code in [200, 204] else 'error'
-                }
-                
+            client = integration_http.client('kabis')
+            headers = {
+                'Authorization': f'Bearer {self.api_key}',
+                'X-Firma-Kodu': self.firma_kodu
+            }
+            
+            response = await client.delete(
+                f'{self.api_url}/bildirim/{notification_id}',
+                headers=headers,
+                params={'iptal_nedeni': reason}
+            )
+            
+            return {
+                'success': response.status_code in [200, 204],
+                'notification_id': notification_id,
+                'status': 'cancelled' if response.status_code in [200, 204] else 'error'
+            }
+            
         except Exception as e:
             return {
                 'success': False,
@@ -190,23 +212,23 @@ class KabisService:
             }
         
         try:
-            async with httpx.AsyncClient(timeout=30) as client:
-                headers = {
-                    'Authorization': f'Bearer {self.api_key}',
-                    'X-Firma-Kodu': self.firma_kodu
+            client = integration_http.client('kabis')
+            headers = {
+                'Authorization': f'Bearer {self.api_key}',
+                'X-Firma-Kodu': self.firma_kodu
+            }
+            
+            response = await client.get(
+                f'{self.api_url}/bildirim/{notification_id}',
+                headers=headers
+            )
+            
+            if response.status_code == 200:
+                return {
+                    'success': True,
+                    **response.json()
                 }
                 
-                response = await client.get(
-                    f'{self.api_url}/bildirim/{notification_id}',
-                    headers=headers
-                )
-                
-                if response.status_code == 200:
-                    return {
-                        'success': True,
-                        **response.json()
-                    }
-                    
         except Exception as e:
             logger.error(f'KABİS status error: {str(e)}')
         
@@ -225,23 +247,23 @@ class KabisService:
             }
         
         try:
-            async with httpx.AsyncClient(timeout=10) as client:
-                headers = {
-                    'Authorization': f'Bearer {self.api_key}',
-                    'X-Firma-Kodu': self.firma_kodu
-                }
-                
-                response = await client.get(
-                    f'{self.api_url}/ping',
-                    headers=headers
-                )
-                
-                return {
-                    'success': response.status_code == 200,
-                    'configured': True,
-                    'status_code': response.status_code
-                }
-                
+            client = integration_http.client('kabis')
+            headers = {
+                'Authorization': f'Bearer {self.api_key}',
+                'X-Firma-Kodu': self.firma_kodu
+            }
+            
+            response = await client.get(
+                f'{self.api_url}/ping',
+                headers=headers
+            )
+            
+            return {
+                'success': response.status_code == 200,
+                'configured': True,
+                'status_code': response.status_code
+            }
+            
         except Exception as e:
             return {
                 'success': False,
@@ -0,0 +1,158 @@
+"""
+Portainer Inventory Snapshot
+Periodically snapshots Portainer stacks and containers so SuperAdmin status
+pages are served from memory instead of querying Portainer on every view.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+from datetime import datetime, timezone
+from typing import Any, Dict, Optional
+
+from .portainer_service import portainer_service
+
+logger = logging.getLogger(__name__)
+
+INVENTORY_REFRESH_INTERVAL = int(os.environ.get('INVENTORY_REFRESH_INTERVAL', '30'))
+
+
+class PortainerInventory:
+    """
+    In-memory snapshot of Portainer stacks and containers
+
+    - run(): background loop refreshing every INVENTORY_REFRESH_INTERVAL seconds
+    - get(refresh=True): force a live read (single-flight)
+    - Change detection: a fingerprint over stack/container identity and state;
+      'version' and 'last_changed' only move when the inventory actually changes
+    """
+
+    def __init__(self, interval: int = INVENTORY_REFRESH_INTERVAL):
+        self.interval = interval
+        self.snapshot: Optional[Dict[str, Any]] = None
+        self._stale = False
+        self._lock = asyncio.Lock()
+        # Monotonic time the current snapshot's live read started / last mark_stale()
+        self._refreshed_at = 0.0
+        self._stale_at = 0.0
+
+    @staticmethod
+    def _fingerprint(stacks: list, containers: list) -> str:
+        # Container 'status' ("Up 5 minutes") changes constantly - only track identity and state
+        payload = {
+            'stacks': sorted((str(s.get('Id')), s.get('Name'), s.get('Status')) for s in stacks if isinstance(s, dict)),
+            'containers': sorted((c.get('id'), tuple(c.get('names') or []), c.get('state'), c.get('image')) for c in containers)
+        }
+        return hashlib.sha256(json.dumps(payload, default=str).encode()).hexdigest()
+
+    @staticmethod
+    def _diff(old: Optional[Dict[str, Any]], containers: list) -> Dict[str, Any]:
+        if not old:
+            return {}
+        old_states = {c['id']: c.get('state') for c in old.get('containers', [])}
+        new_states = {c['id']: c.get('state') for c in containers}
+        names = {c['id']: (c.get('names') or [c['id']])[0].lstrip('/') for c in old.get('containers', []) + containers}
+        return {
+            'added': [names[i] for i in new_states.keys() - old_states.keys()],
+            'removed': [names[i] for i in old_states.keys() - new_states.keys()],
+            'state_changed': [
+                {'container': names[i], 'from': old_states[i], 'to': new_states[i]}
+                for i in new_states.keys() & old_states.keys()
+                if old_states[i] != new_states[i]
+            ]
+        }
+
+    async def refresh(self) -> Dict[str, Any]:
+        """Read stacks and containers live from Portainer and update the snapshot"""
+        requested_at = time.monotonic()
+        async with self._lock:
+            # Single-flight: callers that queued behind a refresh share its result,
+            # as long as that read started after they asked
+            if self._refreshed_at >= requested_at and not self._stale and self.snapshot is not None:
+                return self.snapshot
+
+            started = time.monotonic()
+            status_result, stacks_result, containers_result = await asyncio.gather(
+                portainer_service._request('GET', 'system/status'),
+                portainer_service._request('GET', 'stacks'),
+                portainer_service.get_containers(strict=True),
+                return_exceptions=True
+            )
+            now = datetime.now(timezone.utc).isoformat()
+            connected = isinstance(status_result, dict) and 'error' not in status_result
+            status_error = None if connected else (
+                status_result.get('error') if isinstance(status_result, dict) else str(status_result)
+            )
+
+            previous = self.snapshot
+            if not connected and previous:
+                # Keep serving the last good inventory, flagged as disconnected
+                self.snapshot = {**previous, 'connected': False, 'error': status_error, 'last_refreshed': now}
+                self._mark_refreshed(started)
+                return self.snapshot
+
+            if isinstance(stacks_result, list):
+                stacks = stacks_result
+            else:
+                # A failed stacks call must not look like "all stacks removed"
+                stacks = previous.get('stacks', []) if previous else []
+                logger.warning(f"[INVENTORY] Stack list failed, keeping previous stacks: {stacks_result}")
+            if not isinstance(containers_result, Exception):
+                containers = containers_result
+            else:
+                # Same for containers - otherwise every container would be reported as removed
+                containers = previous.get('containers', []) if previous else []
+                logger.warning(f"[INVENTORY] {containers_result}, keeping previous containers")
+
+            fingerprint = self._fingerprint(stacks, containers)
+            changed = previous is None or previous.get('fingerprint') != fingerprint
+            if changed and previous:
+                changes = self._diff(previous, containers)
+                logger.info(f"[INVENTORY] Portainer inventory changed: {changes}")
+            else:
+                changes = previous.get('changes', {}) if previous else {}
+
+            self.snapshot = {
+                'connected': connected,
+                'error': status_error,
+                'stacks': stacks,
+                'containers': containers,
+                'fingerprint': fingerprint,
+                'version': (previous.get('version', 0) + 1 if changed else previous.get('version', 0)) if previous else 1,
+                'changes': changes,
+                'last_changed': now if changed else previous.get('last_changed'),
+                'last_refreshed': now
+            }
+            self._mark_refreshed(started)
+            return self.snapshot
+
+    def _mark_refreshed(self, started: float):
+        self._refreshed_at = started
+        # A mark_stale() that arrived during the read still forces the next get() live
+        self._stale = self._stale_at >= started
+
+    async def get(self, refresh: bool = False) -> Dict[str, Any]:
+        """Current snapshot; reads live when asked to, when marked stale, or before the first refresh"""
+        if refresh or self._stale or self.snapshot is None:
+            return await self.refresh()
+        return self.snapshot
+
+    def mark_stale(self):
+        """Force the next get() to read live (e.g. after creating or deleting a stack)"""
+        self._stale = True
+        self._stale_at = time.monotonic()
+
+    async def run(self):
+        """Background refresher"""
+        while True:
+            try:
+                await self.refresh()
+            except Exception as e:
+                logger.warning(f"[INVENTORY] Refresh failed: {e}")
+            await asyncio.sleep(self.interval)
+
+
+# Singleton instance
+portainer_inventory = PortainerInventory()
@@ -4,12 +4,20 @@ Handles automatic deployment of company stacks to Portainer
 """
 
 import os
+import asyncio
 import httpx
 import logging
 import tarfile
+import hashlib
+import gzip
+import lzma
 import io as std_io
 from typing import Optional, Dict, Any
 from datetime import datetime, timezone
+from pymongo import ReturnDocument
+from pymongo.errors import OperationFailure
+
+from .tenant_db_registry import tenant_db_registry, get_safe_code, get_tenant_mongo_url, TENANT_MONGO_MODE
 
 logger = logging.getLogger(__name__)
 
@@ -19,6 +27,68 @@ PORTAINER_URL = os.environ.get('PORTAINER_URL', 'https://72.61.158.147:9443')
 PORTAINER_API_KEY = os.environ.get('PORTAINER_API_KEY', 'ptr_XwtYmxpR0KCkqMLsPLGMM4mHQS5Q75gupgBcCGqRUEY=')
 PORTAINER_ENDPOINT_ID = int(os.environ.get('PORTAINER_ENDPOINT_ID', '3'))
 SERVER_IP = os.environ.get('SERVER_IP', '72.61.158.147')
+# SuperAdmin API that tenant backends push support ticket events to
+SUPERADMIN_API_URL = os.environ.get('SUPERADMIN_API_URL', f'http://{SERVER_IP}:9001')
+TENANT_SECRET = os.environ.get('TENANT_SECRET', '')
+
+# Tenant routing: 'docker' = container labels, 'file' = Traefik file provider (hot reload).
+# File mode needs Traefik redeployed with the file provider and the dynamic volume
+# (get_traefik_compose_template) - only switch once that is live.
+TRAEFIK_ROUTING_MODE = os.environ.get('TRAEFIK_ROUTING_MODE', 'docker')
+# Traefik API for route readiness checks (internal address); unset skips the checks
+TRAEFIK_API_URL = os.environ.get('TRAEFIK_API_URL', '')
+TRAEFIK_DYNAMIC_DIR = '/etc/traefik/dynamic'
+
+# Multi-tenant backend serving consolidated tenants (resolved by Host header)
+SHARED_BACKEND_CONTAINER = 'shared_tenant_backend'
+SHARED_BACKEND_TENANT_MAP = '/app/tenants.json'
+
+# Shared static frontend: one React build, config.js generated per Host
+TENANT_FRONTEND_MODE = os.environ.get('TENANT_FRONTEND_MODE', 'dedicated')  # 'dedicated' | 'shared'
+SHARED_FRONTEND_CONTAINER = 'shared_tenant_frontend'
+
+# Container resource profiles per subscription plan (keys match SUBSCRIPTION_PLANS)
+PLAN_RESOURCE_PROFILES = {
+    'free': {
+        'backend_memory_mb': 256, 'backend_cpu_shares': 256, 'backend_workers': 1,
+        'mongo_memory_mb': 512, 'mongo_cpu_shares': 256, 'mongo_cache_gb': 0.25,
+        'frontend_memory_mb': 64
+    },
+    'starter': {
+        'backend_memory_mb': 384, 'backend_cpu_shares': 512, 'backend_workers': 2,
+        'mongo_memory_mb': 768, 'mongo_cpu_shares': 512, 'mongo_cache_gb': 0.25,
+        'frontend_memory_mb': 64
+    },
+    'professional': {
+        'backend_memory_mb': 768, 'backend_cpu_shares': 1024, 'backend_workers': 3,
+        'mongo_memory_mb': 1536, 'mongo_cpu_shares': 1024, 'mongo_cache_gb': 0.75,
+        'frontend_memory_mb': 128
+    },
+    'enterprise': {
+        'backend_memory_mb': 1536, 'backend_cpu_shares': 2048, 'backend_workers': 4,
+        'mongo_memory_mb': 3072, 'mongo_cpu_shares': 2048, 'mongo_cache_gb': 1.5,
+        'frontend_memory_mb': 128
+    }
+}
+
+# Offline wheelhouse for tenant backend dependencies (built once in the template backend)
+TEMPLATE_REQUIREMENTS_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'template', 'backend', 'requirements.txt')
+WHEELHOUSE_VOLUME = 'rentacar_wheelhouse'
+WHEELHOUSE_PATH = '/wheelhouse'
+# Lives next to site-packages so it disappears together with the installed packages
+INSTALLED_REQUIREMENTS_MARKER = '/usr/local/lib/.requirements-hash'
+
+# Build-time precompression of frontend assets (served by nginx gzip_static)
+# Source maps (.map) are left out: only dev tools fetch them, they would just double the upload
+PRECOMPRESS_EXTENSIONS = ('.js', '.css', '.html', '.svg', '.json', '.txt', '.ico', '.xml')
+PRECOMPRESS_MIN_SIZE = int(os.environ.get('PRECOMPRESS_MIN_SIZE', '1024'))
+# Rewritten per tenant after upload - a precompressed copy would go stale
+PRECOMPRESS_SKIP_FILES = ('config.js',)
+
+# Compression for tar uploads to the Docker archive API: 'gzip' | 'xz' | 'none'
+ARCHIVE_COMPRESSION = os.environ.get('ARCHIVE_COMPRESSION', 'gzip')
+GZIP_MAGIC = b'\x1f\x8b'
+XZ_MAGIC = b'\xfd7zXZ\x00'
 
 # Port allocation range for companies
 BASE_FRONTEND_PORT = 10000
@@ -136,13 +206,39 @@ networks:
 """
 
 
-def get_full_company_stack_template(company_code: str, company_name: str, domain: str, port_offset: int) -> str:
+def get_resource_profile(plan: Optional[str]) -> Dict[str, Any]:
+    """Resource profile for a subscription plan (unknown plans get the starter profile)"""
+    return PLAN_RESOURCE_PROFILES.get(plan or 'free', PLAN_RESOURCE_PROFILES['starter'])
+
+
+def get_gunicorn_conf(workers: int) -> str:
+    """
+    /app/gunicorn_conf.py for tenant backends - the image's start script prefers it
+    over WEB_CONCURRENCY, so a plan change survives container restarts
+    """
+    return f"""# Generated by SuperAdmin from the subscription plan - do not edit by hand
+bind = "0.0.0.0:80"
+workers = {workers}
+keepalive = 120
+loglevel = "info"
+errorlog = "-"
+accesslog = "-"
+"""
+
+
+def get_full_company_stack_template(company_code: str, company_name: str, domain: str, port_offset: int, mongo_mode: Optional[str] = None, frontend_mode: Optional[str] = None, plan: Optional[str] = None) -> str:
     """
     Generate Docker Compose for a complete company stack with Traefik SSL.
     Template files will be copied via Portainer API after stack creation.
     Includes mobile app containers for Customer and Operation apps.
+    
+    mongo_mode 'shared' leaves out the per-tenant MongoDB container; the backend
+    uses its own database and user on the shared instance instead.
+    frontend_mode 'shared' leaves out the per-tenant Nginx; the web panel is
+    served by the shared static frontend.
+    plan selects memory/CPU limits, Mongo cache size and gunicorn workers.
     """
-    safe_code = company_code.replace('-', '').replace('_', '')
+    safe_code = get_safe_code(company_code)
     
     frontend_port = BASE_FRONTEND_PORT + port_offset
     backend_port = BASE_BACKEND_PORT + port_offset
@@ -151,13 +247,47 @@ def get_full_company_stack_template(company_code: str, company_name: str, domain
     # Expo token from environment
     expo_token = os.environ.get("EXPO_TOKEN", "")
     
-    return f"""version: '3.8'
-
-services:
+    resources = get_resource_profile(plan)
+    
+    # In file mode routes come from the Traefik dynamic config, not container labels
+    if TRAEFIK_ROUTING_MODE == 'docker':
+        backend_labels = f"""
+    labels:
+      - "traefik.enable=true"
+      - "traefik.http.routers.{safe_code}-api.rule=Host(`api.{domain}`)"
+      - "traefik.http.routers.{safe_code}-api.entrypoints=websecure"
+      - "traefik.http.routers.{safe_code}-api.tls.certresolver=letsencrypt"
+      - "traefik.http.services.{safe_code}-api.loadbalancer.server.port=80\""""
+        frontend_labels = f"""
+    labels:
+      - "traefik.enable=true"
+      - "traefik.http.routers.{safe_code}-web.rule=Host(`{domain}`) || Host(`www.{domain}`)"
+      - "traefik.http.routers.{safe_code}-web.entrypoints=websecure"
+      - "traefik.http.routers.{safe_code}-web.tls.certresolver=letsencrypt"
+      - "traefik.http.routers.{safe_code}-web.service={safe_code}-frontend"
+      - "traefik.http.routers.{safe_code}-panel.rule=Host(`panel.{domain}`)"
+      - "traefik.http.routers.{safe_code}-panel.entrypoints=websecure"
+      - "traefik.http.routers.{safe_code}-panel.tls.certresolver=letsencrypt"
+      - "traefik.http.routers.{safe_code}-panel.service={safe_code}-frontend"
+      - "traefik.http.services.{safe_code}-frontend.loadbalancer.server.port=80\""""
+    else:
+        backend_labels = ""
+        frontend_labels = ""
+    
+    if (mongo_mode or TENANT_MONGO_MODE) == 'shared':
+        mongo_service = ""
+        mongo_url = get_tenant_mongo_url(company_code, 'shared')
+        backend_depends = ""
+        mongo_volume = ""
+    else:
+        mongo_service = f"""
   {safe_code}_mongodb:
     image: mongo:6.0
     container_name: {safe_code}_mongodb
     restart: unless-stopped
+    command: ["mongod", "--wiredTigerCacheSizeGB", "{resources['mongo_cache_gb']}"]
+    mem_limit: {resources['mongo_memory_mb']}m
+    cpu_shares: {resources['mongo_cpu_shares']}
     environment:
       - MONGO_INITDB_DATABASE={safe_code}_db
     volumes:
@@ -167,13 +297,43 @@ services:
     networks:
       - {safe_code}_network
       - traefik_network
+"""
+        mongo_url = f"mongodb://{safe_code}_mongodb:27017"
+        backend_depends = f"""
+    depends_on:
+      - {safe_code}_mongodb"""
+        mongo_volume = f"""
+  {safe_code}_mongo_data:"""
+    
+    if (frontend_mode or TENANT_FRONTEND_MODE) == 'shared':
+        frontend_service = ""
+    else:
+        frontend_service = f"""
+  {safe_code}_frontend:
+    image: nginx:alpine
+    container_name: {safe_code}_frontend
+    restart: unless-stopped
+    mem_limit: {resources['frontend_memory_mb']}m
+    ports:
+      - "{frontend_port}:80"
+    depends_on:
+      - {safe_code}_backend
+    networks:
+      - {safe_code}_network
+      - traefik_network{frontend_labels}
+"""
+    
+    return f"""version: '3.8'
 
+services:{mongo_service}
   {safe_code}_backend:
     image: tiangolo/uvicorn-gunicorn-fastapi:python3.11-slim
     container_name: {safe_code}_backend
     restart: unless-stopped
+    mem_limit: {resources['backend_memory_mb']}m
+    cpu_shares: {resources['backend_cpu_shares']}
     environment:
-      - MONGO_URL=mongodb://{safe_code}_mongodb:27017
+      - MONGO_URL={mongo_url}
       - DB_NAME={safe_code}_db
       - JWT_SECRET={safe_code}_jwt_secret_2024
       - COMPANY_CODE={company_code}
@@ -182,43 +342,17 @@ services:
       - DOMAIN={domain}
       - MODULE_NAME=server
       - VARIABLE_NAME=app
+      - WEB_CONCURRENCY={resources['backend_workers']}
+      - SUPERADMIN_API_URL={SUPERADMIN_API_URL}
+      - TENANT_SECRET={TENANT_SECRET}
     ports:
       - "{backend_port}:80"
-    depends_on:
-      - {safe_code}_mongodb
-    networks:
-      - {safe_code}_network
-      - traefik_network
-    labels:
-      - "traefik.enable=true"
-      - "traefik.http.routers.{safe_code}-api.rule=Host(`api.{domain}`)"
-      - "traefik.http.routers.{safe_code}-api.entrypoints=websecure"
-      - "traefik.http.routers.{safe_code}-api.tls.certresolver=letsencrypt"
-      - "traefik.http.services.{safe_code}-api.loadbalancer.server.port=80"
-
-  {safe_code}_frontend:
-    image: nginx:alpine
-    container_name: {safe_code}_frontend
-    restart: unless-stopped
-    ports:
-      - "{frontend_port}:80"
-    depends_on:
-      - {safe_code}_backend
+    volumes:
+      - {WHEELHOUSE_VOLUME}:{WHEELHOUSE_PATH}:ro{backend_depends}
     networks:
       - {safe_code}_network
-      - traefik_network
-    labels:
-      - "traefik.enable=true"
-      - "traefik.http.routers.{safe_code}-web.rule=Host(`{domain}`) || Host(`www.{domain}`)"
-      - "traefik.http.routers.{safe_code}-web.entrypoints=websecure"
-      - "traefik.http.routers.{safe_code}-web.tls.certresolver=letsencrypt"
-      - "traefik.http.routers.{safe_code}-web.service={safe_code}-frontend"
-      - "traefik.http.routers.{safe_code}-panel.rule=Host(`panel.{domain}`)"
-      - "traefik.http.routers.{safe_code}-panel.entrypoints=websecure"
-      - "traefik.http.routers.{safe_code}-panel.tls.certresolver=letsencrypt"
-      - "traefik.http.routers.{safe_code}-panel.service={safe_code}-frontend"
-      - "traefik.http.services.{safe_code}-frontend.loadbalancer.server.port=80"
-
+      - traefik_network{backend_labels}
+{frontend_service}
   {safe_code}_customer_app:
     image: node:20-alpine
     container_name: {safe_code}_customer_app
@@ -249,8 +383,9 @@ services:
     networks:
       - {safe_code}_network
 
-volumes:
-  {safe_code}_mongo_data:
+volumes:{mongo_volume}
+  {WHEELHOUSE_VOLUME}:
+    name: {WHEELHOUSE_VOLUME}
 
 networks:
   {safe_code}_network:
@@ -286,6 +421,7 @@ services:
     restart: unless-stopped
     volumes:
       - rentacar_template_backend:/app
+      - rentacar_wheelhouse:/wheelhouse
     ports:
       - "11099:80"
     networks:
@@ -326,6 +462,8 @@ volumes:
     name: rentacar_template_customer_app
   rentacar_template_operation_app:
     name: rentacar_template_operation_app
+  rentacar_wheelhouse:
+    name: rentacar_wheelhouse
 
 networks:
   template_network:
@@ -350,6 +488,8 @@ services:
       - "--providers.docker=true"
       - "--providers.docker.exposedbydefault=false"
       - "--providers.docker.network=traefik_network"
+      - "--providers.file.directory=/etc/traefik/dynamic"
+      - "--providers.file.watch=true"
       - "--entrypoints.web.address=:80"
       - "--entrypoints.web.http.redirections.entrypoint.to=websecure"
       - "--entrypoints.web.http.redirections.entrypoint.scheme=https"
@@ -365,6 +505,7 @@ services:
     volumes:
       - /var/run/docker.sock:/var/run/docker.sock:ro
       - traefik_certs:/letsencrypt
+      - traefik_dynamic:/etc/traefik/dynamic
     networks:
       - traefik_network
     labels:
@@ -374,6 +515,7 @@ services:
 
 volumes:
   traefik_certs:
+  traefik_dynamic:
 
 networks:
   traefik_network:
@@ -382,6 +524,344 @@ networks:
 """
 
 
+def get_shared_mongo_compose_template() -> str:
+    """
+    Generate the shared MongoDB stack used by tenants in shared mode.
+    Tenants reach it on traefik_network as shared_mongodb:27017 and authenticate
+    with their own per-database user; root credentials come from the stack env.
+    """
+    return """version: '3.8'
+
+services:
+  shared_mongodb:
+    image: mongo:6.0
+    container_name: shared_mongodb
+    restart: unless-stopped
+    command: ["mongod", "--auth"]
+    environment:
+      - MONGO_INITDB_ROOT_USERNAME=${MONGO_ROOT_USERNAME}
+      - MONGO_INITDB_ROOT_PASSWORD=${MONGO_ROOT_PASSWORD}
+    volumes:
+      - shared_mongo_data:/data/db
+    ports:
+      - "27100:27017"
+    networks:
+      - traefik_network
+
+volumes:
+  shared_mongo_data:
+    name: shared_mongo_data
+
+networks:
+  traefik_network:
+    external: true
+"""
+
+
+def get_shared_backend_compose_template() -> str:
+    """
+    Generate the multi-tenant backend stack.
+    Runs template/backend/server.py with MULTI_TENANT=true; the tenant map is
+    written to /app/tenants.json by SuperAdmin.
+    """
+    return f"""version: '3.8'
+
+services:
+  {SHARED_BACKEND_CONTAINER}:
+    image: tiangolo/uvicorn-gunicorn-fastapi:python3.11-slim
+    container_name: {SHARED_BACKEND_CONTAINER}
+    restart: unless-stopped
+    environment:
+      - MULTI_TENANT=true
+      - TENANT_MAP_PATH={SHARED_BACKEND_TENANT_MAP}
+      - MODULE_NAME=server
+      - VARIABLE_NAME=app
+      - SUPERADMIN_API_URL={SUPERADMIN_API_URL}
+      - TENANT_SECRET={TENANT_SECRET}
+    volumes:
+      - shared_tenant_backend:/app
+      - {WHEELHOUSE_VOLUME}:{WHEELHOUSE_PATH}:ro
+    networks:
+      - traefik_network
+
+volumes:
+  shared_tenant_backend:
+    name: shared_tenant_backend
+  {WHEELHOUSE_VOLUME}:
+    name: {WHEELHOUSE_VOLUME}
+
+networks:
+  traefik_network:
+    external: true
+"""
+
+
+def get_shared_frontend_compose_template() -> str:
+    """
+    Generate the shared static frontend stack: one Nginx and one React build
+    for every tenant web panel in shared frontend mode
+    """
+    return f"""version: '3.8'
+
+services:
+  {SHARED_FRONTEND_CONTAINER}:
+    image: nginx:alpine
+    container_name: {SHARED_FRONTEND_CONTAINER}
+    restart: unless-stopped
+    volumes:
+      - shared_tenant_frontend:/usr/share/nginx/html
+    networks:
+      - traefik_network
+
+volumes:
+  shared_tenant_frontend:
+    name: shared_tenant_frontend
+
+networks:
+  traefik_network:
+    external: true
+"""
+
+
+def get_shared_frontend_nginx_conf() -> str:
+    """
+    Nginx server for the shared frontend. config.js is not a file: it is rendered
+    from $tenant_api_url, which tenants_map.conf maps from the request Host.
+    """
+    return """server {
+    listen 80;
+    server_name _;
+    root /usr/share/nginx/html;
+    index index.html;
+
+    location / {
+        try_files $uri $uri/ /index.html;
+    }
+
+    location ~* \\.(js|css|png|jpg|jpeg|gif|ico|svg|woff|woff2)$ {
+        expires 1y;
+        add_header Cache-Control "public, immutable";
+    }
+
+    location = /index.html {
+        add_header Cache-Control "no-cache, no-store, must-revalidate";
+    }
+
+    location = /config.js {
+        default_type application/javascript;
+        add_header Cache-Control "no-cache, no-store, must-revalidate";
+        if ($tenant_api_url = "") {
+            return 404;
+        }
+        return 200 'window.REACT_APP_BACKEND_URL = "$tenant_api_url";';
+    }
+
+    gzip_static on;
+    gzip on;
+    gzip_vary on;
+    gzip_min_length 1024;
+    gzip_types text/plain text/css application/json application/javascript text/xml application/xml image/svg+xml;
+}
+"""
+
+
+def get_shared_frontend_host_map(tenants: list) -> str:
+    """
+    Host -> API URL map for the shared frontend's config.js
+    
+    Args:
+        tenants: List of {'domain': ...}
+    """
+    lines = []
+    for tenant in tenants:
+        domain = tenant['domain']
+        for host in (domain, f"www.{domain}", f"panel.{domain}"):
+            lines.append(f"    {host} https://api.{domain};")
+    entries = "\n".join(lines)
+    return f"""# Generated by SuperAdmin from the companies collection - do not edit by hand
+map $host $tenant_api_url {{
+    hostnames;
+    default "";
+{entries}
+}}
+"""
+
+
+def get_requirements_hash(requirements: str) -> str:
+    """Wheelhouse key: hash of the normalized requirement lines (order and comments ignored)"""
+    lines = sorted(
+        line.strip() for line in requirements.splitlines()
+        if line.strip() and not line.strip().startswith('#')
+    )
+    return hashlib.sha256("\n".join(lines).encode('utf-8')).hexdigest()[:16]
+
+
+def precompress_static_assets(build_dir: str, min_size: int = PRECOMPRESS_MIN_SIZE) -> Dict[str, Any]:
+    """
+    Write .gz siblings for compressible files in a frontend build so nginx
+    (gzip_static) serves them without compressing on every request.
+    Siblings that are newer than their source are kept as they are.
+    """
+    stats = {'compressed': 0, 'skipped': 0, 'original_bytes': 0, 'compressed_bytes': 0}
+    for root, dirs, files in os.walk(build_dir):
+        for file in files:
+            if not file.endswith(PRECOMPRESS_EXTENSIONS) or file in PRECOMPRESS_SKIP_FILES:
+                continue
+            file_path = os.path.join(root, file)
+            size = os.path.getsize(file_path)
+            if size < min_size:
+                continue
+
+            gz_path = f"{file_path}.gz"
+            if os.path.exists(gz_path) and os.path.getmtime(gz_path) >= os.path.getmtime(file_path):
+                stats['skipped'] += 1
+                continue
+
+            with open(file_path, 'rb') as f:
+                # mtime=0 keeps the output byte-identical across rebuilds of the same file
+                compressed = gzip.compress(f.read(), compresslevel=9, mtime=0)
+            if len(compressed) >= size:
+                continue
+            with open(gz_path, 'wb') as f:
+                f.write(compressed)
+            stats['compressed'] += 1
+            stats['original_bytes'] += size
+            stats['compressed_bytes'] += len(compressed)
+
+    logger.info(f"[PRECOMPRESS] {build_dir}: {stats}")
+    return stats
+
+
+def compress_tar(tar_data: bytes, compression: Optional[str] = None) -> bytes:
+    """
+    Compress a tar archive for PUT /containers/{id}/archive (Docker detects
+    gzip and xz itself). Archives that are already compressed are returned as is.
+    """
+    compression = compression or ARCHIVE_COMPRESSION
+    if tar_data.startswith(GZIP_MAGIC) or tar_data.startswith(XZ_MAGIC):
+        return tar_data
+    if compression == 'xz':
+        return lzma.compress(tar_data, format=lzma.FORMAT_XZ, check=lzma.CHECK_CRC32, preset=6)
+    if compression == 'gzip':
+        return gzip.compress(tar_data, compresslevel=6, mtime=0)
+    return tar_data
+
+
+# (path, include, exclude_prefixes, compression) -> {'fingerprint', 'data'}
+_archive_cache: Dict[tuple, Dict[str, Any]] = {}
+
+
+def _iter_archive_files(path: str, include: Optional[tuple], exclude_prefixes: tuple):
+    """(file_path, arcname) pairs in a stable order; include limits to top-level files/folders"""
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for file in sorted(files):
+            file_path = os.path.join(root, file)
+            arcname = os.path.relpath(file_path, path)
+            if include and arcname.split(os.sep, 1)[0] not in include:
+                continue
+            if arcname.startswith(exclude_prefixes):
+                continue
+            yield file_path, arcname
+
+
+def build_directory_archive(path: str, exclude_prefixes: tuple = (), compression: Optional[str] = None, include: Optional[tuple] = None) -> bytes:
+    """
+    Compressed tar of a directory (paths relative to it).
+    The archive is cached and reused until a file under path changes, so
+    deploying the same build to many tenants compresses it only once.
+
+    Args:
+        include: Only these top-level files/folders (e.g. ('server.py', 'services'))
+    """
+    compression = compression or ARCHIVE_COMPRESSION
+    include = tuple(include) if include else None
+    exclude_prefixes = tuple(exclude_prefixes)
+    key = (os.path.abspath(path), include, exclude_prefixes, compression)
+
+    digest = hashlib.sha256()
+    files = list(_iter_archive_files(path, include, exclude_prefixes))
+    for file_path, arcname in files:
+        stat = os.stat(file_path)
+        digest.update(f"{arcname}:{stat.st_size}:{stat.st_mtime_ns}\n".encode('utf-8'))
+    fingerprint = digest.hexdigest()
+
+    cached = _archive_cache.get(key)
+    if cached and cached['fingerprint'] == fingerprint:
+        return cached['data']
+
+    tar_buffer = std_io.BytesIO()
+    with tarfile.open(fileobj=tar_buffer, mode='w') as tar:
+        for file_path, arcname in files:
+            tar.add(file_path, arcname=arcname)
+
+    tar_data = tar_buffer.getvalue()
+    data = compress_tar(tar_data, compression)
+    _archive_cache[key] = {'fingerprint': fingerprint, 'data': data}
+    logger.info(f"[ARCHIVE] {path}: {len(tar_data)} -> {len(data)} bytes ({compression})")
+    return data
+
+
+def get_traefik_dynamic_config_template(tenants: list) -> str:
+    """
+    Generate Traefik file-provider dynamic config for all tenant stacks.
+    Traefik watches the directory and applies changes without a restart.
+    
+    Args:
+        tenants: List of {'code', 'domain', 'backend_mode', 'frontend_mode'}; 'shared'
+                 modes route to the shared tenant backend / static frontend
+    """
+    routers = []
+    services = []
+    for tenant in tenants:
+        safe_code = get_safe_code(tenant['code'])
+        domain = tenant['domain']
+        if tenant.get('backend_mode') == 'shared':
+            api_url = f"http://{SHARED_BACKEND_CONTAINER}:80"
+        else:
+            api_url = f"http://{safe_code}_backend:80"
+        if tenant.get('frontend_mode') == 'shared':
+            web_url = f"http://{SHARED_FRONTEND_CONTAINER}:80"
+        else:
+            web_url = f"http://{safe_code}_frontend:80"
+        routers.append(f"""    {safe_code}-api:
+      rule: "Host(`api.{domain}`)"
+      entryPoints: [websecure]
+      service: {safe_code}-api
+      tls:
+        certResolver: letsencrypt
+    {safe_code}-web:
+      rule: "Host(`{domain}`) || Host(`www.{domain}`)"
+      entryPoints: [websecure]
+      service: {safe_code}-frontend
+      tls:
+        certResolver: letsencrypt
+    {safe_code}-panel:
+      rule: "Host(`panel.{domain}`)"
+      entryPoints: [websecure]
+      service: {safe_code}-frontend
+      tls:
+        certResolver: letsencrypt""")
+        services.append(f"""    {safe_code}-api:
+      loadBalancer:
+        servers:
+          - url: "{api_url}"
+    {safe_code}-frontend:
+      loadBalancer:
+        servers:
+          - url: "{web_url}\"""")
+    
+    routers_yaml = "\n".join(routers) if routers else "    {}"
+    services_yaml = "\n".join(services) if services else "    {}"
+    return f"""# Generated by SuperAdmin from the companies collection - do not edit by hand
+http:
+  routers:
+{routers_yaml}
+  services:
+{services_yaml}
+"""
+
+
 def get_superadmin_compose_template(github_repo: str = "https://github.com/vegabyte-emre/vega-rent.git") -> str:
     """
     Generate Docker Compose YAML for SuperAdmin stack
@@ -479,6 +959,8 @@ class PortainerService:
             'X-API-Key': self.api_key,
             'Content-Type': 'application/json'
         }
+        # Requirements hash whose wheelhouse is known to be complete
+        self._wheelhouse_hash: Optional[str] = None
     
     async def _request(self, method: str, endpoint: str, data: Optional[Dict] = None, files: Optional[Dict] = None) -> Dict[str, Any]:
         """Make request to Portainer API"""
@@ -521,8 +1003,8 @@ class PortainerService:
             return result
         return []
     
-    async def get_containers(self) -> list:
-        """Get all containers from Portainer"""
+    async def get_containers(self, strict: bool = False) -> list:
+        """Get all containers from Portainer (strict: raise instead of returning [] when the read fails)"""
         endpoint = f"endpoints/{self.endpoint_id}/docker/containers/json?all=true"
         result = await self._request('GET', endpoint)
         if isinstance(result, list):
@@ -536,6 +1018,8 @@ class PortainerService:
                 }
                 for c in result
             ]
+        if strict:
+            raise RuntimeError(f"Container list failed: {result.get('error') if isinstance(result, dict) else result}")
         return []
     
     async def _get_container_port(self, container_name: str) -> Optional[int]:
@@ -572,40 +1056,99 @@ class PortainerService:
                 logger.error(f"Stack delete error: {str(e)}")
                 return {'error': str(e)}
     
-    async def get_next_port_offset(self, db) -> int:
-        """Get next available port offset based on existing companies and Portainer stacks"""
-        # Find the highest port_offset used in database
-        companies = await db.companies.find(
-            {'port_offset': {'$exists': True, '$ne': None}},
-            {'port_offset': 1}
-        ).to_list(1000)
-        
-        # Also check Portainer for existing stacks to avoid conflicts
+    async def init_port_offset_allocator(self, db) -> int:
+        """
+        Create port offset indexes and seed the counter document.
+        Runs once at startup; $max keeps it idempotent and never moves the counter backwards.
+        """
+        try:
+            await db.companies.create_index(
+                "port_offset",
+                unique=True,
+                partialFilterExpression={"port_offset": {"$type": "number"}}
+            )
+        except OperationFailure as e:
+            # Legacy duplicate allocations - log them and keep starting; the counter still avoids new clashes
+            duplicates = await db.companies.aggregate([
+                {'$match': {'port_offset': {'$type': 'number'}}},
+                {'$group': {'_id': '$port_offset', 'codes': {'$push': '$code'}, 'count': {'$sum': 1}}},
+                {'$match': {'count': {'$gt': 1}}}
+            ]).to_list(None)
+            for dup in duplicates:
+                logger.error(f"[PORT] Duplicate port offset {dup['_id']}: {', '.join(str(c) for c in dup['codes'])}")
+            logger.error(f"[PORT] Unique port_offset index not created: {e}")
+        await db.port_offset_pool.create_index("port_offset", unique=True)
+        
+        # Seed from existing companies and Portainer stacks (legacy allocations)
+        highest = await db.companies.find_one(
+            {'port_offset': {'$type': 'number'}},
+            {'port_offset': 1},
+            sort=[('port_offset', -1)]
+        )
+        max_offset = highest.get('port_offset', 0) if highest else 0
         try:
             stacks = await self.get_stacks()
             stack_count = len([s for s in stacks if isinstance(s, dict) and s.get('Name', '').startswith('rentacar_')])
-        except:
+        except Exception as e:
+            logger.warning(f"[PORT] Could not count Portainer stacks: {e}")
             stack_count = 0
         
-        if not companies:
-            # Start from offset that accounts for existing Portainer stacks
-            # Add +5 buffer to avoid any potential conflicts
-            return max(stack_count + 5, 5)
-        
-        max_offset = max(c.get('port_offset', 0) for c in companies)
-        # Ensure new offset is higher than both max in DB and stack count
-        next_offset = max(max_offset + 1, stack_count + 5)
-        
-        logger.info(f"[PORT] Next port offset: {next_offset} (DB max: {max_offset}, Portainer stacks: {stack_count})")
-        return next_offset
+        # First allocation on an empty system is 5 (+5 buffer for pre-existing stacks)
+        seed = max(max_offset, stack_count + 4, 4)
+        await db.counters.update_one(
+            {'_id': 'port_offset'},
+            {'$max': {'value': seed}},
+            upsert=True
+        )
+        logger.info(f"[PORT] Port offset counter seeded at {seed} (DB max: {max_offset}, Portainer stacks: {stack_count})")
+        return seed
+    
+    async def allocate_port_offset(self, db) -> int:
+        """
+        Atomically allocate a port offset.
+        Reuses the lowest offset released by deprovisioning, otherwise increments the counter.
+        """
+        released = await db.port_offset_pool.find_one_and_delete({}, sort=[('port_offset', 1)])
+        if released:
+            logger.info(f"[PORT] Reusing released port offset: {released['port_offset']}")
+            return released['port_offset']
+        
+        counter = await db.counters.find_one_and_update(
+            {'_id': 'port_offset'},
+            {'$inc': {'value': 1}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        logger.info(f"[PORT] Allocated port offset: {counter['value']}")
+        return counter['value']
+    
+    async def release_port_offset(self, db, port_offset: Optional[int]):
+        """Return a port offset to the free-list after its stack is removed"""
+        if port_offset is None:
+            return
+        await db.port_offset_pool.update_one(
+            {'port_offset': port_offset},
+            {'$setOnInsert': {
+                'port_offset': port_offset,
+                'released_at': datetime.now(timezone.utc).isoformat()
+            }},
+            upsert=True
+        )
+        logger.info(f"[PORT] Released port offset: {port_offset}")
     
-    async def create_full_stack(self, company_code: str, company_name: str, domain: str, port_offset: int) -> Dict[str, Any]:
+    async def create_full_stack(self, company_code: str, company_name: str, domain: str, port_offset: int, mongo_mode: Optional[str] = None, frontend_mode: Optional[str] = None, plan: Optional[str] = None) -> Dict[str, Any]:
         """
         Create a full company stack with Frontend + Backend + MongoDB
         With Traefik labels for domain-based routing
         """
+        mongo_mode = mongo_mode or TENANT_MONGO_MODE
+        frontend_mode = frontend_mode or TENANT_FRONTEND_MODE
         stack_name = f"rentacar_{company_code}"
-        compose_content = get_full_company_stack_template(company_code, company_name, domain, port_offset)
+        try:
+            compose_content = get_full_company_stack_template(company_code, company_name, domain, port_offset, mongo_mode, frontend_mode, plan)
+        except ValueError as e:
+            # e.g. shared MongoDB mode without SHARED_MONGO_SECRET
+            return {'success': False, 'error': str(e)}
         
         endpoint = f"stacks/create/standalone/string?endpointId={self.endpoint_id}"
         
@@ -623,10 +1166,13 @@ class PortainerService:
                 'success': True,
                 'stack_id': result.get('Id'),
                 'stack_name': stack_name,
+                'mongo_mode': mongo_mode,
+                'frontend_mode': frontend_mode,
+                'resource_plan': plan or 'free',
                 'ports': {
-                    'frontend': BASE_FRONTEND_PORT + port_offset,
+                    'frontend': BASE_FRONTEND_PORT + port_offset if frontend_mode != 'shared' else None,
                     'backend': BASE_BACKEND_PORT + port_offset,
-                    'mongodb': BASE_MONGO_PORT + port_offset
+                    'mongodb': BASE_MONGO_PORT + port_offset if mongo_mode != 'shared' else None
                 },
                 'urls': {
                     'website': f"https://{domain}",
@@ -829,12 +1375,260 @@ class PortainerService:
             logger.error(f"Traefik deployment failed: {result}")
             return {'success': False, 'error': result.get('error', 'Unknown error')}
 
-    async def check_traefik_status(self) -> Dict[str, Any]:
+    async def _update_container_resources(self, container_name: str, memory_mb: int, cpu_shares: Optional[int] = None) -> Dict[str, Any]:
+        """Change memory/CPU limits of a running container in place (no recreate)"""
+        container_id = await self.get_container_id(container_name)
+        if not container_id:
+            return {'error': f'Container {container_name} not found'}
+        
+        memory = memory_mb * 1024 * 1024
+        payload = {'Memory': memory, 'MemorySwap': memory * 2}
+        if cpu_shares:
+            payload['CpuShares'] = cpu_shares
+        result = await self._request('POST', f"endpoints/{self.endpoint_id}/docker/containers/{container_id}/update", data=payload)
+        if isinstance(result, dict) and 'error' in result:
+            return {'error': result['error']}
+        return {'success': True, 'memory_mb': memory_mb, 'cpu_shares': cpu_shares}
+
+    async def apply_resource_profile(self, company_code: str, plan: str, previous_plan: Optional[str] = None, mongo_mode: Optional[str] = None, frontend_mode: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Re-apply a plan's resource profile to a running tenant stack without recreating
+        containers (their code lives in the container filesystem):
+        - memory / CPU limits via the Docker update API
+        - Mongo WiredTiger cache via setParameter (until the next stack redeploy)
+        - gunicorn workers via TTIN/TTOU, pinned for restarts by /app/gunicorn_conf.py
+        """
+        safe_code = get_safe_code(company_code)
+        backend_container = f"{safe_code}_backend"
+        profile = get_resource_profile(plan)
+        results = {}
+        
+        results['backend'] = await self._update_container_resources(
+            backend_container, profile['backend_memory_mb'], profile['backend_cpu_shares']
+        )
+        
+        if (mongo_mode or TENANT_MONGO_MODE) != 'shared':
+            mongo_container = f"{safe_code}_mongodb"
+            results['mongodb'] = await self._update_container_resources(
+                mongo_container, profile['mongo_memory_mb'], profile['mongo_cpu_shares']
+            )
+            cache_mb = int(profile['mongo_cache_gb'] * 1024)
+            results['mongo_cache'] = await self.exec_in_container(
+                mongo_container,
+                f"mongosh --quiet --eval 'db.adminCommand({{setParameter: 1, wiredTigerEngineRuntimeConfig: \"cache_size={cache_mb}M\"}})'"
+            )
+        
+        if (frontend_mode or TENANT_FRONTEND_MODE) != 'shared':
+            results['frontend'] = await self._update_container_resources(
+                f"{safe_code}_frontend", profile['frontend_memory_mb']
+            )
+        
+        results['gunicorn_conf'] = await self.write_file_to_container(
+            backend_container, "/app/gunicorn_conf.py", get_gunicorn_conf(profile['backend_workers'])
+        )
+        if previous_plan:
+            # Gunicorn runs as PID 1: TTIN adds a worker, TTOU removes one
+            delta = profile['backend_workers'] - get_resource_profile(previous_plan)['backend_workers']
+            if delta:
+                signal = 'TTIN' if delta > 0 else 'TTOU'
+                results['workers'] = await self.exec_in_container(
+                    backend_container,
+                    " && ".join([f"kill -{signal} 1"] * abs(delta))
+                )
+        
+        errors = {k: v.get('error') for k, v in results.items() if isinstance(v, dict) and v.get('error')}
+        if errors:
+            logger.warning(f"[RESOURCES] {company_code}: profile '{plan}' partially applied: {errors}")
+        else:
+            logger.info(f"[RESOURCES] {company_code}: applied '{plan}' profile")
+        
+        return {'success': not errors, 'plan': plan, 'profile': profile, 'errors': errors or None}
+
+    async def deploy_shared_mongo(self, root_username: str, root_password: str) -> Dict[str, Any]:
+        """
+        Deploy the shared MongoDB stack for shared-mode tenants
+        """
+        stack_name = "shared_mongodb"
+        
+        existing_stacks = await self.get_stacks()
+        for stack in existing_stacks:
+            if isinstance(stack, dict) and stack.get("Name") == stack_name:
+                return {
+                    'success': True,
+                    'message': 'Shared MongoDB already deployed',
+                    'stack_id': stack.get('Id'),
+                    'already_exists': True
+                }
+        
+        endpoint = f"stacks/create/standalone/string?endpointId={self.endpoint_id}"
+        
+        payload = {
+            'name': stack_name,
+            'stackFileContent': get_shared_mongo_compose_template(),
+            'env': [
+                {'name': 'MONGO_ROOT_USERNAME', 'value': root_username},
+                {'name': 'MONGO_ROOT_PASSWORD', 'value': root_password}
+            ]
+        }
+        
+        result = await self._request('POST', endpoint, data=payload)
+        
+        if 'error' not in result:
+            logger.info("Shared MongoDB stack deployed successfully")
+            return {
+                'success': True,
+                'stack_id': result.get('Id'),
+                'stack_name': stack_name,
+                'connection_url': f"mongodb://{root_username}:***@{SERVER_IP}:27100/?authSource=admin",
+                'message': 'Shared MongoDB deployed - set SHARED_MONGO_URL and TENANT_MONGO_MODE=shared to use it'
+            }
+        else:
+            logger.error(f"Shared MongoDB deployment failed: {result}")
+            return {'success': False, 'error': result.get('error', 'Unknown error')}
+
+    async def deploy_shared_backend(self) -> Dict[str, Any]:
+        """
+        Deploy the multi-tenant backend stack and load the template backend code into it
+        """
+        stack_name = "shared_tenant_backend"
+        
+        existing_stacks = await self.get_stacks()
+        stack_id = None
+        for stack in existing_stacks:
+            if isinstance(stack, dict) and stack.get("Name") == stack_name:
+                stack_id = stack.get('Id')
+                break
+        
+        if not stack_id:
+            endpoint = f"stacks/create/standalone/string?endpointId={self.endpoint_id}"
+            result = await self._request('POST', endpoint, data={
+                'name': stack_name,
+                'stackFileContent': get_shared_backend_compose_template(),
+                'env': []
+            })
+            if 'error' in result:
+                logger.error(f"Shared backend deployment failed: {result}")
+                return {'success': False, 'error': result.get('error', 'Unknown error')}
+            stack_id = result.get('Id')
+            await self.wait_for_container_state(SHARED_BACKEND_CONTAINER, 'running', timeout=60)
+        
+        results = {
+            'backend_copy': await self.copy_from_template(
+                template_container="rentacar_template_backend",
+                target_container=SHARED_BACKEND_CONTAINER,
+                source_path="/app",
+                dest_path="/",
+                exclude_files=[".env", "tenants.json"]
+            ),
+            'deps_install': await self.install_backend_dependencies(SHARED_BACKEND_CONTAINER)
+        }
+        results['restart'] = await self.restart_container(SHARED_BACKEND_CONTAINER)
+        
+        return {
+            'success': not any(r.get('error') for r in results.values() if isinstance(r, dict)),
+            'stack_id': stack_id,
+            'stack_name': stack_name,
+            'results': results
+        }
+
+    async def deploy_shared_frontend(self, tenants: list) -> Dict[str, Any]:
+        """
+        Deploy the shared static frontend (or refresh its build from the template)
+        
+        Args:
+            tenants: Current shared-frontend tenants for the host map
+        """
+        stack_name = "shared_tenant_frontend"
+        
+        existing_stacks = await self.get_stacks()
+        stack_id = None
+        for stack in existing_stacks:
+            if isinstance(stack, dict) and stack.get("Name") == stack_name:
+                stack_id = stack.get('Id')
+                break
+        
+        if not stack_id:
+            endpoint = f"stacks/create/standalone/string?endpointId={self.endpoint_id}"
+            result = await self._request('POST', endpoint, data={
+                'name': stack_name,
+                'stackFileContent': get_shared_frontend_compose_template(),
+                'env': []
+            })
+            if 'error' in result:
+                logger.error(f"Shared frontend deployment failed: {result}")
+                return {'success': False, 'error': result.get('error', 'Unknown error')}
+            stack_id = result.get('Id')
+            await self.wait_for_container_state(SHARED_FRONTEND_CONTAINER, 'running', timeout=60)
+        
+        results = {
+            'frontend_copy': await self.copy_from_template(
+                template_container="rentacar_template_frontend",
+                target_container=SHARED_FRONTEND_CONTAINER,
+                source_path="/usr/share/nginx/html",
+                dest_path="/usr/share/nginx",
+                exclude_files=["config.js"]
+            ),
+            'nginx_config': await self.write_shared_frontend_hosts(tenants)
+        }
+        
+        return {
+            'success': not any(r.get('error') for r in results.values() if isinstance(r, dict)),
+            'stack_id': stack_id,
+            'stack_name': stack_name,
+            'results': results
+        }
+
+    async def write_shared_frontend_hosts(self, tenants: list) -> Dict[str, Any]:
+        """
+        Write the shared frontend's server config and Host -> API URL map, then reload Nginx
+        """
+        tar_buffer = std_io.BytesIO()
+        with tarfile.open(fileobj=tar_buffer, mode='w') as tar:
+            for name, content in (
+                ("default.conf", get_shared_frontend_nginx_conf()),
+                ("tenants_map.conf", get_shared_frontend_host_map(tenants))
+            ):
+                conf_bytes = content.encode('utf-8')
+                conf_info = tarfile.TarInfo(name=name)
+                conf_info.size = len(conf_bytes)
+                tar.addfile(conf_info, std_io.BytesIO(conf_bytes))
+        
+        result = await self.upload_to_container(SHARED_FRONTEND_CONTAINER, tar_buffer.getvalue(), "/etc/nginx/conf.d")
+        if result.get('error'):
+            return result
+        
+        reload_result = await self.exec_in_container(
+            SHARED_FRONTEND_CONTAINER,
+            "nginx -t && nginx -s reload && echo NGINX_RELOADED"
+        )
+        if 'NGINX_RELOADED' not in reload_result.get('output', ''):
+            logger.error(f"[SHARED-FRONTEND] Nginx reload failed: {reload_result}")
+            return {'error': 'Nginx reload failed', 'details': reload_result.get('output') or reload_result.get('error')}
+        
+        logger.info(f"[SHARED-FRONTEND] Host map written with {len(tenants)} tenants")
+        return {'success': True, 'tenant_count': len(tenants)}
+
+    async def write_shared_backend_tenant_map(self, tenants: list) -> Dict[str, Any]:
+        """
+        Write the Host -> tenant map read by the multi-tenant backend (picked up without restart)
+        """
+        import json
+        content = json.dumps({'tenants': tenants}, indent=2)
+        result = await self.write_file_to_container(SHARED_BACKEND_CONTAINER, SHARED_BACKEND_TENANT_MAP, content)
+        if result.get('success'):
+            logger.info(f"[SHARED-BACKEND] Tenant map written with {len(tenants)} tenants")
+        return result
+
+    async def check_traefik_status(self, stacks: Optional[list] = None) -> Dict[str, Any]:
         """
         Check if Traefik is deployed and running
+        
+        Args:
+            stacks: Pre-fetched stack list (e.g. inventory snapshot); read live if omitted
         """
         try:
-            stacks = await self.get_stacks()
+            if stacks is None:
+                stacks = await self.get_stacks()
             traefik_stack = None
             for stack in stacks:
                 if isinstance(stack, dict) and stack.get("Name") == "traefik":
@@ -860,6 +1654,74 @@ class PortainerService:
                 'error': str(e)
             }
 
+    async def update_traefik_routes(self, tenants: list, wait_for: Optional[list] = None, timeout: int = 30) -> Dict[str, Any]:
+        """
+        Write tenant routes to the Traefik file provider (hot reload, no restart)
+        
+        Args:
+            tenants: List of {'code': ..., 'domain': ...} for every routed tenant
+            wait_for: Company codes whose routes must be live before returning
+        """
+        config = get_traefik_dynamic_config_template(tenants)
+        
+        tar_buffer = std_io.BytesIO()
+        with tarfile.open(fileobj=tar_buffer, mode='w') as tar:
+            config_bytes = config.encode('utf-8')
+            config_info = tarfile.TarInfo(name="tenants.yml")
+            config_info.size = len(config_bytes)
+            config_info.mtime = int(datetime.now(timezone.utc).timestamp())
+            tar.addfile(config_info, std_io.BytesIO(config_bytes))
+        
+        result = await self.upload_to_container("traefik", tar_buffer.getvalue(), TRAEFIK_DYNAMIC_DIR)
+        if not result.get('success'):
+            logger.error(f"[TRAEFIK] Route config upload failed: {result.get('error')}")
+            return {'success': False, 'error': result.get('error'), 'tenant_count': len(tenants)}
+        
+        logger.info(f"[TRAEFIK] Wrote dynamic routes for {len(tenants)} tenants")
+        response = {'success': True, 'tenant_count': len(tenants)}
+        
+        if wait_for:
+            routers = []
+            for code in wait_for:
+                safe_code = get_safe_code(code)
+                routers.extend([f"{safe_code}-api", f"{safe_code}-web", f"{safe_code}-panel"])
+            readiness = await self.wait_for_traefik_routes(routers, timeout=timeout)
+            response['routes_ready'] = readiness['ready']
+            response['pending_routers'] = readiness['pending']
+        
+        return response
+
+    async def wait_for_traefik_routes(self, routers: list, timeout: int = 30) -> Dict[str, Any]:
+        """
+        Poll the Traefik API until the given file-provider routers are enabled
+        """
+        import asyncio
+        
+        if not TRAEFIK_API_URL:
+            logger.debug("[TRAEFIK] TRAEFIK_API_URL not set, skipping route readiness check")
+            return {'ready': True, 'pending': [], 'checked': False}
+        
+        pending = set(routers)
+        start_time = datetime.now(timezone.utc)
+        async with httpx.AsyncClient(timeout=5.0) as client:
+            while pending:
+                for name in list(pending):
+                    try:
+                        response = await client.get(f"{TRAEFIK_API_URL}/api/http/routers/{name}@file")
+                        if response.status_code == 200 and response.json().get('status') == 'enabled':
+                            pending.discard(name)
+                    except Exception as e:
+                        logger.debug(f"[TRAEFIK] Router check failed for {name}: {e}")
+                
+                if not pending:
+                    break
+                if (datetime.now(timezone.utc) - start_time).total_seconds() > timeout:
+                    logger.warning(f"[TRAEFIK] Routes not live after {timeout}s: {sorted(pending)}")
+                    break
+                await asyncio.sleep(1)
+        
+        return {'ready': not pending, 'pending': sorted(pending)}
+
     async def create_superadmin_stack(self) -> Dict[str, Any]:
         """
         Create SuperAdmin stack in Portainer
@@ -1016,7 +1878,8 @@ class PortainerService:
 
     async def upload_to_container(self, container_name: str, tar_data: bytes, dest_path: str) -> Dict[str, Any]:
         """
-        Upload a tar archive to a container via Portainer API
+        Upload a tar archive to a container via Portainer API.
+        Plain tars are compressed with ARCHIVE_COMPRESSION before upload.
         """
         # First, get container ID
         containers_endpoint = f"endpoints/{self.endpoint_id}/docker/containers/json"
@@ -1036,7 +1899,9 @@ class PortainerService:
         if not container_id:
             return {'error': f'Container {container_name} not found'}
         
-        # Upload archive to container
+        # Upload archive to container (compressed off the event loop unless it already is)
+        if not tar_data.startswith(GZIP_MAGIC) and not tar_data.startswith(XZ_MAGIC):
+            tar_data = await asyncio.to_thread(compress_tar, tar_data)
         upload_endpoint = f"endpoints/{self.endpoint_id}/docker/containers/{container_id}/archive?path={dest_path}"
         url = f"{self.base_url}/api/{upload_endpoint}"
         
@@ -1075,8 +1940,20 @@ class PortainerService:
         add_header Cache-Control "public, immutable";
     }
 
+    location = /index.html {
+        add_header Cache-Control "no-cache, no-store, must-revalidate";
+    }
+
+    location = /config.js {
+        gzip_static off;
+        add_header Cache-Control "no-cache, no-store, must-revalidate";
+    }
+
+    gzip_static on;
     gzip on;
-    gzip_types text/plain text/css application/json application/javascript text/xml application/xml;
+    gzip_vary on;
+    gzip_min_length 1024;
+    gzip_types text/plain text/css application/json application/javascript text/xml application/xml image/svg+xml;
 }
 '''
         
@@ -1245,6 +2122,7 @@ class PortainerService:
                     logger.info(f"[TEMPLATE-COPY] Filtered tar size: {len(tar_data)} bytes")
                 
                 # Step 3: Upload to target container
+                tar_data = await asyncio.to_thread(compress_tar, tar_data)
                 upload_url = f"{self.base_url}/api/endpoints/{self.endpoint_id}/docker/containers/{target_id}/archive?path={dest_path}"
                 upload_headers = {**self.headers, 'Content-Type': 'application/x-tar'}
                 upload_resp = await client.put(upload_url, headers=upload_headers, content=tar_data)
@@ -1326,9 +2204,68 @@ class PortainerService:
         
         return result
 
+    async def build_wheelhouse(self, force: bool = False) -> Dict[str, Any]:
+        """
+        Build wheels for the tenant backend requirements once, in the template backend.
+        
+        Wheels go to rentacar_wheelhouse:/wheelhouse/<requirements hash>/, which tenant
+        backends mount read-only. A finished build is marked with .complete and reused
+        until template/backend/requirements.txt changes.
+        """
+        with open(TEMPLATE_REQUIREMENTS_PATH, 'r') as f:
+            requirements = f.read()
+        req_hash = get_requirements_hash(requirements)
+        wheel_dir = f"{WHEELHOUSE_PATH}/{req_hash}"
+        
+        if not force and self._wheelhouse_hash == req_hash:
+            return {'success': True, 'hash': req_hash, 'built': False}
+        
+        template_container = "rentacar_template_backend"
+        check = await self.exec_in_container(
+            template_container,
+            f"test -f {wheel_dir}/.complete && echo WHEELHOUSE_READY || echo WHEELHOUSE_MISSING"
+        )
+        if check.get('error'):
+            return {'success': False, 'hash': req_hash, 'error': check['error']}
+        
+        if not force and 'WHEELHOUSE_READY' in check.get('output', ''):
+            self._wheelhouse_hash = req_hash
+            return {'success': True, 'hash': req_hash, 'built': False}
+        
+        logger.info(f"[WHEELHOUSE] Building wheels for requirements {req_hash}")
+        
+        tar_buffer = std_io.BytesIO()
+        with tarfile.open(fileobj=tar_buffer, mode='w') as tar:
+            req_bytes = requirements.encode('utf-8')
+            req_info = tarfile.TarInfo(name=f"{req_hash}/requirements.txt")
+            req_info.size = len(req_bytes)
+            tar.addfile(req_info, std_io.BytesIO(req_bytes))
+        
+        upload = await self.upload_to_container(template_container, tar_buffer.getvalue(), WHEELHOUSE_PATH)
+        if not upload.get('success'):
+            return {'success': False, 'hash': req_hash, 'error': upload.get('error')}
+        
+        build = await self.exec_in_container(
+            template_container,
+            f"pip wheel --quiet -r {wheel_dir}/requirements.txt -w {wheel_dir} "
+            f"&& touch {wheel_dir}/.complete && echo WHEELHOUSE_BUILT",
+            timeout=600.0
+        )
+        if build.get('error') or 'WHEELHOUSE_BUILT' not in build.get('output', ''):
+            logger.error(f"[WHEELHOUSE] Build failed: {build.get('error') or build.get('output', '')[-500:]}")
+            return {'success': False, 'hash': req_hash, 'error': build.get('error') or 'pip wheel failed'}
+        
+        self._wheelhouse_hash = req_hash
+        logger.info(f"[WHEELHOUSE] Wheels ready for requirements {req_hash}")
+        return {'success': True, 'hash': req_hash, 'built': True}
+
     async def install_backend_dependencies(self, container_name: str) -> Dict[str, Any]:
         """
         Install Python dependencies in backend container via exec
+        
+        Installs offline from the shared wheelhouse and skips pip entirely when the
+        container already has this requirements hash installed. Falls back to PyPI
+        when the wheelhouse cannot be built or is not mounted in the container.
         """
         logger.info(f"[DEPS] Installing dependencies in {container_name}")
         
@@ -1336,38 +2273,47 @@ class PortainerService:
         if not container_id:
             return {'error': f'Container {container_name} not found'}
         
-        # Wait for container to be running
-        import asyncio
-        for _ in range(10):
-            containers = await self._request('GET', f"endpoints/{self.endpoint_id}/docker/containers/json")
-            for c in containers:
-                if c.get('Id') == container_id:
-                    if c.get('State') == 'running':
-                        break
-            await asyncio.sleep(2)
-        
-        # Create and run exec - bcrypt version pinned to avoid passlib compatibility issues
-        exec_endpoint = f"endpoints/{self.endpoint_id}/docker/containers/{container_id}/exec"
-        exec_payload = {
-            'Cmd': ['pip', 'install', 'motor', 'python-jose', 'passlib[bcrypt]', 'python-dotenv', 'httpx', 'bcrypt==4.0.1', '--quiet'],
-            'AttachStdout': True,
-            'AttachStderr': True
-        }
-        
-        result = await self._request('POST', exec_endpoint, data=exec_payload)
+        if not await self.wait_for_container_state(container_name, 'running', timeout=20):
+            logger.warning(f"[DEPS] {container_name} not running yet, trying anyway")
+        
+        # bcrypt version pinned to avoid passlib compatibility issues
+        pypi_command = "pip install --quiet motor python-jose 'passlib[bcrypt]' python-dotenv httpx bcrypt==4.0.1 && echo DEPS_INSTALLED_PYPI"
+        
+        wheelhouse = await self.build_wheelhouse()
+        if wheelhouse.get('success'):
+            req_hash = wheelhouse['hash']
+            wheel_dir = f"{WHEELHOUSE_PATH}/{req_hash}"
+            # Stacks deployed before the wheelhouse volume existed don't mount it - use PyPI there
+            command = (
+                f'if [ "$(cat {INSTALLED_REQUIREMENTS_MARKER} 2>/dev/null)" = "{req_hash}" ]; then echo DEPS_UP_TO_DATE; '
+                f'elif [ -f {wheel_dir}/requirements.txt ]; then '
+                f'pip install --quiet --no-index --find-links {wheel_dir} -r {wheel_dir}/requirements.txt '
+                f'&& echo {req_hash} > {INSTALLED_REQUIREMENTS_MARKER} && echo DEPS_INSTALLED; '
+                f'else {pypi_command}; fi'
+            )
+        else:
+            logger.warning(f"[DEPS] Wheelhouse unavailable ({wheelhouse.get('error')}), installing from PyPI")
+            req_hash = None
+            command = pypi_command
         
-        if 'Id' in result:
-            exec_id = result['Id']
-            async with httpx.AsyncClient(verify=False, timeout=180.0) as client:
-                start_url = f"{self.base_url}/api/endpoints/{self.endpoint_id}/docker/exec/{exec_id}/start"
-                await client.post(start_url, headers=self.headers, json={'Detach': False})
-            
+        result = await self.exec_in_container(container_name, command, timeout=300.0)
+        if result.get('error'):
+            return {'error': result['error']}
+        
+        output = result.get('output', '')
+        if 'DEPS_UP_TO_DATE' in output:
+            logger.info(f"[DEPS] {container_name} already has requirements {req_hash}, skipping install")
+            return {'success': True, 'skipped': True, 'hash': req_hash}
+        if 'DEPS_INSTALLED_PYPI' in output:
+            logger.info(f"[DEPS] Dependencies installed in {container_name} from PyPI (no wheelhouse mount)")
+            return {'success': True, 'skipped': False, 'hash': None, 'offline': False}
+        if 'DEPS_INSTALLED' in output:
             logger.info(f"[DEPS] Dependencies installed in {container_name}")
-            return {'success': True}
+            return {'success': True, 'skipped': False, 'hash': req_hash, 'offline': True}
         
-        return {'error': 'Failed to create exec', 'details': result}
+        return {'error': 'Dependency install failed', 'details': output[-1000:]}
 
-    async def full_tenant_deployment(self, company_code: str, domain: str, admin_email: str, admin_password: str, mongo_port: int, backend_port: int = None) -> Dict[str, Any]:
+    async def full_tenant_deployment(self, company_code: str, domain: str, admin_email: str, admin_password: str, mongo_port: int, backend_port: int = None, mongo_mode: Optional[str] = None, frontend_mode: Optional[str] = None) -> Dict[str, Any]:
         """
         Complete tenant deployment after stack creation:
         1. Copy frontend from template
@@ -1379,7 +2325,7 @@ class PortainerService:
         
         All operations via Portainer API - no external dependencies
         """
-        safe_code = company_code.replace('-', '').replace('_', '')
+        safe_code = get_safe_code(company_code)
         frontend_container = f"{safe_code}_frontend"
         backend_container = f"{safe_code}_backend"
         db_name = f"{safe_code}_db"
@@ -1405,16 +2351,20 @@ class PortainerService:
         import asyncio
         await asyncio.sleep(10)
         
+        # Shared frontend tenants have no Nginx of their own - only the host map changes
+        own_frontend = (frontend_mode or TENANT_FRONTEND_MODE) != 'shared'
+        
         try:
             # Step 1: Copy frontend from template (config.js will be created separately with correct URL)
-            logger.info(f"[FULL-DEPLOY] Step 1: Copying frontend...")
-            results['frontend_copy'] = await self.copy_from_template(
-                template_container="rentacar_template_frontend",
-                target_container=frontend_container,
-                source_path="/usr/share/nginx/html",
-                dest_path="/usr/share/nginx",
-                exclude_files=["config.js"]
-            )
+            if own_frontend:
+                logger.info(f"[FULL-DEPLOY] Step 1: Copying frontend...")
+                results['frontend_copy'] = await self.copy_from_template(
+                    template_container="rentacar_template_frontend",
+                    target_container=frontend_container,
+                    source_path="/usr/share/nginx/html",
+                    dest_path="/usr/share/nginx",
+                    exclude_files=["config.js"]
+                )
             
             # Step 2: Copy backend from template (exclude .env - will be created with tenant settings)
             logger.info(f"[FULL-DEPLOY] Step 2: Copying backend...")
@@ -1430,13 +2380,14 @@ class PortainerService:
             logger.info(f"[FULL-DEPLOY] Step 3: Installing dependencies...")
             results['deps_install'] = await self.install_backend_dependencies(backend_container)
             
-            # Step 4: Create config.js
-            logger.info(f"[FULL-DEPLOY] Step 4: Creating config.js...")
-            results['config_js'] = await self.create_config_js(frontend_container, api_url)
-            
-            # Step 5: Configure Nginx for SPA
-            logger.info(f"[FULL-DEPLOY] Step 5: Configuring Nginx...")
-            results['nginx_config'] = await self.configure_nginx_spa(frontend_container)
+            if own_frontend:
+                # Step 4: Create config.js
+                logger.info(f"[FULL-DEPLOY] Step 4: Creating config.js...")
+                results['config_js'] = await self.create_config_js(frontend_container, api_url)
+                
+                # Step 5: Configure Nginx for SPA
+                logger.info(f"[FULL-DEPLOY] Step 5: Configuring Nginx...")
+                results['nginx_config'] = await self.configure_nginx_spa(frontend_container)
             
             # Step 6: Setup database - this needs MongoDB connection
             logger.info(f"[FULL-DEPLOY] Step 6: Setting up database...")
@@ -1444,14 +2395,17 @@ class PortainerService:
                 mongo_port=mongo_port,
                 db_name=db_name,
                 admin_email=admin_email,
-                admin_password=admin_password
+                admin_password=admin_password,
+                company_code=company_code,
+                mongo_mode=mongo_mode
             )
             
             # Step 7: Restart containers
             logger.info(f"[FULL-DEPLOY] Step 7: Restarting containers...")
             await self.restart_container(backend_container)
-            await asyncio.sleep(3)
-            await self.restart_container(frontend_container)
+            if own_frontend:
+                await asyncio.sleep(3)
+                await self.restart_container(frontend_container)
             
             logger.info(f"[FULL-DEPLOY] Deployment complete for {company_code}")
             
@@ -1478,10 +2432,13 @@ class PortainerService:
                 'results': results
             }
 
-    async def setup_tenant_database(self, mongo_port: int, db_name: str, admin_email: str, admin_password: str) -> Dict[str, Any]:
+    async def setup_tenant_database(self, mongo_port: Optional[int], db_name: str, admin_email: str, admin_password: str, company_code: Optional[str] = None, mongo_mode: Optional[str] = None) -> Dict[str, Any]:
         """
         Setup tenant MongoDB with admin user.
         Creates password hash inside the backend container for bcrypt compatibility.
+        
+        In shared mode the tenant's database user is created on the shared instance
+        first, and the admin user is written through the pooled shared client.
         """
         import uuid
         from datetime import datetime, timezone
@@ -1543,9 +2500,18 @@ class PortainerService:
             # Connect to tenant MongoDB and create user
             from motor.motor_asyncio import AsyncIOMotorClient
             
-            mongo_url = f"mongodb://{SERVER_IP}:{mongo_port}"
-            client = AsyncIOMotorClient(mongo_url, serverSelectionTimeoutMS=30000)
-            tenant_db = client[db_name]
+            shared = (mongo_mode or TENANT_MONGO_MODE) == 'shared'
+            if shared:
+                tenant_code = company_code or safe_code
+                await tenant_db_registry.ensure_shared_tenant(tenant_code)
+                client = None
+                tenant_db = await tenant_db_registry.get_db(tenant_code, 'shared')
+                if tenant_db is None:
+                    return {'success': False, 'error': 'Shared MongoDB unreachable'}
+            else:
+                mongo_url = f"mongodb://{SERVER_IP}:{mongo_port}"
+                client = AsyncIOMotorClient(mongo_url, serverSelectionTimeoutMS=30000)
+                tenant_db = client[db_name]
             
             # Check if admin already exists
             existing = await tenant_db.users.find_one({"email": admin_email})
@@ -1568,7 +2534,8 @@ class PortainerService:
                 logger.info(f"[DB-SETUP] Admin user already exists: {admin_email}")
                 result = {'success': True, 'admin_email': admin_email, 'created': False, 'already_exists': True}
             
-            client.close()
+            if client:
+                client.close()
             return result
             
         except Exception as e:
@@ -1695,17 +2662,10 @@ class PortainerService:
             if os.path.exists(frontend_build_path) and template_frontend_id:
                 logger.info(f"[MASTER-TEMPLATE-LOCAL] Uploading frontend from {frontend_build_path}")
                 
-                # Create tar of build folder
-                tar_buffer = std_io.BytesIO()
-                with tarfile.open(fileobj=tar_buffer, mode='w') as tar:
-                    for root, dirs, files in os.walk(frontend_build_path):
-                        for file in files:
-                            file_path = os.path.join(root, file)
-                            arcname = os.path.relpath(file_path, frontend_build_path)
-                            if not arcname.startswith('downloads/'):
-                                tar.add(file_path, arcname=arcname)
+                await asyncio.to_thread(precompress_static_assets, frontend_build_path)
                 
-                tar_data = tar_buffer.getvalue()
+                # Compressed tar of build folder
+                tar_data = await asyncio.to_thread(build_directory_archive, frontend_build_path, ('downloads/',))
                 logger.info(f"[MASTER-TEMPLATE-LOCAL] Frontend tar size: {len(tar_data)} bytes")
                 
                 # Clean and upload
@@ -1737,7 +2697,7 @@ class PortainerService:
                     if os.path.exists(requirements):
                         tar.add(requirements, arcname='requirements.txt')
                 
-                tar_data = tar_buffer.getvalue()
+                tar_data = await asyncio.to_thread(compress_tar, tar_buffer.getvalue())
                 
                 upload_result = await self.upload_to_container(
                     container_name="rentacar_template_backend",
@@ -1768,7 +2728,7 @@ class PortainerService:
                 'results': results
             }
 
-    async def update_tenant_from_template(self, company_code: str, domain: str) -> Dict[str, Any]:
+    async def update_tenant_from_template(self, company_code: str, domain: str, frontend_mode: Optional[str] = None) -> Dict[str, Any]:
         """
         Update existing tenant from template WITHOUT touching database.
         
@@ -1785,13 +2745,17 @@ class PortainerService:
         - Admin credentials
         - Theme settings stored in DB
         - config.js API URL (PRESERVED from existing config)
+        
+        frontend_mode 'shared' skips the frontend steps - the shared static
+        frontend is updated once via deploy_shared_frontend.
         """
-        safe_code = company_code.replace('-', '').replace('_', '')
+        safe_code = get_safe_code(company_code)
         frontend_container = f"{safe_code}_frontend"
         backend_container = f"{safe_code}_backend"
+        own_frontend = frontend_mode != 'shared'
         
         # CRITICAL: First, read existing config.js to preserve API URL
-        existing_api_url = await self._get_existing_config_url(frontend_container)
+        existing_api_url = await self._get_existing_config_url(frontend_container) if own_frontend else None
         
         # ALWAYS use HTTPS domain URL if domain exists - this is the PRIMARY rule
         if domain:
@@ -1860,35 +2824,37 @@ class PortainerService:
             results['deps_install'] = await self.install_backend_dependencies(backend_container)
             
             # ===== FRONTEND UPDATE (NO STOP NEEDED - Nginx handles gracefully) =====
-            
-            # Step 5: Copy frontend files (EXCLUDE config.js to preserve tenant API URL)
-            logger.info(f"[UPDATE-TEMPLATE] Step 5: Copying frontend code (excluding config.js)...")
-            results['frontend_copy'] = await self.copy_from_template(
-                template_container="rentacar_template_frontend",
-                target_container=frontend_container,
-                source_path="/usr/share/nginx/html",
-                dest_path="/usr/share/nginx",
-                exclude_files=["config.js"]
-            )
-            
-            # Step 6: Write config.js with correct URL
-            logger.info(f"[UPDATE-TEMPLATE] Step 6: Writing config.js with URL: {api_url}")
-            results['config_js'] = await self.create_config_js(frontend_container, api_url)
-            
-            # Step 7: Configure Nginx for SPA routing
-            logger.info(f"[UPDATE-TEMPLATE] Step 7: Updating Nginx config...")
-            results['nginx_config'] = await self.configure_nginx_spa(frontend_container)
-            
-            # Step 8: Reload nginx to pick up new config
-            logger.info(f"[UPDATE-TEMPLATE] Step 8: Reloading Nginx...")
-            await self.exec_in_container(frontend_container, "nginx -s reload")
-            results['nginx_reload'] = {'success': True}
-            
-            # Step 9: Final verification
-            await asyncio.sleep(2)
-            final_url = await self._get_existing_config_url(frontend_container)
-            results['final_config_url'] = final_url
-            logger.info(f"[UPDATE-TEMPLATE] Final config.js URL: {final_url}")
+            if own_frontend:
+                # Step 5: Copy frontend files (EXCLUDE config.js to preserve tenant API URL)
+                logger.info(f"[UPDATE-TEMPLATE] Step 5: Copying frontend code (excluding config.js)...")
+                results['frontend_copy'] = await self.copy_from_template(
+                    template_container="rentacar_template_frontend",
+                    target_container=frontend_container,
+                    source_path="/usr/share/nginx/html",
+                    dest_path="/usr/share/nginx",
+                    exclude_files=["config.js"]
+                )
+                
+                # Step 6: Write config.js with correct URL
+                logger.info(f"[UPDATE-TEMPLATE] Step 6: Writing config.js with URL: {api_url}")
+                results['config_js'] = await self.create_config_js(frontend_container, api_url)
+                
+                # Step 7: Configure Nginx for SPA routing
+                logger.info(f"[UPDATE-TEMPLATE] Step 7: Updating Nginx config...")
+                results['nginx_config'] = await self.configure_nginx_spa(frontend_container)
+                
+                # Step 8: Reload nginx to pick up new config
+                logger.info(f"[UPDATE-TEMPLATE] Step 8: Reloading Nginx...")
+                await self.exec_in_container(frontend_container, "nginx -s reload")
+                results['nginx_reload'] = {'success': True}
+                
+                # Step 9: Final verification
+                await asyncio.sleep(2)
+                final_url = await self._get_existing_config_url(frontend_container)
+                results['final_config_url'] = final_url
+                logger.info(f"[UPDATE-TEMPLATE] Final config.js URL: {final_url}")
+            else:
+                logger.info(f"[UPDATE-TEMPLATE] Steps 5-9 skipped: web panel served by the shared frontend")
             
             # Step 10: Verify backend is healthy
             backend_health = await self._check_backend_health(backend_container)
@@ -2066,38 +3032,22 @@ class PortainerService:
                 'results': results
             }
 
-    async def get_tenant_support_tickets(self, company_code: str) -> list:
-        """Get support tickets from tenant's database via container exec"""
+    async def get_tenant_support_tickets(self, company_code: str, strict: bool = False, mongo_mode: Optional[str] = None) -> list:
+        """
+        Get support tickets from tenant's database via pooled direct connection
+
+        Args:
+            strict: Raise on failure instead of returning [] (used by fan-out to report per-tenant status)
+            mongo_mode: The company's MongoDB mode ('dedicated' / 'shared')
+        """
         try:
-            backend_container = f"{company_code}_backend"
-            mongo_host = f"{company_code}_mongodb"
-            db_name = f"{company_code}_db"
-            
-            cmd = f'''python3 -c "
-from motor.motor_asyncio import AsyncIOMotorClient
-import asyncio, json
-
-async def get():
-    c = AsyncIOMotorClient('mongodb://{mongo_host}:27017')
-    db = c['{db_name}']
-    tickets = await db.support_tickets.find({{}}, {{'_id': 0}}).to_list(50)
-    print(json.dumps(tickets, default=str))
-
-asyncio.run(get())
-"'''
-            
-            result = await self.exec_in_container(backend_container, cmd)
-            if result.get("success"):
-                output = result.get("output", {}).get("text", "[]")
-                # Clean control characters and find JSON array
-                output = output.replace("\x01", " ").strip()
-                import re
-                match = re.search(r'\[.*\]', output, re.DOTALL)
-                if match:
-                    import json
-                    return json.loads(match.group())
-            return []
+            tenant_db = await tenant_db_registry.get_db(company_code, mongo_mode)
+            if tenant_db is None:
+                raise ConnectionError(f'Tenant MongoDB unreachable: {company_code}')
+            return await tenant_db.support_tickets.find({}, {'_id': 0}).to_list(50)
         except Exception as e:
+            if strict:
+                raise
             logger.warning(f"Error getting tickets from {company_code}: {e}")
             return []
 
@@ -2174,7 +3124,7 @@ fi
         - Sadece 3 şey oluşturulur: app.config.js, keystore.jks, credentials.json
         - Artık runtime'da expo install --fix, asset generation vs. YOK
         """
-        safe_code = company_code.replace('-', '').replace('_', '')
+        safe_code = get_safe_code(company_code)
         template_container = f"rentacar_template_{app_type}_app"
         tenant_container = f"{safe_code}_{app_type}_app"
         
@@ -2378,6 +3328,7 @@ fi
                 file_data = content.encode('utf-8')
                 file_info = tarfile.TarInfo(name=os.path.basename(file_path))
                 file_info.size = len(file_data)
+                file_info.mtime = int(datetime.now(timezone.utc).timestamp())
                 tar.addfile(file_info, std_io.BytesIO(file_data))
             
             tar_data = tar_buffer.getvalue()
@@ -2401,7 +3352,7 @@ fi
         3. Initialize EAS project if not configured
         4. Run eas build
         """
-        safe_code = company_code.replace('-', '').replace('_', '')
+        safe_code = get_safe_code(company_code)
         container_name = f"{safe_code}_{app_type}_app"
         
         # Get Expo credentials - use hardcoded values for reliability
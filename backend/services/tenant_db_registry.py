@@ -0,0 +1,267 @@
+"""
+Tenant MongoDB Connection Registry
+Pooled motor clients to tenant databases for direct cross-tenant reads.
+
+Tenant MongoDB containers join traefik_network as {safe_code}_mongodb, so the
+SuperAdmin backend can reach them by container name instead of exec'ing a
+Python interpreter inside every tenant backend container.
+
+In shared mode (TENANT_MONGO_MODE=shared) tenants are separate databases with
+their own users on one shared mongod / replica set, reached via SHARED_MONGO_URL.
+"""
+import asyncio
+import hashlib
+import hmac
+import logging
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+from motor.motor_asyncio import AsyncIOMotorClient
+
+logger = logging.getLogger(__name__)
+
+# Connection settings
+TENANT_MONGO_URL_TEMPLATE = os.environ.get('TENANT_MONGO_URL_TEMPLATE', 'mongodb://{safe_code}_mongodb:27017')
+TENANT_DB_MAX_CLIENTS = int(os.environ.get('TENANT_DB_MAX_CLIENTS', '50'))
+TENANT_DB_HEALTH_INTERVAL = float(os.environ.get('TENANT_DB_HEALTH_INTERVAL', '30'))
+TENANT_DB_POOL_SIZE = int(os.environ.get('TENANT_DB_POOL_SIZE', '5'))
+# Evicted clients stay open this long - callers may still hold a database handle from them
+TENANT_DB_CLOSE_GRACE = float(os.environ.get('TENANT_DB_CLOSE_GRACE', '120'))
+
+# Shared instance mode
+TENANT_MONGO_MODE = os.environ.get('TENANT_MONGO_MODE', 'dedicated')  # 'dedicated' | 'shared'
+SHARED_MONGO_URL = os.environ.get('SHARED_MONGO_URL', '')  # admin connection used by SuperAdmin
+SHARED_MONGO_TENANT_HOSTS = os.environ.get('SHARED_MONGO_TENANT_HOSTS', 'shared_mongodb:27017')  # as seen from tenant containers
+SHARED_MONGO_OPTIONS = os.environ.get('SHARED_MONGO_OPTIONS', '')  # e.g. replicaSet=rs0
+SHARED_MONGO_SECRET = os.environ.get('SHARED_MONGO_SECRET', '')
+SHARED_MONGO_POOL_SIZE = int(os.environ.get('SHARED_MONGO_POOL_SIZE', '20'))
+SHARED_CLIENT_KEY = '__shared__'
+
+
+def get_safe_code(company_code: str) -> str:
+    """
+    Container/database naming used by tenant stacks (no dashes/underscores).
+    Case is kept - existing containers and databases are named that way - so
+    every stack, URL and user name must be derived through this function.
+    """
+    return (company_code or '').replace('-', '').replace('_', '')
+
+
+def get_tenant_mongo_credentials(company_code: str) -> Tuple[str, str]:
+    """
+    Per-tenant user on the shared instance.
+    The password is derived from SHARED_MONGO_SECRET so it never has to be stored.
+    """
+    if not SHARED_MONGO_SECRET:
+        raise ValueError('SHARED_MONGO_SECRET must be set for shared MongoDB mode')
+    safe_code = get_safe_code(company_code)
+    password = hmac.new(SHARED_MONGO_SECRET.encode(), safe_code.encode(), hashlib.sha256).hexdigest()[:32]
+    return f"{safe_code}_user", password
+
+
+def get_tenant_mongo_url(company_code: str, mongo_mode: Optional[str] = None) -> str:
+    """MONGO_URL a tenant backend uses for its own database"""
+    safe_code = get_safe_code(company_code)
+    if (mongo_mode or TENANT_MONGO_MODE) != 'shared':
+        return f"mongodb://{safe_code}_mongodb:27017"
+    username, password = get_tenant_mongo_credentials(company_code)
+    options = f"authSource={safe_code}_db"
+    if SHARED_MONGO_OPTIONS:
+        options = f"{options}&{SHARED_MONGO_OPTIONS}"
+    return f"mongodb://{username}:{password}@{SHARED_MONGO_TENANT_HOSTS}/{safe_code}_db?{options}"
+
+
+class TenantDBRegistry:
+    """
+    LRU registry of motor clients, one per tenant MongoDB.
+
+    - Clients are created lazily and reused across requests
+    - Least recently used clients are retired once max_clients is exceeded and
+      closed TENANT_DB_CLOSE_GRACE seconds later, so in-flight reads finish
+    - Each client is pinged at most once per health_interval; unhealthy
+      clients are evicted and recreated on the next access
+    - Shared-mode tenants all use one client to the shared instance
+    """
+
+    def __init__(self, max_clients: int = TENANT_DB_MAX_CLIENTS, health_interval: float = TENANT_DB_HEALTH_INTERVAL):
+        self.max_clients = max_clients
+        self.health_interval = health_interval
+        self._clients: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._retired: List[Tuple[float, str, Dict[str, Any]]] = []
+        self._lock = asyncio.Lock()
+
+    def _mongo_url(self, safe_code: str) -> str:
+        if safe_code == SHARED_CLIENT_KEY:
+            if not SHARED_MONGO_URL:
+                raise ValueError('SHARED_MONGO_URL must be set for shared MongoDB mode')
+            return SHARED_MONGO_URL
+        return TENANT_MONGO_URL_TEMPLATE.format(safe_code=safe_code)
+
+    def _create_entry(self, safe_code: str) -> Dict[str, Any]:
+        client = AsyncIOMotorClient(
+            self._mongo_url(safe_code),
+            maxPoolSize=SHARED_MONGO_POOL_SIZE if safe_code == SHARED_CLIENT_KEY else TENANT_DB_POOL_SIZE,
+            minPoolSize=0,
+            maxIdleTimeMS=300000,
+            serverSelectionTimeoutMS=3000,
+            connectTimeoutMS=3000
+        )
+        return {
+            'client': client,
+            'db_name': f"{safe_code}_db",
+            'created_at': time.monotonic(),
+            'checked_at': 0.0,
+            'healthy': None,
+            'last_error': None
+        }
+
+    def _close_entry(self, safe_code: str, entry: Dict[str, Any]):
+        try:
+            entry['client'].close()
+        except Exception as e:
+            logger.warning(f"[TENANT-DB] Error closing client for {safe_code}: {e}")
+
+    def _retire_entry(self, safe_code: str, entry: Dict[str, Any]):
+        """Close later instead of now - get_db() handles from this client may still be in use"""
+        self._retired.append((time.monotonic() + TENANT_DB_CLOSE_GRACE, safe_code, entry))
+
+    def _sweep_retired(self):
+        now = time.monotonic()
+        due = [r for r in self._retired if r[0] <= now]
+        if due:
+            self._retired = [r for r in self._retired if r[0] > now]
+            for _, safe_code, entry in due:
+                self._close_entry(safe_code, entry)
+
+    async def _ping(self, safe_code: str, entry: Dict[str, Any]) -> bool:
+        try:
+            await entry['client'].admin.command('ping')
+            entry['healthy'] = True
+            entry['last_error'] = None
+        except Exception as e:
+            entry['healthy'] = False
+            entry['last_error'] = str(e)
+            logger.warning(f"[TENANT-DB] Health check failed for {safe_code}: {e}")
+        entry['checked_at'] = time.monotonic()
+        return entry['healthy']
+
+    async def _get_entry(self, key: str) -> Optional[Dict[str, Any]]:
+        async with self._lock:
+            self._sweep_retired()
+            entry = self._clients.get(key)
+            if entry:
+                self._clients.move_to_end(key)
+            else:
+                entry = self._create_entry(key)
+                self._clients[key] = entry
+                while len(self._clients) > self.max_clients:
+                    evicted_code, evicted = self._clients.popitem(last=False)
+                    logger.info(f"[TENANT-DB] Evicting LRU client: {evicted_code}")
+                    self._retire_entry(evicted_code, evicted)
+
+        if time.monotonic() - entry['checked_at'] >= self.health_interval:
+            if not await self._ping(key, entry):
+                await self._evict_key(key)
+                return None
+
+        return entry
+
+    async def get_db(self, company_code: str, mongo_mode: Optional[str] = None):
+        """
+        Get a database handle for a tenant.
+        Returns None when the tenant MongoDB is unreachable.
+
+        Args:
+            mongo_mode: The company's 'dedicated' / 'shared' mode (defaults to TENANT_MONGO_MODE)
+        """
+        safe_code = get_safe_code(company_code)
+        if not safe_code:
+            return None
+
+        shared = (mongo_mode or TENANT_MONGO_MODE) == 'shared'
+        entry = await self._get_entry(SHARED_CLIENT_KEY if shared else safe_code)
+        if entry is None:
+            return None
+
+        return entry['client'][f"{safe_code}_db"]
+
+    async def ensure_shared_tenant(self, company_code: str) -> Dict[str, Any]:
+        """
+        Create the tenant's user on the shared instance, scoped to its own database
+        (resets password and roles when the user already exists)
+        """
+        safe_code = get_safe_code(company_code)
+        username, password = get_tenant_mongo_credentials(company_code)
+        entry = await self._get_entry(SHARED_CLIENT_KEY)
+        if entry is None:
+            raise ConnectionError('Shared MongoDB unreachable')
+
+        db_name = f"{safe_code}_db"
+        tenant_db = entry['client'][db_name]
+        roles = [{'role': 'readWrite', 'db': db_name}, {'role': 'dbAdmin', 'db': db_name}]
+        existing = await tenant_db.command('usersInfo', username)
+        if existing.get('users'):
+            await tenant_db.command('updateUser', username, pwd=password, roles=roles)
+            created = False
+        else:
+            await tenant_db.command('createUser', username, pwd=password, roles=roles)
+            created = True
+        logger.info(f"[TENANT-DB] Shared tenant user {username} {'created' if created else 'updated'}")
+        return {'success': True, 'username': username, 'db_name': db_name, 'created': created}
+
+    async def drop_shared_tenant(self, company_code: str, drop_data: bool = False) -> Dict[str, Any]:
+        """Revoke the tenant's user on the shared instance; with drop_data also drop its database"""
+        safe_code = get_safe_code(company_code)
+        username = f"{safe_code}_user"
+        entry = await self._get_entry(SHARED_CLIENT_KEY)
+        if entry is None:
+            raise ConnectionError('Shared MongoDB unreachable')
+
+        tenant_db = entry['client'][f"{safe_code}_db"]
+        existing = await tenant_db.command('usersInfo', username)
+        if existing.get('users'):
+            await tenant_db.command('dropUser', username)
+        if drop_data:
+            await entry['client'].drop_database(f"{safe_code}_db")
+        logger.info(f"[TENANT-DB] Shared tenant {safe_code} removed (data dropped: {drop_data})")
+        return {'success': True, 'user_dropped': bool(existing.get('users')), 'data_dropped': drop_data}
+
+    async def _evict_key(self, key: str):
+        async with self._lock:
+            entry = self._clients.pop(key, None)
+            if entry:
+                self._retire_entry(key, entry)
+
+    async def evict(self, company_code: str):
+        """Close and forget a tenant client (e.g. after deprovisioning)"""
+        await self._evict_key(get_safe_code(company_code))
+
+    def stats(self) -> List[Dict[str, Any]]:
+        """Registry contents, most recently used last"""
+        now = time.monotonic()
+        return [
+            {
+                'safe_code': safe_code,
+                'db_name': entry['db_name'],
+                'healthy': entry['healthy'],
+                'last_error': entry['last_error'],
+                'age_seconds': round(now - entry['created_at'], 1),
+                'last_check_seconds_ago': round(now - entry['checked_at'], 1) if entry['checked_at'] else None
+            }
+            for safe_code, entry in self._clients.items()
+        ]
+
+    def close_all(self):
+        """Close all pooled clients (application shutdown)"""
+        while self._clients:
+            safe_code, entry = self._clients.popitem(last=False)
+            self._close_entry(safe_code, entry)
+        for _, safe_code, entry in self._retired:
+            self._close_entry(safe_code, entry)
+        self._retired = []
+
+
+# Singleton instance
+tenant_db_registry = TenantDBRegistry()
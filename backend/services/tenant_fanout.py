@@ -0,0 +1,95 @@
+"""
+Cross-Tenant Fan-Out Service
+Runs a read against many tenants concurrently with a per-tenant deadline.
+
+A slow or unreachable tenant only costs its own deadline; everyone else's
+results are returned as a partial result with a per-tenant status.
+"""
+import asyncio
+import logging
+import os
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Fan-out settings
+TENANT_FANOUT_CONCURRENCY = int(os.environ.get('TENANT_FANOUT_CONCURRENCY', '10'))
+TENANT_FANOUT_TIMEOUT = float(os.environ.get('TENANT_FANOUT_TIMEOUT', '3'))
+
+
+class TenantFanOut:
+    """
+    Concurrent cross-tenant reads
+
+    - run(): query tenants under a semaphore, each bounded by a deadline
+    """
+
+    def __init__(self, concurrency: int = TENANT_FANOUT_CONCURRENCY, timeout: float = TENANT_FANOUT_TIMEOUT):
+        self.concurrency = concurrency
+        self.timeout = timeout
+
+    async def run(
+        self,
+        companies: List[Dict[str, Any]],
+        fetch: Callable[[Dict[str, Any]], Awaitable[Any]],
+        timeout: Optional[float] = None,
+        concurrency: Optional[int] = None
+    ) -> Dict[str, Any]:
+        """
+        Call fetch(company) for every company concurrently.
+
+        Returns:
+            {
+                'results': [{'company': {...}, 'data': ...}, ...],   # successful tenants only
+                'tenants': [{'code', 'name', 'status', 'duration_ms', 'error'}, ...],
+                'ok_count', 'failed_count', 'partial'
+            }
+        """
+        deadline = timeout or self.timeout
+        semaphore = asyncio.Semaphore(concurrency or self.concurrency)
+
+        async def run_one(company: Dict[str, Any]) -> Dict[str, Any]:
+            async with semaphore:
+                started = time.monotonic()
+                outcome = {
+                    'code': company.get('code'),
+                    'name': company.get('name'),
+                    'status': 'ok',
+                    'error': None,
+                    'data': None
+                }
+                try:
+                    outcome['data'] = await asyncio.wait_for(fetch(company), deadline)
+                except asyncio.TimeoutError:
+                    outcome['status'] = 'timeout'
+                    outcome['error'] = f'Deadline of {deadline}s exceeded'
+                except Exception as e:
+                    outcome['status'] = 'error'
+                    outcome['error'] = str(e)
+                outcome['duration_ms'] = round((time.monotonic() - started) * 1000, 1)
+                return outcome
+
+        outcomes = await asyncio.gather(*[run_one(c) for c in companies])
+
+        results = []
+        tenants = []
+        for company, outcome in zip(companies, outcomes):
+            if outcome['status'] == 'ok':
+                results.append({'company': company, 'data': outcome['data']})
+            else:
+                logger.warning(f"[FANOUT] {outcome['code']}: {outcome['status']} - {outcome['error']}")
+            tenants.append({k: v for k, v in outcome.items() if k != 'data'})
+
+        failed_count = len(companies) - len(results)
+        return {
+            'results': results,
+            'tenants': tenants,
+            'ok_count': len(results),
+            'failed_count': failed_count,
+            'partial': failed_count > 0
+        }
+
+
+# Singleton instance
+tenant_fanout = TenantFanOut()
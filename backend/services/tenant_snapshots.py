@@ -0,0 +1,304 @@
+"""
+Tenant Code Snapshots
+Captures a tenant's backend and frontend trees before a template update so a
+bad rollout can be rolled back in seconds instead of re-copying the template.
+
+Files are stored once per content hash (gzip-compressed) in snapshot_blobs;
+snapshots are manifests of path -> hash. Tenants running the same template
+version therefore share almost all of their blobs.
+"""
+import asyncio
+import gzip
+import hashlib
+import io as std_io
+import logging
+import os
+import shlex
+import tarfile
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional
+
+from pymongo.errors import BulkWriteError
+
+from .portainer_service import portainer_service
+from .tenant_db_registry import get_safe_code
+
+logger = logging.getLogger(__name__)
+
+TENANT_SNAPSHOT_KEEP = int(os.environ.get('TENANT_SNAPSHOT_KEEP', '5'))
+# Mongo documents are capped at 16MB - larger files are left out of snapshots
+SNAPSHOT_MAX_BLOB_BYTES = int(os.environ.get('SNAPSHOT_MAX_BLOB_BYTES', str(12 * 1024 * 1024)))
+# Unreferenced blobs younger than this may belong to a snapshot still being written
+SNAPSHOT_BLOB_GRACE_MINUTES = 60
+SNAPSHOT_DELETE_BATCH = 100
+# Tenant-specific backend files: .env, and the plan's gunicorn sizing written by apply_resource_profile
+BACKEND_EXCLUDE = ['.env', 'gunicorn_conf.py']
+
+
+def get_snapshot_trees(company_code: str, frontend_mode: Optional[str] = None) -> List[Dict[str, Any]]:
+    """
+    Trees touched by update_tenant_from_template, with the same files left out
+    (.env, gunicorn_conf.py and config.js are tenant-specific and never
+    overwritten by updates)
+    """
+    safe_code = get_safe_code(company_code)
+    trees = [{
+        'name': 'backend',
+        'container': f"{safe_code}_backend",
+        'root': '/app',
+        'exclude': list(BACKEND_EXCLUDE)
+    }]
+    if frontend_mode != 'shared':
+        trees.append({
+            'name': 'frontend',
+            'container': f"{safe_code}_frontend",
+            'root': '/usr/share/nginx/html',
+            'exclude': ['config.js']
+        })
+    return trees
+
+
+def _is_excluded(path: str, exclude: List[str]) -> bool:
+    return path in exclude or '__pycache__' in path.split('/')
+
+
+def _read_tree(tar_data: bytes, exclude: List[str]) -> Dict[str, Dict[str, Any]]:
+    """
+    Regular files of a container archive, keyed by path relative to the
+    archived directory (Docker prefixes members with the directory name)
+    """
+    files = {}
+    with tarfile.open(fileobj=std_io.BytesIO(tar_data), mode='r:*') as tar:
+        for member in tar.getmembers():
+            if not member.isfile():
+                continue
+            parts = member.name.split('/', 1)
+            if len(parts) < 2 or _is_excluded(parts[1], exclude):
+                continue
+            content = tar.extractfile(member).read()
+            files[parts[1]] = {
+                'sha': hashlib.sha256(content).hexdigest(),
+                'mode': member.mode,
+                'size': member.size,
+                'content': content
+            }
+    return files
+
+
+class TenantSnapshotService:
+    """
+    Content-addressed snapshots of tenant code
+
+    - create(): archive each tree, store new blobs, record a manifest
+    - rollback(): restore a manifest as a delta - only changed files are
+      uploaded and files added since the snapshot are removed
+    - Only the newest TENANT_SNAPSHOT_KEEP snapshots per tenant are kept
+    """
+
+    def __init__(self, keep: int = TENANT_SNAPSHOT_KEEP):
+        self.keep = keep
+
+    async def ensure_indexes(self, db):
+        await db.tenant_snapshots.create_index([("company_code", 1), ("created_at", -1)])
+        await db.tenant_snapshots.create_index("id", unique=True)
+
+    async def _download_tree(self, tree: Dict[str, Any]) -> Dict[str, Dict[str, Any]]:
+        result = await portainer_service.download_from_container(tree['container'], tree['root'])
+        if not result.get('success'):
+            raise RuntimeError(f"{tree['container']}:{tree['root']} - {result.get('error')}")
+        return await asyncio.to_thread(_read_tree, result['data'], tree['exclude'])
+
+    async def _store_blobs(self, db, files: Dict[str, Dict[str, Any]]) -> Dict[str, int]:
+        """Insert blobs that are not stored yet; returns new/reused counts"""
+        by_sha = {f['sha']: f['content'] for f in files.values()}
+        existing = {
+            doc['_id'] async for doc in
+            db.snapshot_blobs.find({'_id': {'$in': list(by_sha)}}, {'_id': 1})
+        }
+        missing = [sha for sha in by_sha if sha not in existing]
+        if missing:
+            now = datetime.now(timezone.utc).isoformat()
+            docs = []
+            for sha in missing:
+                content = by_sha[sha]
+                data = await asyncio.to_thread(gzip.compress, content, 6, mtime=0)
+                docs.append({'_id': sha, 'data': data, 'size': len(content), 'compressed_size': len(data), 'created_at': now})
+            try:
+                await db.snapshot_blobs.insert_many(docs, ordered=False)
+            except BulkWriteError as e:
+                # Another snapshot stored the same content concurrently
+                if any(err.get('code') != 11000 for err in e.details.get('writeErrors', [])):
+                    raise
+        return {'new': len(missing), 'reused': len(by_sha) - len(missing)}
+
+    async def create(self, db, company_code: str, frontend_mode: Optional[str] = None, reason: str = 'template_update') -> Dict[str, Any]:
+        """Snapshot the tenant's current code trees"""
+        started = time.monotonic()
+        snapshot = {
+            'id': str(uuid.uuid4()),
+            'company_code': company_code,
+            'reason': reason,
+            'trees': [],
+            'created_at': datetime.now(timezone.utc).isoformat()
+        }
+        blob_stats = {'new': 0, 'reused': 0}
+
+        try:
+            for tree in get_snapshot_trees(company_code, frontend_mode):
+                files = await self._download_tree(tree)
+                skipped = [path for path, f in files.items() if f['size'] > SNAPSHOT_MAX_BLOB_BYTES]
+                for path in skipped:
+                    files.pop(path)
+                    logger.warning(f"[SNAPSHOT] {company_code}: {tree['name']}/{path} too large, not snapshotted")
+
+                stats = await self._store_blobs(db, files)
+                blob_stats['new'] += stats['new']
+                blob_stats['reused'] += stats['reused']
+                snapshot['trees'].append({
+                    'name': tree['name'],
+                    'container': tree['container'],
+                    'root': tree['root'],
+                    'exclude': tree['exclude'] + skipped,
+                    'files': [
+                        {'path': path, 'sha': f['sha'], 'mode': f['mode'], 'size': f['size']}
+                        for path, f in sorted(files.items())
+                    ]
+                })
+        except Exception as e:
+            logger.error(f"[SNAPSHOT] {company_code}: snapshot failed - {e}")
+            return {'success': False, 'error': str(e)}
+
+        snapshot['blobs'] = blob_stats
+        await db.tenant_snapshots.insert_one(dict(snapshot))
+        await self.prune(db, company_code)
+
+        duration = round(time.monotonic() - started, 1)
+        logger.info(f"[SNAPSHOT] {company_code}: snapshot {snapshot['id']} created in {duration}s ({blob_stats})")
+        return {
+            'success': True,
+            'snapshot_id': snapshot['id'],
+            'files': sum(len(t['files']) for t in snapshot['trees']),
+            'blobs': blob_stats,
+            'duration_seconds': duration
+        }
+
+    async def list_snapshots(self, db, company_code: str) -> List[Dict[str, Any]]:
+        """Snapshots of a tenant, newest first (without file lists)"""
+        snapshots = await db.tenant_snapshots.find(
+            {'company_code': company_code},
+            {'_id': 0, 'trees.files': 0}
+        ).sort('created_at', -1).to_list(self.keep * 2)
+        return snapshots
+
+    async def rollback(self, db, company_code: str, snapshot_id: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Restore a snapshot (default: the latest) onto the tenant's containers.
+        Only files whose content differs are uploaded.
+        """
+        query = {'company_code': company_code}
+        if snapshot_id:
+            query['id'] = snapshot_id
+        snapshot = await db.tenant_snapshots.find_one(query, {'_id': 0}, sort=[('created_at', -1)])
+        if not snapshot:
+            return {'success': False, 'error': 'Snapshot not found'}
+
+        started = time.monotonic()
+        results = {}
+        for tree in snapshot['trees']:
+            try:
+                results[tree['name']] = await self._restore_tree(db, tree)
+            except Exception as e:
+                logger.error(f"[ROLLBACK] {company_code}: {tree['name']} restore failed - {e}")
+                results[tree['name']] = {'success': False, 'error': str(e)}
+
+        backend = results.get('backend')
+        if backend and backend.get('success') and backend['changed']:
+            container = next(t['container'] for t in snapshot['trees'] if t['name'] == 'backend')
+            # Restored requirements.txt must be installed before the restart picks up the code
+            backend['deps_install'] = await portainer_service.install_backend_dependencies(container)
+            backend['restart'] = await portainer_service.restart_container(container)
+            await portainer_service.wait_for_container_state(container, 'running', timeout=30)
+
+        frontend = results.get('frontend')
+        if frontend and frontend.get('success') and frontend['changed']:
+            container = next(t['container'] for t in snapshot['trees'] if t['name'] == 'frontend')
+            await portainer_service.exec_in_container(container, "nginx -s reload")
+
+        duration = round(time.monotonic() - started, 1)
+        success = all(r.get('success') for r in results.values())
+        logger.info(f"[ROLLBACK] {company_code}: snapshot {snapshot['id']} restored in {duration}s (success: {success})")
+        return {
+            'success': success,
+            'snapshot_id': snapshot['id'],
+            'snapshot_created_at': snapshot['created_at'],
+            'results': results,
+            'duration_seconds': duration
+        }
+
+    async def _restore_tree(self, db, tree: Dict[str, Any]) -> Dict[str, Any]:
+        # Snapshots taken before an exclude was added must not overwrite that file either
+        exclude = tree['exclude'] + (BACKEND_EXCLUDE if tree['name'] == 'backend' else [])
+        tree = {**tree, 'exclude': exclude}
+        current = await self._download_tree(tree)
+        wanted = {f['path']: f for f in tree['files'] if not _is_excluded(f['path'], exclude)}
+
+        to_write = [f for path, f in wanted.items() if current.get(path, {}).get('sha') != f['sha']]
+        to_delete = [path for path in current if path not in wanted and not _is_excluded(path, exclude)]
+
+        if to_write:
+            shas = list({f['sha'] for f in to_write})
+            blobs = {
+                doc['_id']: doc['data'] async for doc in
+                db.snapshot_blobs.find({'_id': {'$in': shas}})
+            }
+            missing = [sha for sha in shas if sha not in blobs]
+            if missing:
+                raise RuntimeError(f"{len(missing)} snapshot blobs missing")
+
+            tar_buffer = std_io.BytesIO()
+            now = time.time()
+            with tarfile.open(fileobj=tar_buffer, mode='w') as tar:
+                for f in to_write:
+                    content = gzip.decompress(blobs[f['sha']])
+                    info = tarfile.TarInfo(name=f['path'])
+                    info.size = len(content)
+                    info.mode = f['mode']
+                    info.mtime = now
+                    tar.addfile(info, std_io.BytesIO(content))
+
+            upload = await portainer_service.upload_to_container(tree['container'], tar_buffer.getvalue(), tree['root'])
+            if upload.get('error'):
+                raise RuntimeError(f"Upload failed: {upload['error']}")
+
+        for i in range(0, len(to_delete), SNAPSHOT_DELETE_BATCH):
+            batch = to_delete[i:i + SNAPSHOT_DELETE_BATCH]
+            paths = ' '.join(shlex.quote(path) for path in batch)
+            await portainer_service.exec_in_container(tree['container'], f"cd {shlex.quote(tree['root'])} && rm -f -- {paths}")
+
+        return {
+            'success': True,
+            'changed': bool(to_write or to_delete),
+            'written': len(to_write),
+            'deleted': len(to_delete),
+            'unchanged': len(wanted) - len(to_write)
+        }
+
+    async def prune(self, db, company_code: str):
+        """Drop snapshots beyond the newest `keep`, then blobs no snapshot references"""
+        old = await db.tenant_snapshots.find(
+            {'company_code': company_code}, {'_id': 0, 'id': 1}
+        ).sort('created_at', -1).skip(self.keep).to_list(None)
+        if not old:
+            return
+        await db.tenant_snapshots.delete_many({'id': {'$in': [s['id'] for s in old]}})
+
+        referenced = await db.tenant_snapshots.distinct('trees.files.sha')
+        cutoff = (datetime.now(timezone.utc) - timedelta(minutes=SNAPSHOT_BLOB_GRACE_MINUTES)).isoformat()
+        result = await db.snapshot_blobs.delete_many({'_id': {'$nin': referenced}, 'created_at': {'$lt': cutoff}})
+        logger.info(f"[SNAPSHOT] {company_code}: pruned {len(old)} snapshots, {result.deleted_count} blobs")
+
+
+# Singleton instance
+tenant_snapshots = TenantSnapshotService()
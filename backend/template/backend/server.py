@@ -5,17 +5,24 @@ SuperAdmin kodları bu dosyada YOK - sadece firma işlevselliği var.
 """
 
 import os
+import json
+import time
+import hashlib
 import uuid
+import asyncio
 import logging
+import contextvars
 from datetime import datetime, timezone, timedelta
 from typing import Optional, List
 from enum import Enum
 
-from fastapi import FastAPI, HTTPException, Depends, status
+from fastapi import FastAPI, HTTPException, Depends, Request, status
+from fastapi.responses import JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from pydantic import BaseModel, EmailStr
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo.errors import DuplicateKeyError
 from passlib.context import CryptContext
 from jose import JWTError, jwt
 
@@ -36,9 +43,128 @@ JWT_SECRET = os.environ.get("JWT_SECRET", "tenant_jwt_secret_key_2024")
 JWT_ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_HOURS = 24
 
+# Multi-tenant mode: one process serves many tenants, resolved from the Host header
+MULTI_TENANT = os.environ.get("MULTI_TENANT", "false").lower() == "true"
+TENANT_MAP_PATH = os.environ.get("TENANT_MAP_PATH", "/app/tenants.json")
+TENANT_MAP_RELOAD_INTERVAL = 5  # seconds
+TENANT_DB_POOL_SIZE = int(os.environ.get("TENANT_DB_POOL_SIZE", "10"))
+
 # MongoDB Connection
 client = AsyncIOMotorClient(MONGO_URL)
-db = client[DB_NAME]
+default_db = client[DB_NAME]
+
+# Tenant of the current request (multi-tenant mode)
+current_tenant: contextvars.ContextVar = contextvars.ContextVar("current_tenant", default=None)
+
+class TenantRegistry:
+    """
+    Host -> tenant map loaded from TENANT_MAP_PATH (written by SuperAdmin):
+        {"tenants": [{"code", "name", "hosts": ["api.firma.com"], "mongo_url", "db_name",
+                      "env": {"JWT_SECRET", "COMPANY_CODE", "COMPANY_NAME", "API_URL", "DOMAIN"}}]}
+    The file is re-read when its content changes; Mongo clients are shared per mongo_url.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self._digest = None
+        self._checked_at = 0.0
+        self._by_host = {}
+        self._tenants = {}
+        self._clients = {}
+        self._indexed = set()
+    
+    def _reload(self):
+        now = time.monotonic()
+        if now - self._checked_at < TENANT_MAP_RELOAD_INTERVAL:
+            return
+        self._checked_at = now
+        try:
+            with open(self.path, "rb") as f:
+                raw = f.read()
+        except OSError:
+            return
+        # Content hash, not mtime: two writes within the same second must both be picked up
+        digest = hashlib.sha256(raw).hexdigest()
+        if digest == self._digest:
+            return
+        
+        try:
+            entries = json.loads(raw).get("tenants", [])
+        except Exception as e:
+            logger.error(f"Tenant map could not be loaded: {e}")
+            return
+        
+        tenants = {}
+        by_host = {}
+        for entry in entries:
+            mongo_url = entry["mongo_url"]
+            if mongo_url not in self._clients:
+                self._clients[mongo_url] = AsyncIOMotorClient(mongo_url, maxPoolSize=TENANT_DB_POOL_SIZE)
+            tenant = {
+                "code": entry["code"],
+                "name": entry.get("name"),
+                "mongo_url": mongo_url,
+                "db": self._clients[mongo_url][entry["db_name"]],
+                "env": entry.get("env", {})
+            }
+            tenants[tenant["code"]] = tenant
+            for host in entry.get("hosts", []):
+                by_host[host.lower()] = tenant
+        
+        # Close clients no tenant uses anymore
+        live_urls = {t["mongo_url"] for t in tenants.values()}
+        for mongo_url in list(self._clients):
+            if mongo_url not in live_urls:
+                self._clients.pop(mongo_url).close()
+        
+        self._tenants = tenants
+        self._by_host = by_host
+        self._digest = digest
+        logger.info(f"Tenant map loaded: {len(tenants)} tenants")
+    
+    def resolve(self, host: str) -> Optional[dict]:
+        self._reload()
+        return self._by_host.get(host.split(":")[0].lower())
+    
+    def all(self) -> List[dict]:
+        self._reload()
+        return list(self._tenants.values())
+    
+    async def ensure_indexes(self, tenant: dict):
+        if tenant["code"] in self._indexed:
+            return
+        self._indexed.add(tenant["code"])
+        try:
+            await create_indexes(tenant["db"])
+        except Exception as e:
+            self._indexed.discard(tenant["code"])
+            logger.warning(f"Index creation failed for {tenant['code']}: {e}")
+
+tenant_registry = TenantRegistry(TENANT_MAP_PATH)
+
+def _active_db():
+    tenant = current_tenant.get()
+    if tenant is not None:
+        return tenant["db"]
+    if MULTI_TENANT:
+        raise RuntimeError("No tenant resolved for this request")
+    return default_db
+
+class TenantDatabase:
+    """`db` proxy: the current tenant's database in multi-tenant mode, DB_NAME otherwise"""
+    def __getattr__(self, name):
+        return getattr(_active_db(), name)
+    
+    def __getitem__(self, name):
+        return _active_db()[name]
+
+db = TenantDatabase()
+
+def tenant_env(name: str, default: str = "") -> str:
+    """Per-tenant setting in multi-tenant mode, environment variable otherwise"""
+    tenant = current_tenant.get()
+    if tenant is not None and name in tenant["env"]:
+        return tenant["env"][name]
+    return os.environ.get(name, default)
 
 # Password Hashing
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
@@ -84,6 +210,13 @@ class PaymentStatus(str, Enum):
     PARTIAL = "partial"
     REFUNDED = "refunded"
 
+class TicketStatus(str, Enum):
+    OPEN = "open"
+    IN_PROGRESS = "in_progress"
+    WAITING_CUSTOMER = "waiting_customer"
+    RESOLVED = "resolved"
+    CLOSED = "closed"
+
 # ============== PYDANTIC MODELS ==============
 class UserLogin(BaseModel):
     email: EmailStr
@@ -222,11 +355,11 @@ def create_access_token(data: dict) -> str:
     to_encode = data.copy()
     expire = datetime.now(timezone.utc) + timedelta(hours=ACCESS_TOKEN_EXPIRE_HOURS)
     to_encode.update({"exp": expire})
-    return jwt.encode(to_encode, JWT_SECRET, algorithm=JWT_ALGORITHM)
+    return jwt.encode(to_encode, tenant_env("JWT_SECRET", JWT_SECRET), algorithm=JWT_ALGORITHM)
 
 async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
     try:
-        payload = jwt.decode(credentials.credentials, JWT_SECRET, algorithms=[JWT_ALGORITHM])
+        payload = jwt.decode(credentials.credentials, tenant_env("JWT_SECRET", JWT_SECRET), algorithms=[JWT_ALGORITHM])
         user_id = payload.get("sub")
         if user_id is None:
             raise HTTPException(status_code=401, detail="Invalid token")
@@ -248,6 +381,25 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.middleware("http")
+async def resolve_tenant(request: Request, call_next):
+    """Multi-tenant mode: bind the tenant for api.{domain} to this request"""
+    if not MULTI_TENANT:
+        return await call_next(request)
+    
+    tenant = tenant_registry.resolve(request.headers.get("host", ""))
+    if tenant is None:
+        if request.url.path == "/api/health":
+            return await call_next(request)
+        return JSONResponse(status_code=404, content={"detail": "Unknown tenant"})
+    
+    await tenant_registry.ensure_indexes(tenant)
+    token = current_tenant.set(tenant)
+    try:
+        return await call_next(request)
+    finally:
+        current_tenant.reset(token)
+
 # ============== AUTH ROUTES ==============
 @app.post("/api/auth/login", response_model=TokenResponse)
 async def login(credentials: UserLogin):
@@ -1102,8 +1254,8 @@ async def get_company_info(user: dict = Depends(get_current_user)):
     
     if not company:
         # Return default company info from environment or settings
-        company_name = os.environ.get("COMPANY_NAME", "Rent A Car")
-        company_code = os.environ.get("COMPANY_CODE", "rentacar")
+        company_name = tenant_env("COMPANY_NAME", "Rent A Car")
+        company_code = tenant_env("COMPANY_CODE", "rentacar")
         return {
             "id": company_id,
             "name": company_name,
@@ -1287,7 +1439,7 @@ async def get_public_company_info():
     company = await db.company.find_one({}, {"_id": 0})
     if not company:
         return {
-            "name": os.environ.get("COMPANY_NAME", "Rent A Car"),
+            "name": tenant_env("COMPANY_NAME", "Rent A Car"),
             "phone": None,
             "email": None,
             "address": None,
@@ -1394,7 +1546,7 @@ async def login_public_customer(data: PublicCustomerLogin):
     
     token = jwt.encode(
         {"sub": customer["id"], "role": "customer", "exp": datetime.now(timezone.utc) + timedelta(hours=24)},
-        JWT_SECRET, algorithm=JWT_ALGORITHM
+        tenant_env("JWT_SECRET", JWT_SECRET), algorithm=JWT_ALGORITHM
     )
     
     return {
@@ -1484,12 +1636,151 @@ async def get_public_reservation(reservation_id: str, email: str):
 
 # ============== SUPPORT TICKETS (SuperAdmin Entegrasyonu) ==============
 
+SUPERADMIN_API_URL = os.environ.get("SUPERADMIN_API_URL", "https://api.vegarent.com")
+TICKET_OUTBOX_INTERVAL = int(os.environ.get("TICKET_OUTBOX_INTERVAL", "10"))
+TICKET_OUTBOX_MAX_ATTEMPTS = int(os.environ.get("TICKET_OUTBOX_MAX_ATTEMPTS", "20"))
+TICKET_OUTBOX_MAX_BACKOFF = 600  # seconds
+
+ticket_outbox_wakeup = asyncio.Event()
+
 class SupportTicketCreate(BaseModel):
     subject: str
     message: str
     priority: str = "normal"
     category: str = "general"
 
+class SupportTicketReply(BaseModel):
+    message: str
+
+async def enqueue_ticket_event(event_type: str, ticket_id: str, data: dict):
+    """
+    Ticket değişikliğini outbox'a yaz - SuperAdmin'e arka planda gönderilir.
+    Event types: ticket.created, ticket.reply, ticket.status
+    """
+    now = datetime.now(timezone.utc).isoformat()
+    await db.ticket_outbox.insert_one({
+        "id": str(uuid.uuid4()),
+        "event_type": event_type,
+        "ticket_id": ticket_id,
+        "company_code": tenant_env("COMPANY_CODE", "unknown"),
+        "occurred_at": now,
+        "data": data,
+        "status": "pending",
+        "attempts": 0,
+        "next_attempt_at": now,
+        "last_error": None,
+        "created_at": now
+    })
+    ticket_outbox_wakeup.set()
+
+async def _acquire_outbox_lease(seconds: int) -> bool:
+    """Only one worker process dispatches at a time so events keep their order"""
+    now = datetime.now(timezone.utc)
+    try:
+        await db.outbox_leases.find_one_and_update(
+            {"_id": "ticket_outbox", "locked_until": {"$lt": now.isoformat()}},
+            {"$set": {"locked_until": (now + timedelta(seconds=seconds)).isoformat()}},
+            upsert=True
+        )
+        return True
+    except DuplicateKeyError:
+        return False
+
+async def dispatch_ticket_outbox() -> int:
+    """
+    Bekleyen ticket event'lerini sırayla SuperAdmin'e gönder.
+    İlk başarısız event'te durur (sıra korunur), exponential backoff ile tekrar dener.
+    """
+    if not HTTPX_AVAILABLE or not SUPERADMIN_API_URL:
+        return 0
+    if not await _acquire_outbox_lease(TICKET_OUTBOX_INTERVAL * 3):
+        return 0
+    
+    sent = 0
+    try:
+        events = await db.ticket_outbox.find(
+            {"status": "pending"},
+            {"_id": 0}
+        ).sort("created_at", 1).to_list(50)
+        
+        async with httpx.AsyncClient(timeout=10.0) as client:
+            for event in events:
+                now = datetime.now(timezone.utc)
+                if event["next_attempt_at"] > now.isoformat():
+                    break  # Oldest event still backing off - keep order
+                
+                payload = {
+                    "event_id": event["id"],
+                    "event_type": event["event_type"],
+                    "ticket_id": event["ticket_id"],
+                    "company_code": event["company_code"],
+                    "occurred_at": event["occurred_at"],
+                    "data": event["data"]
+                }
+                error = None
+                permanent = False
+                try:
+                    response = await client.post(
+                        f"{SUPERADMIN_API_URL}/api/superadmin/support/tickets/events",
+                        json=payload,
+                        headers={"X-Tenant-Secret": os.environ.get("TENANT_SECRET", "")}
+                    )
+                    if response.status_code < 300:
+                        await db.ticket_outbox.delete_one({"id": event["id"]})
+                        sent += 1
+                        continue
+                    error = f"HTTP {response.status_code}: {response.text[:200]}"
+                    # 4xx (except 409/429) will never succeed - don't block the queue
+                    permanent = 400 <= response.status_code < 500 and response.status_code not in (409, 429)
+                except Exception as e:
+                    error = str(e)
+                
+                attempts = event.get("attempts", 0) + 1
+                if permanent or attempts >= TICKET_OUTBOX_MAX_ATTEMPTS:
+                    await db.ticket_outbox.update_one(
+                        {"id": event["id"]},
+                        {"$set": {"status": "failed", "attempts": attempts, "last_error": error}}
+                    )
+                    logger.error(f"Ticket event {event['event_type']} for {event['ticket_id']} failed permanently: {error}")
+                    continue
+                
+                backoff = min(TICKET_OUTBOX_INTERVAL * (2 ** attempts), TICKET_OUTBOX_MAX_BACKOFF)
+                await db.ticket_outbox.update_one(
+                    {"id": event["id"]},
+                    {"$set": {
+                        "attempts": attempts,
+                        "last_error": error,
+                        "next_attempt_at": (now + timedelta(seconds=backoff)).isoformat()
+                    }}
+                )
+                logger.warning(f"Could not send ticket event to SuperAdmin (attempt {attempts}, retry in {backoff}s): {error}")
+                break
+    finally:
+        await db.outbox_leases.update_one(
+            {"_id": "ticket_outbox"},
+            {"$set": {"locked_until": datetime.now(timezone.utc).isoformat()}}
+        )
+    
+    return sent
+
+async def ticket_outbox_worker():
+    """Outbox'ı periyodik olarak (veya yeni event geldiğinde hemen) boşalt"""
+    while True:
+        # Multi-tenant modda her tenant'ın kendi outbox'ı sırayla boşaltılır
+        for tenant in (tenant_registry.all() if MULTI_TENANT else [None]):
+            token = current_tenant.set(tenant)
+            try:
+                await dispatch_ticket_outbox()
+            except Exception as e:
+                logger.warning(f"Ticket outbox dispatch error: {e}")
+            finally:
+                current_tenant.reset(token)
+        try:
+            await asyncio.wait_for(ticket_outbox_wakeup.wait(), TICKET_OUTBOX_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        ticket_outbox_wakeup.clear()
+
 @app.get("/api/support/tickets")
 async def get_support_tickets(user: dict = Depends(get_current_user)):
     """Firma destek taleplerini listele"""
@@ -1501,15 +1792,16 @@ async def get_support_tickets(user: dict = Depends(get_current_user)):
 
 @app.post("/api/support/tickets")
 async def create_support_ticket(data: SupportTicketCreate, user: dict = Depends(get_current_user)):
-    """Destek talebi oluştur - SuperAdmin'e gönderilir"""
-    import httpx
-    
+    """Destek talebi oluştur - outbox üzerinden SuperAdmin'e gönderilir"""
     # Get company info
     company = await db.company.find_one({}, {"_id": 0})
     company_name = company.get("name", "Bilinmeyen Firma") if company else "Bilinmeyen Firma"
     
+    now = datetime.now(timezone.utc)
+    ticket_id = str(uuid.uuid4())
     ticket = {
-        "id": str(uuid.uuid4()),
+        "id": ticket_id,
+        "ticket_number": f"TKT-{now.strftime('%Y%m%d')}-{ticket_id[:6].upper()}",
         "subject": data.subject,
         "message": data.message,
         "priority": data.priority,
@@ -1519,28 +1811,33 @@ async def create_support_ticket(data: SupportTicketCreate, user: dict = Depends(
         "created_by_email": user["email"],
         "created_by_name": user.get("full_name", ""),
         "company_name": company_name,
-        "company_code": os.environ.get("COMPANY_CODE", "unknown"),
+        "company_code": tenant_env("COMPANY_CODE", "unknown"),
         "source": "tenant_panel",
-        "created_at": datetime.now(timezone.utc).isoformat(),
+        "messages": [
+            {
+                "id": str(uuid.uuid4()),
+                "sender_id": user["id"],
+                "sender_name": user.get("full_name", user["email"]),
+                "sender_type": "customer",
+                "message": data.message,
+                "created_at": now.isoformat()
+            }
+        ],
+        "created_at": now.isoformat(),
+        "updated_at": now.isoformat(),
         "responses": []
     }
     
-    # Save locally
-    await db.support_tickets.insert_one(ticket)
-    
-    # Try to send to SuperAdmin
-    superadmin_url = os.environ.get("SUPERADMIN_API_URL", "https://api.vegarent.com")
-    try:
-        async with httpx.AsyncClient(timeout=10.0) as client:
-            await client.post(
-                f"{superadmin_url}/api/superadmin/support/tickets/incoming",
-                json=ticket,
-                headers={"X-Tenant-Secret": os.environ.get("TENANT_SECRET", "")}
-            )
-    except Exception as e:
-        logger.warning(f"Could not send ticket to SuperAdmin: {e}")
+    # Save locally, then queue for SuperAdmin
+    await db.support_tickets.insert_one({**ticket})
+    await enqueue_ticket_event("ticket.created", ticket_id, ticket)
     
-    return {"success": True, "ticket_id": ticket["id"], "message": "Destek talebiniz oluşturuldu"}
+    return {
+        "success": True,
+        "ticket_id": ticket_id,
+        "ticket_number": ticket["ticket_number"],
+        "message": "Destek talebiniz oluşturuldu"
+    }
 
 @app.get("/api/support/tickets/{ticket_id}")
 async def get_support_ticket(ticket_id: str, user: dict = Depends(get_current_user)):
@@ -1550,6 +1847,47 @@ async def get_support_ticket(ticket_id: str, user: dict = Depends(get_current_us
         raise HTTPException(status_code=404, detail="Talep bulunamadı")
     return ticket
 
+@app.post("/api/support/tickets/{ticket_id}/reply")
+async def reply_support_ticket(ticket_id: str, data: SupportTicketReply, user: dict = Depends(get_current_user)):
+    """Destek talebine yanıt ekle"""
+    ticket = await db.support_tickets.find_one({"id": ticket_id}, {"_id": 0, "status": 1})
+    if not ticket:
+        raise HTTPException(status_code=404, detail="Talep bulunamadı")
+    
+    now = datetime.now(timezone.utc).isoformat()
+    message = {
+        "id": str(uuid.uuid4()),
+        "sender_id": user["id"],
+        "sender_name": user.get("full_name", user["email"]),
+        "sender_type": "customer",
+        "message": data.message,
+        "created_at": now
+    }
+    new_status = "in_progress" if ticket.get("status") == "waiting_customer" else ticket.get("status", "open")
+    
+    await db.support_tickets.update_one(
+        {"id": ticket_id},
+        {"$push": {"messages": message}, "$set": {"status": new_status, "updated_at": now}}
+    )
+    await enqueue_ticket_event("ticket.reply", ticket_id, {"message": message, "status": new_status})
+    
+    return {"success": True, "message": "Yanıt eklendi"}
+
+@app.patch("/api/support/tickets/{ticket_id}/status")
+async def update_support_ticket_status(ticket_id: str, status: TicketStatus, user: dict = Depends(get_current_user)):
+    """Destek talebi durumunu güncelle (ör. kapat)"""
+    now = datetime.now(timezone.utc).isoformat()
+    update = {"status": status.value, "updated_at": now}
+    if status == TicketStatus.RESOLVED:
+        update["resolved_at"] = now
+    
+    result = await db.support_tickets.update_one({"id": ticket_id}, {"$set": update})
+    if result.matched_count == 0:
+        raise HTTPException(status_code=404, detail="Talep bulunamadı")
+    await enqueue_ticket_event("ticket.status", ticket_id, update)
+    
+    return {"success": True, "message": f"Durum güncellendi: {status.value}"}
+
 # ============== MOBILE APP BUILD (Expo EAS) ==============
 
 EXPO_TOKEN = os.environ.get("EXPO_TOKEN", "vIg74dANrrkDXdDtOl6jSOmGRkKld9EKBhBxfKM3")
@@ -1578,8 +1916,8 @@ async def start_mobile_build(data: MobileBuildRequest, user: dict = Depends(get_
     # Get company info for customization
     company = await db.company.find_one({}, {"_id": 0})
     company_name = company.get("name", "Rent A Car") if company else "Rent A Car"
-    company_code = os.environ.get("COMPANY_CODE", "tenant")
-    api_url = os.environ.get("API_URL", f"https://api.{os.environ.get('DOMAIN', 'example.com')}")
+    company_code = tenant_env("COMPANY_CODE", "tenant")
+    api_url = tenant_env("API_URL", f"https://api.{tenant_env('DOMAIN', 'example.com')}")
     
     # Determine which app to build
     if data.app_type == "customer":
@@ -1618,7 +1956,7 @@ async def start_mobile_build(data: MobileBuildRequest, user: dict = Depends(get_
     
     # Try to trigger build via SuperAdmin API (which has access to containers)
     superadmin_url = os.environ.get("SUPERADMIN_URL", "http://72.61.158.147:9001")
-    company_code = os.environ.get("COMPANY_CODE", "")
+    company_code = tenant_env("COMPANY_CODE", "")
     
     if HTTPX_AVAILABLE and superadmin_url and company_code:
         try:
@@ -1810,8 +2148,8 @@ async def get_mobile_config(user: dict = Depends(get_current_user)):
     """Get mobile app configuration for this tenant"""
     company = await db.company.find_one({}, {"_id": 0})
     company_name = company.get("name", "Rent A Car") if company else "Rent A Car"
-    company_code = os.environ.get("COMPANY_CODE", "tenant")
-    api_url = os.environ.get("API_URL", f"https://api.{os.environ.get('DOMAIN', 'example.com')}")
+    company_code = tenant_env("COMPANY_CODE", "tenant")
+    api_url = tenant_env("API_URL", f"https://api.{tenant_env('DOMAIN', 'example.com')}")
     
     return {
         "customer_app": {
@@ -1864,15 +2202,24 @@ async def health_check():
     return {"status": "healthy", "timestamp": datetime.now(timezone.utc).isoformat()}
 
 # ============== STARTUP EVENT ==============
+async def create_indexes(database):
+    await database.users.create_index("email", unique=True)
+    await database.vehicles.create_index("plate")
+    await database.customers.create_index("email")
+    await database.reservations.create_index("vehicle_id")
+    await database.ticket_outbox.create_index([("status", 1), ("created_at", 1)])
+
 @app.on_event("startup")
 async def startup_event():
-    logger.info(f"Tenant API started - DB: {DB_NAME}")
+    if MULTI_TENANT:
+        # Tenant indexes are created on each tenant's first request
+        logger.info(f"Tenant API started - multi-tenant mode, map: {TENANT_MAP_PATH}")
+    else:
+        logger.info(f"Tenant API started - DB: {DB_NAME}")
+        await create_indexes(default_db)
     
-    # Create indexes
-    await db.users.create_index("email", unique=True)
-    await db.vehicles.create_index("plate")
-    await db.customers.create_index("email")
-    await db.reservations.create_index("vehicle_id")
+    # Start support ticket outbox dispatcher
+    asyncio.create_task(ticket_outbox_worker())
 
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,90 @@
+"""
+HGS statement parser tests (pure functions, no database)
+
+Run from backend/: python -m pytest tests
+"""
+import importlib.util
+import io
+from pathlib import Path
+
+import pytest
+
+# Loaded by path: importing the services package pulls in Portainer/httpx
+_spec = importlib.util.spec_from_file_location(
+    'hgs_statement', Path(__file__).resolve().parent.parent / 'services' / 'hgs_statement.py'
+)
+hgs_statement = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(hgs_statement)
+
+
+def rows(text: str):
+    return list(hgs_statement.iter_statement_rows(io.BytesIO(text.encode('utf-8'))))
+
+
+@pytest.mark.parametrize('value, expected', [
+    ('12,50', 12.5),
+    ('1.234,50', 1234.5),
+    ('1,234.50', 1234.5),
+    ('1234.50', 1234.5),
+    ('45,00 TL', 45.0),
+    ('₺ 7,25', 7.25),
+    ('-12,50', -12.5),
+])
+def test_parse_amount(value, expected):
+    assert hgs_statement.parse_amount(value) == pytest.approx(expected)
+
+
+def test_parse_amount_rejects_text():
+    with pytest.raises(ValueError):
+        hgs_statement.parse_amount('abc')
+
+
+def test_parse_passage_time_turkish_format_is_turkey_time():
+    assert hgs_statement.parse_passage_time('31.01.2026 14:05') == '2026-01-31T11:05:00+00:00'
+
+
+def test_parse_passage_time_iso_with_offset():
+    assert hgs_statement.parse_passage_time('2026-01-31T14:05:00Z') == '2026-01-31T14:05:00+00:00'
+
+
+def test_parse_passage_time_rejects_unknown_format():
+    with pytest.raises(ValueError):
+        hgs_statement.parse_passage_time('31 Ocak')
+
+
+def test_iter_statement_rows_semicolon_turkish_headers():
+    result = rows(
+        'Geçiş No;Etiket No;Plaka;Tutar;Geçiş Tarihi;İstasyon\n'
+        'G1;123 456;34 ABC 123;12,50;31.01.2026 14:05;Çamlıca\n'
+    )
+    assert len(result) == 1
+    line_number, row, error = result[0]
+    assert (line_number, error) == (2, None)
+    assert row['passage_id'] == 'G1'
+    assert row['tag_number'] == '123456'
+    assert row['amount'] == 12.5
+    assert row['passage_time'] == '2026-01-31T11:05:00+00:00'
+
+
+def test_iter_statement_rows_reports_bad_lines():
+    result = rows(
+        'plaka,tutar\n'
+        '34ABC123,abc\n'
+        ',10.00\n'
+        '\n'
+        '34ABC123,10.00\n'
+    )
+    assert [(line, error is None) for line, _, error in result] == [(2, False), (3, False), (5, True)]
+
+
+def test_identical_rows_without_passage_id_stay_separate():
+    text = 'plaka;tutar\n34ABC123;12,50\n34ABC123;12,50\n'
+    ids = [row['passage_id'] for _, row, _ in rows(text)]
+    assert len(set(ids)) == 2
+    # Re-importing the same statement yields the same ids
+    assert ids == [row['passage_id'] for _, row, _ in rows(text)]
+
+
+def test_statement_without_amount_column_is_rejected():
+    with pytest.raises(hgs_statement.StatementError):
+        rows('plaka;tarih\n34ABC123;31.01.2026\n')
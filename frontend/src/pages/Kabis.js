@@ -177,6 +177,12 @@ export function Kabis() {
         return <Badge className="bg-green-100 text-green-800"><CheckCircle className="h-3 w-3 mr-1" />Gonderildi</Badge>;
       case "pending_api":
         return <Badge className="bg-amber-100 text-amber-800"><Clock className="h-3 w-3 mr-1" />API Bekliyor</Badge>;
+      case "pending":
+      case "submitting":
+        return <Badge className="bg-blue-100 text-blue-800"><Clock className="h-3 w-3 mr-1" />Kuyrukta</Badge>;
+      case "failed":
+      case "rejected":
+        return <Badge className="bg-red-100 text-red-800"><XCircle className="h-3 w-3 mr-1" />{status === "failed" ? "Gonderilemedi" : "Reddedildi"}</Badge>;
       case "cancelled":
         return <Badge className="bg-red-100 text-red-800"><XCircle className="h-3 w-3 mr-1" />Iptal</Badge>;
       default: